@@ -7,6 +7,7 @@ __all__ = ['CharacterLevelParser',
            'JsonSchemaParser',
            'TokenEnforcer',
            'TokenEnforcerTokenizerData',
+           'EnforcerManager',
            'LMFormatEnforcerException',
            'FormatEnforcerAnalyzer',]
 
@@ -14,6 +15,7 @@ from .characterlevelparser import CharacterLevelParser, CharacterLevelParserConf
 from .regexparser import RegexParser
 from .jsonschemaparser import JsonSchemaParser
 from .tokenenforcer import TokenEnforcer, TokenEnforcerTokenizerData
+from .enforcermanager import EnforcerManager
 from .exceptions import LMFormatEnforcerException
 try:
     from .analyzer import FormatEnforcerAnalyzer
@@ -0,0 +1,193 @@
+import codecs
+import functools
+import sys
+from typing import Hashable, Iterable, List, Optional, Tuple
+
+from .characterlevelparser import CharacterLevelParser, CharacterLevelParserConfig
+
+# In byte level mode, every byte is represented by the character with the same code point (latin-1), so that the tokenizer
+# prefix tree and the parsers keep working with strings.
+
+
+def bytes_to_byte_string(data: bytes) -> str:
+    return data.decode('latin-1')
+
+
+def byte_string_to_text(byte_string: str) -> str:
+    return byte_string.encode('latin-1').decode('utf-8', errors='replace')
+
+
+def is_utf8_prefix(byte_string: str) -> bool:
+    """Whether the bytes are valid UTF-8 when they start at a character boundary, allowing an incomplete last character."""
+    try:
+        codecs.utf_8_decode(byte_string.encode('latin-1'), 'strict', False)
+        return True
+    except UnicodeDecodeError:
+        return False
+
+
+# Stands for all of the characters that are not in the byte level alphabet. Byte fallback tokenizers can build any character 
+# from its bytes, and listing all of them would make every parser that allows "any character" (such as JSON strings) slow.
+OTHER_CHARACTER = '\U0010ffff'
+
+
+def get_byte_level_alphabet(regular_tokens: List[Tuple[int, str, bool]], token_byte_strings: Iterable[str]) -> str:
+    """The characters that the parsers allow in byte level mode: the characters that the tokens contain, and OTHER_CHARACTER,
+    which Utf8ByteParser translates to the UTF-8 encodings of all of the other characters."""
+    alphabet = set()
+    for _, token_str, _ in regular_tokens:
+        alphabet.update(token_str)
+    for token_byte_string in token_byte_strings:
+        alphabet.update(byte_string_to_text(token_byte_string))
+    alphabet.discard('\ufffd')
+    alphabet.add(OTHER_CHARACTER)
+    return "".join(sorted(alphabet))
+
+
+@functools.lru_cache(maxsize=16)
+def _get_character_set(characters: str) -> frozenset:
+    return frozenset(characters)
+
+
+def _get_utf8_next_bytes(pending_bytes: bytes) -> range:
+    # The bytes that can follow pending_bytes in a valid UTF-8 encoding of a non-ASCII character
+    if not pending_bytes:
+        return range(0xC2, 0xF5)
+    if len(pending_bytes) == 1:
+        # The second byte is limited after some lead bytes, to rule out overlong encodings, surrogates and code points above U+10FFFF
+        lead_byte = pending_bytes[0]
+        if lead_byte == 0xE0:
+            return range(0xA0, 0xC0)
+        if lead_byte == 0xED:
+            return range(0x80, 0xA0)
+        if lead_byte == 0xF0:
+            return range(0x90, 0xC0)
+        if lead_byte == 0xF4:
+            return range(0x80, 0x90)
+    return range(0x80, 0xC0)
+
+
+def _get_utf8_length(lead_byte: int) -> int:
+    if lead_byte < 0xE0:
+        return 2
+    return 3 if lead_byte < 0xF0 else 4
+
+
+@functools.lru_cache(maxsize=4096)
+def _get_allowed_bytes(allowed_characters: str, pending_bytes: bytes, alphabet: str) -> str:
+    # The bytes that can follow pending_bytes in the UTF-8 encoding of one of the allowed characters
+    if not pending_bytes:
+        # The first bytes of the allowed characters are the bytes of their encoding that are not continuation bytes
+        encoded = allowed_characters.replace(OTHER_CHARACTER, '').encode('utf-8', errors='ignore')
+        allowed_bytes = set(byte for byte in set(encoded) if not 0x80 <= byte < 0xC0)
+    else:
+        # Only the characters in the code point range of pending_bytes are encoded
+        num_pending_bytes = len(pending_bytes)
+        utf8_length = _get_utf8_length(pending_bytes[0])
+        num_remaining_bits = 6 * (utf8_length - num_pending_bytes)
+        code_point = pending_bytes[0] & (0x7F >> utf8_length)
+        for byte in pending_bytes[1:]:
+            code_point = (code_point << 6) | (byte & 0x3F)
+        first_character = chr(code_point << num_remaining_bits)
+        last_character = chr(min(((code_point + 1) << num_remaining_bits) - 1, sys.maxunicode))
+        allowed_bytes = set()
+        for character in allowed_characters:
+            if first_character <= character <= last_character and character != OTHER_CHARACTER:
+                encoded = character.encode('utf-8', errors='ignore')
+                if len(encoded) > num_pending_bytes and encoded.startswith(pending_bytes):
+                    allowed_bytes.add(encoded[num_pending_bytes])
+    if OTHER_CHARACTER in allowed_characters:
+        next_bytes = _get_utf8_next_bytes(pending_bytes)
+        if pending_bytes and len(pending_bytes) + 1 == _get_utf8_length(pending_bytes[0]):
+            # The characters that complete here are known, and the ones in the alphabet are only allowed if they are listed
+            alphabet_characters = _get_character_set(alphabet)
+            for byte in next_bytes:
+                if (pending_bytes + bytes([byte])).decode('utf-8') not in alphabet_characters:
+                    allowed_bytes.add(byte)
+        else:
+            allowed_bytes.update(next_bytes)
+    return "".join(chr(byte) for byte in sorted(allowed_bytes))
+
+
+def _add_decoded_string(parser: CharacterLevelParser, decoded: str) -> CharacterLevelParser:
+    # Characters outside of the alphabet are passed as OTHER_CHARACTER, unless the parser allows them explicitly
+    # (for example, a literal character of a pattern)
+    if decoded.isascii():
+        return parser.add_string(decoded)
+    alphabet_characters = _get_character_set(parser.config.alphabet)
+    start_idx = 0
+    for idx, character in enumerate(decoded):
+        if character < '\x80' or character in alphabet_characters:
+            continue
+        if start_idx < idx:
+            parser = parser.add_string(decoded[start_idx:idx])
+        if character not in parser.get_allowed_characters():
+            character = OTHER_CHARACTER
+        parser = parser.add_character(character)
+        start_idx = idx + 1
+    return parser.add_string(decoded[start_idx:]) if start_idx < len(decoded) else parser
+
+
+class Utf8ByteParser(CharacterLevelParser):
+    """Utf8ByteParser adapts a CharacterLevelParser to byte level mode (see TokenEnforcerTokenizerData): it receives the
+    UTF-8 bytes of the text as latin-1 characters, and passes the decoded characters to the inner parser. The bytes of an
+    incomplete character are kept until it is complete, and only bytes that continue an allowed character are allowed."""
+    def __init__(self, parser: CharacterLevelParser, pending_bytes: bytes = b''):
+        self.parser = parser
+        self.pending_bytes = pending_bytes
+
+    def add_character(self, new_character: str) -> CharacterLevelParser:
+        return self.add_string(new_character)
+
+    def add_string(self, new_string: str) -> CharacterLevelParser:
+        data = self.pending_bytes + new_string.encode('latin-1')
+        # Raises UnicodeDecodeError for invalid UTF-8, like other parsers raise for characters that are not allowed
+        decoded, num_consumed_bytes = codecs.utf_8_decode(data, 'strict', False)
+        parser = _add_decoded_string(self.parser, decoded) if decoded else self.parser
+        return Utf8ByteParser(parser, data[num_consumed_bytes:])
+
+    def get_allowed_characters(self) -> str:
+        return _get_allowed_bytes(self.parser.get_allowed_characters(), self.pending_bytes, self.parser.config.alphabet)
+
+    def can_end(self) -> bool:
+        return not self.pending_bytes and self.parser.can_end()
+
+    def shortcut_key(self) -> Optional[Hashable]:
+        if self.pending_bytes:
+            return None
+        shortcut_key = self.parser.shortcut_key()
+        if isinstance(shortcut_key, tuple) and shortcut_key[0] == 'json_freetext':
+            # The JSON freetext token lists count bytes instead of characters, so they are only exact without length constraints
+            _, cur_len, min_len, max_len = shortcut_key
+            if cur_len >= min_len and max_len == sys.maxsize:
+                return shortcut_key
+        return None
+
+    def get_any_string_characters(self) -> Optional[str]:
+        if self.pending_bytes:
+            return None
+        any_string_characters = self.parser.get_any_string_characters()
+        if any_string_characters is None:
+            return None
+        # ASCII characters are single bytes, any other character is only allowed through its complete encoding
+        return "".join(character for character in any_string_characters if character < '\x80')
+
+    def cache_key(self) -> Optional[Hashable]:
+        cache_key = self.parser.cache_key()
+        if cache_key is None:
+            return None
+        return ('utf8', self.pending_bytes, cache_key)
+
+    def fingerprint(self) -> Optional[Hashable]:
+        fingerprint = self.parser.fingerprint()
+        if fingerprint is None:
+            return None
+        return ('utf8', fingerprint)
+
+    @property
+    def config(self) -> CharacterLevelParserConfig:
+        return self.parser.config
+
+    @config.setter
+    def config(self, new_config: CharacterLevelParserConfig):
+        self.parser.config = new_config
@@ -0,0 +1,352 @@
+import abc
+from collections import OrderedDict
+import dbm
+import hashlib
+import mmap
+import os
+import struct
+import threading
+from typing import Any, Callable, Dict, Generic, Hashable, Iterator, List, Optional, Tuple, TypeVar
+
+from .tokenlist import TokenList
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+
+class LRUCache(Generic[K, V]):
+    """A dictionary-like container that holds at most max_size entries. When it is full, the least recently used
+    entry is evicted. Both reading (get / []) and writing an entry count as using it.
+    A max_size of None means that the cache is unbounded, which is the same as a regular dictionary.
+    All operations are thread safe. The on_evict callback is called outside of the internal lock."""
+    def __init__(self, max_size: Optional[int] = None, on_evict: Optional[Callable[[K, V], None]] = None):
+        """
+        :param max_size: The maximal number of entries to hold, or None for no limit.
+        :param on_evict: An optional callback that is called with (key, value) for every entry that is evicted because of the size limit.
+        """
+        if max_size is not None and max_size <= 0:
+            raise ValueError("LRUCache max_size must be positive")
+        self.max_size = max_size
+        self.on_evict = on_evict
+        self._data: 'OrderedDict[K, V]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def __getitem__(self, key: K) -> V:
+        with self._lock:
+            value = self._data[key]
+            self._data.move_to_end(key)
+            return value
+
+    def __setitem__(self, key: K, value: V):
+        with self._lock:
+            evicted_items = self._insert(key, value)
+        self._notify_evicted(evicted_items)
+
+    def setdefault(self, key: K, value: V) -> V:
+        """Insert value if key is missing, and return the value that is stored for key. Used to publish
+        entries that were computed without holding a lock, so that all threads end up using the same one."""
+        with self._lock:
+            existing = self._data.get(key)
+            if existing is not None:
+                self._data.move_to_end(key)
+                return existing
+            evicted_items = self._insert(key, value)
+        self._notify_evicted(evicted_items)
+        return value
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def pop(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def items(self) -> Iterator[Tuple[K, V]]:
+        with self._lock:
+            return iter(list(self._data.items()))
+
+    def values(self) -> Iterator[V]:
+        with self._lock:
+            return iter(list(self._data.values()))
+
+    def attach(self, tokenizer_data: Any):
+        """Part of the AllowedTokenCacheBackend interface. In-memory lists do not depend on the tokenizer data."""
+        pass
+
+    def _insert(self, key: K, value: V) -> List[Tuple[K, V]]:
+        # Must be called while holding the lock
+        self._data[key] = value
+        self._data.move_to_end(key)
+        evicted_items = []
+        if self.max_size is not None:
+            while len(self._data) > self.max_size:
+                evicted_items.append(self._data.popitem(last=False))
+        return evicted_items
+
+    def _notify_evicted(self, evicted_items: List[Tuple[K, V]]):
+        if self.on_evict is not None:
+            for evicted_key, evicted_value in evicted_items:
+                self.on_evict(evicted_key, evicted_value)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+class ParserTransitionTable:
+    """A transition table of parser states that is built lazily, while the tokenizer tree is traversed: 
+    (cache key, character) -> (next parser, its cache key), and cache key -> allowed characters. Parsers with equal cache keys 
+    behave the same, so once a transition was computed, following it again is a dictionary lookup instead of a new parser object.
+    Keys are namespaced by the fingerprint of the root parser, so one table can be shared by all of the TokenEnforcers of a tokenizer
+    (see TokenEnforcerTokenizerData). When a table reaches max_size entries it is cleared, which only costs recomputation.
+    Lookups are lock free, concurrent misses may compute the same transition twice."""
+    def __init__(self, max_size: Optional[int] = None):
+        """
+        :param max_size: The maximal number of transitions (and of allowed character strings) to hold, or None for no limit.
+        """
+        if max_size is not None and max_size <= 0:
+            raise ValueError("ParserTransitionTable max_size must be positive")
+        self.max_size = max_size
+        self._transitions: Dict[Hashable, Tuple[Any, Optional[Hashable]]] = {}
+        self._allowed_characters: Dict[Hashable, str] = {}
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def add_character(self, namespace: Hashable, parser: Any, cache_key: Hashable, character: str) -> Tuple[Any, Optional[Hashable]]:
+        """Return parser.add_character(character) and its cache key, where cache_key is parser.cache_key()."""
+        key = (namespace, cache_key, character)
+        transition = self._transitions.get(key)
+        if transition is not None:
+            self.num_hits += 1
+            return transition
+        self.num_misses += 1
+        next_parser = parser.add_character(character)
+        transition = (next_parser, next_parser.cache_key())
+        self._insert(self._transitions, key, transition)
+        return transition
+
+    def get_allowed_characters(self, namespace: Hashable, parser: Any, cache_key: Hashable) -> str:
+        """Return parser.get_allowed_characters(), where cache_key is parser.cache_key()."""
+        key = (namespace, cache_key)
+        allowed_characters = self._allowed_characters.get(key)
+        if allowed_characters is not None:
+            self.num_hits += 1
+            return allowed_characters
+        self.num_misses += 1
+        allowed_characters = parser.get_allowed_characters()
+        self._insert(self._allowed_characters, key, allowed_characters)
+        return allowed_characters
+
+    @property
+    def hit_rate(self) -> float:
+        num_lookups = self.num_hits + self.num_misses
+        return self.num_hits / num_lookups if num_lookups else 0.0
+
+    def __len__(self) -> int:
+        return len(self._transitions)
+
+    def clear(self):
+        self._transitions.clear()
+        self._allowed_characters.clear()
+
+    def _insert(self, table: Dict[Hashable, Any], key: Hashable, value: Any):
+        if self.max_size is not None and len(table) >= self.max_size:
+            table.clear()
+        table[key] = value
+
+
+class AllowedTokenCacheBackend(abc.ABC):
+    """A store for allowed token lists that are shared between TokenEnforcers, see the shared_allowed_token_cache_backend 
+    parameter of TokenEnforcerTokenizerData. LRUCache is the in-memory backend. PersistentAllowedTokenCache backends keep
+    the lists on disk, so that a new process (for example, a new replica after a deploy) starts with warm caches."""
+    def attach(self, tokenizer_data: Any):
+        """Called once by the TokenEnforcerTokenizerData that the backend is given to."""
+        pass
+
+    @abc.abstractmethod
+    def get(self, key: Hashable, default: Optional[TokenList] = None) -> Optional[TokenList]:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def setdefault(self, key: Hashable, value: TokenList) -> TokenList:
+        """Store value if key is missing, and return the value that is stored for key."""
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def __len__(self) -> int:
+        raise NotImplementedError()
+
+
+AllowedTokenCacheBackend.register(LRUCache)
+
+
+class PersistentAllowedTokenCache(AllowedTokenCacheBackend):
+    """Base class of the on-disk backends. Lists are stored as packed bitmasks, keyed by the tokenizer fingerprint and the
+    sha256 hash of the repr() of the cache key (the root parser fingerprint and the parser's cache key), so the keys must have a stable repr().
+    Lists that were read from disk are kept in an in-memory LRUCache."""
+    def __init__(self, max_memory_entries: Optional[int] = 1024):
+        self._memory_cache: LRUCache[Hashable, TokenList] = LRUCache(max_memory_entries)
+        self._tokenizer_fingerprint = ''
+        self._use_bitmask = False
+        self._vocab_size = 0
+        self._lock = threading.Lock()
+
+    def attach(self, tokenizer_data: Any):
+        self._tokenizer_fingerprint = tokenizer_data.fingerprint
+        self._use_bitmask = tokenizer_data.use_bitmask
+        self._vocab_size = tokenizer_data.vocab_size
+
+    def get(self, key: Hashable, default: Optional[TokenList] = None) -> Optional[TokenList]:
+        value = self._memory_cache.get(key)
+        if value is not None:
+            return value
+        data = self._read(self._encode_key(key))
+        if data is None:
+            return default
+        value = TokenList.from_packed_bytes(data, self._use_bitmask, self._vocab_size)
+        return self._memory_cache.setdefault(key, value)
+
+    def setdefault(self, key: Hashable, value: TokenList) -> TokenList:
+        existing = self.get(key)
+        if existing is not None:
+            return existing
+        value = self._memory_cache.setdefault(key, value)
+        self._write(self._encode_key(key), value.to_packed_bytes(self._vocab_size))
+        return value
+
+    def _encode_key(self, key: Hashable) -> bytes:
+        # Cache keys of JSON schema parsers can be long, so only a hash of their repr() is stored
+        key_hash = hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+        return f"{self._tokenizer_fingerprint}:{key_hash}".encode('utf-8')
+
+    @abc.abstractmethod
+    def _read(self, key: bytes) -> Optional[bytes]:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def _write(self, key: bytes, data: bytes):
+        raise NotImplementedError()
+
+
+class MemoryMappedFileCache(PersistentAllowedTokenCache):
+    """Stores the lists in an append-only file, which is memory mapped for reading. Copying a file that was filled 
+    by a warmed up process (see TokenEnforcer.warm_up()) to new replicas gives them warm caches at startup.
+    Only one process should write to a file at a time; use read_only=True for the others."""
+    _MAGIC = b'LMFEMMC1'
+    _RECORD_HEADER = struct.Struct('<II')
+
+    def __init__(self, path: str, read_only: bool = False, max_memory_entries: Optional[int] = 1024):
+        super().__init__(max_memory_entries)
+        self.path = path
+        self.read_only = read_only
+        self._index: Dict[bytes, Tuple[int, int]] = {}
+        self._mmap: Optional[mmap.mmap] = None
+        self._file = open(path, 'rb' if read_only else 'a+b')
+        self._file.seek(0, os.SEEK_END)
+        if self._file.tell() == 0 and not read_only:
+            self._file.write(self._MAGIC)
+            self._file.flush()
+        self._load_index()
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def close(self):
+        with self._lock:
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
+            self._file.close()
+
+    def _remap(self):
+        # Must be called while holding the lock
+        if self._mmap is not None:
+            self._mmap.close()
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _load_index(self):
+        with self._lock:
+            self._remap()
+            if self._mmap[:len(self._MAGIC)] != self._MAGIC:
+                raise ValueError(f"{self.path} is not an allowed token cache file")
+            offset = len(self._MAGIC)
+            file_size = len(self._mmap)
+            while offset + self._RECORD_HEADER.size <= file_size:
+                key_length, data_length = self._RECORD_HEADER.unpack_from(self._mmap, offset)
+                data_offset = offset + self._RECORD_HEADER.size + key_length
+                if data_offset + data_length > file_size:
+                    break  # A partially written record, from a process that was interrupted
+                key = self._mmap[offset + self._RECORD_HEADER.size:data_offset]
+                self._index[key] = (data_offset, data_length)
+                offset = data_offset + data_length
+
+    def _read(self, key: bytes) -> Optional[bytes]:
+        with self._lock:
+            location = self._index.get(key)
+            if location is None:
+                return None
+            data_offset, data_length = location
+            if data_offset + data_length > len(self._mmap):
+                self._remap()
+            return self._mmap[data_offset:data_offset + data_length]
+
+    def _write(self, key: bytes, data: bytes):
+        if self.read_only:
+            return
+        with self._lock:
+            if key in self._index:
+                return
+            self._file.seek(0, os.SEEK_END)
+            record_offset = self._file.tell()
+            self._file.write(self._RECORD_HEADER.pack(len(key), len(data)) + key + data)
+            self._file.flush()
+            self._index[key] = (record_offset + self._RECORD_HEADER.size + len(key), len(data))
+
+
+class KeyValueFileCache(PersistentAllowedTokenCache):
+    """Stores the lists in a local key-value database file, using the standard library's dbm module."""
+    def __init__(self, path: str, read_only: bool = False, max_memory_entries: Optional[int] = 1024):
+        super().__init__(max_memory_entries)
+        self.path = path
+        self.read_only = read_only
+        self._db = dbm.open(path, 'r' if read_only else 'c')
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._db)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _read(self, key: bytes) -> Optional[bytes]:
+        with self._lock:
+            return self._db.get(key)
+
+    def _write(self, key: bytes, data: bytes):
+        if self.read_only:
+            return
+        with self._lock:
+            if key not in self._db:
+                self._db[key] = data
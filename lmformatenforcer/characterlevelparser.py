@@ -49,6 +49,15 @@ class CharacterLevelParser(abc.ABC):
         an immutable operation - the original CharacterLevelParser (self) must not be modified."""
         raise NotImplementedError()
 
+    def add_string(self, new_string: str) -> 'CharacterLevelParser':
+        """Add several characters to the parser, and return a new parser that represents the state after all of them have been added.
+        The default implementation calls add_character() for each character. Parsers can override it to consume runs of characters
+        without creating the intermediate parser objects. Like add_character(), this has to be an immutable operation."""
+        parser = self
+        for new_character in new_string:
+            parser = parser.add_character(new_character)
+        return parser
+
     @abc.abstractmethod
     def get_allowed_characters(self) -> str:
         """Return a string containing all characters that are allowed at the current point in the parsing process."""
@@ -66,6 +75,18 @@ class CharacterLevelParser(abc.ABC):
     def cache_key(self) -> Optional[Hashable]:
         """Optional. Return a key that denotes that this state is a repeating state, and if it is visited again, results can be cached."""
         return None
+
+    def get_any_string_characters(self) -> Optional[str]:
+        """Optional. Return a string of characters S, such that from the current state, the parser accepts any string over S
+        (every character of S is allowed, and keeps all of S allowed). TokenEnforcer then allows whole tokenizer subtrees 
+        that only use characters of S, without exploring them. None means that there is no such guarantee."""
+        return None
+
+    def fingerprint(self) -> Optional[Hashable]:
+        """Optional. Return a stable key that identifies the language that the parser accepts (for example, its pattern or schema), 
+        that is the same in every TokenEnforcer and process. Cache keys of parsers with equal fingerprints can be shared between 
+        TokenEnforcers (see TokenEnforcerTokenizerData). Parsers that return None are not shared."""
+        return None
     
     @property
     def config(self) -> CharacterLevelParserConfig:
@@ -89,11 +110,17 @@ class StringParser(CharacterLevelParser):
         else:
             raise ValueError(f"Expected '{self.target_str[0]}' but got '{new_character}'")
 
+    def add_string(self, new_string: str) -> CharacterLevelParser:
+        return self.add_character(new_string)
+
     def get_allowed_characters(self) -> str:
         return self.target_str[0] if self.target_str else ""
 
     def can_end(self) -> bool:
         return not self.target_str
+
+    def fingerprint(self) -> Optional[Hashable]:
+        return ('string', self.target_str)
     
 
 class ForceStopParser(CharacterLevelParser):
@@ -102,10 +129,16 @@ class ForceStopParser(CharacterLevelParser):
         self.allow_whitespace = allow_whitespace
     def add_character(self, new_character: str) -> CharacterLevelParser:
         return self
+    def add_string(self, new_string: str) -> CharacterLevelParser:
+        return self
     def get_allowed_characters(self) -> str:
         return WHITESPACE_CHARACTERS if self.allow_whitespace else ""
     def can_end(self) -> bool:
         return True
+    def get_any_string_characters(self) -> Optional[str]:
+        return self.get_allowed_characters()
+    def fingerprint(self) -> Optional[Hashable]:
+        return ('force_stop', self.allow_whitespace)
     
 
 class UnionParser(CharacterLevelParser):
@@ -140,6 +173,12 @@ class UnionParser(CharacterLevelParser):
             return ('union', all_cache_keys)
         return None
 
+    def fingerprint(self) -> Optional[Hashable]:
+        all_fingerprints = tuple(parser.fingerprint() for parser in self.parsers)
+        if all(fingerprint is not None for fingerprint in all_fingerprints):
+            return ('union', all_fingerprints)
+        return None
+
 
 class SequenceParser(CharacterLevelParser):
     """A parser that is a sequence of multiple parsers."""
@@ -185,4 +224,10 @@ class SequenceParser(CharacterLevelParser):
             return ('sequence', all_cache_keys)
         return None
 
+    def fingerprint(self) -> Optional[Hashable]:
+        all_fingerprints = tuple(parser.fingerprint() for parser in self.parsers)
+        if all(fingerprint is not None for fingerprint in all_fingerprints):
+            return ('sequence', all_fingerprints)
+        return None
+
 
@@ -0,0 +1,66 @@
+import abc
+import codecs
+from typing import Any, Callable, List, Optional, Sequence, Tuple
+
+
+class IncrementalDetokenizer(abc.ABC):
+    """IncrementalDetokenizer decodes the tokens of the current word one at a time, for TokenEnforcer. It works with an
+    opaque detokenizer state that is stored with each TokenEnforcer state, and holds whatever the detokenizer needs to know
+    about the current word. States are never modified, as the same state can be continued with different tokens. 
+    They should be made of plain values (such as tuples, strings and bytes), so that TokenEnforcer.dump_state() can store them."""
+
+    @abc.abstractmethod
+    def start(self, current_word_tokens: List[int]) -> Any:
+        """Return the detokenizer state after the tokens of the current word."""
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def decode_next(self, state: Any, new_token: int) -> Tuple[str, Any]:
+        """Return the characters that new_token adds to the current word, and the detokenizer state after it."""
+        raise NotImplementedError()
+
+
+class DecoderIncrementalDetokenizer(IncrementalDetokenizer):
+    """Uses the decoder function of TokenEnforcerTokenizerData. The state is the tokens of the current word and their decoded
+    string, so each token only decodes the current word once. This works with any tokenizer, but the cost grows with the 
+    length of the word."""
+    def __init__(self, decoder: Callable[[List[int]], str]):
+        self.decoder = decoder
+
+    def start(self, current_word_tokens: List[int]) -> Any:
+        # The word is decoded by the first decode_next(), as most words are not continued
+        return tuple(current_word_tokens), None
+
+    def decode_next(self, state: Any, new_token: int) -> Tuple[str, Any]:
+        word_tokens, decoded = state
+        if decoded is None:
+            decoded = self.decoder(list(word_tokens))
+        new_word_tokens = word_tokens + (new_token,)
+        new_decoded = self.decoder(list(new_word_tokens))
+        return new_decoded[len(decoded):], (new_word_tokens, new_decoded)
+
+
+class BytesIncrementalDetokenizer(IncrementalDetokenizer):
+    """Decodes the UTF-8 bytes of each token. The state is the trailing bytes of an incomplete UTF-8 character, which are
+    decoded together with the following token, so each token costs time proportional to its own length. Invalid bytes are
+    decoded as '�', like tokenizers do."""
+    def __init__(self, token_bytes: Sequence[Optional[bytes]]):
+        """
+        :param token_bytes: The bytes of each token id, as it appears after another token. Tokens that start a word 
+        include their prefix space (for example, b' the'). Tokens without bytes (for example, special tokens) are None.
+        """
+        self.token_bytes = token_bytes
+
+    def start(self, current_word_tokens: List[int]) -> Any:
+        state = b''
+        for token in current_word_tokens:
+            _, state = self.decode_next(state, token)
+        return state
+
+    def decode_next(self, state: Any, new_token: int) -> Tuple[str, Any]:
+        new_bytes = self.token_bytes[new_token] if new_token < len(self.token_bytes) else None
+        if not new_bytes:
+            return '', state
+        word_bytes = state + new_bytes
+        decoded, num_consumed_bytes = codecs.utf_8_decode(word_bytes, 'replace', False)
+        return decoded, word_bytes[num_consumed_bytes:]
@@ -0,0 +1,184 @@
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import dataclass, field, fields
+import itertools
+import sys
+import threading
+from typing import Optional, Tuple
+
+from .characterlevelparser import CharacterLevelParser
+from .caching import LRUCache
+from .tokenenforcer import TokenEnforcer, TokenEnforcerStats, TokenEnforcerTokenizerData
+from .tokenlist import TokenList
+
+
+@dataclass
+class EnforcerManagerStats:
+    """Aggregate counters of all of the requests of an EnforcerManager, see EnforcerManager.get_stats()."""
+    num_open_requests: int = 0
+    """How many requests are currently open"""
+    num_opened_requests: int = 0
+    """How many requests were opened since the manager was created"""
+    memory_bytes: int = 0
+    """The estimated memory held by the caches of the open requests"""
+    num_evicted_caches: int = 0
+    """How many times the caches and state of a request were dropped in order to stay within max_memory_bytes"""
+    enforcer_stats: TokenEnforcerStats = field(default_factory=TokenEnforcerStats)
+    """The sum of the TokenEnforcer statistics of all of the requests, including closed ones"""
+
+
+class EnforcerManager:
+    """EnforcerManager serves many concurrent constrained requests that use the same tokenizer. It owns the
+    TokenEnforcerTokenizerData, creates a TokenEnforcer per request, and tracks the memory that each request holds by itself
+    (its caches and the allowed tokens of its current state, but not the lists of the tokenizer data's shared cache).
+    When the total exceeds max_memory_bytes, the caches and computed states of the least recently used requests are dropped. 
+    This only costs recomputation, the requests themselves remain valid.
+    Requests are identified by the id returned by open(). All methods are thread safe, but each request should only
+    be advanced by one thread at a time. Background computations (prefetch, time_budget) of all of the requests run on one
+    executor, call shutdown() when the manager is no longer needed."""
+    class _Request:
+        __slots__ = ('token_enforcer', 'state', 'memory_bytes', 'cache_sizes', 'caches_bytes')
+
+        def __init__(self, token_enforcer: TokenEnforcer):
+            self.token_enforcer = token_enforcer
+            self.state = token_enforcer.get_initial_state()
+            self.memory_bytes = 0
+            # The sizes of the request's caches when they were last measured, and the measured bytes
+            self.cache_sizes: Tuple[int, ...] = (0, 0, 0)
+            self.caches_bytes = 0
+
+    def __init__(self,
+                 tokenizer_data: TokenEnforcerTokenizerData,
+                 max_memory_bytes: Optional[int] = None,
+                 max_workers: Optional[int] = None,
+                 **token_enforcer_kwargs):
+        """
+        Create a new EnforcerManager.
+        :param tokenizer_data: The tokenizer data that is shared by all of the requests.
+        :param max_memory_bytes: Optional. The global budget for the caches of all of the open requests.
+        :param max_workers: Optional. The number of threads that run the background computations of all of the requests.
+        Defaults to the default of ThreadPoolExecutor. Ignored if an executor is passed in token_enforcer_kwargs.
+        :param token_enforcer_kwargs: Additional arguments for the TokenEnforcer of each request, for example prefetch or time_budget.
+        """
+        self.tokenizer_data = tokenizer_data
+        self.max_memory_bytes = max_memory_bytes
+        self.token_enforcer_kwargs = dict(token_enforcer_kwargs)
+        # Otherwise, every TokenEnforcer would create its own thread
+        self._owned_executor: Optional[Executor] = None
+        if self.token_enforcer_kwargs.get('executor') is None:
+            self._owned_executor = ThreadPoolExecutor(max_workers, thread_name_prefix='lmformatenforcer')
+            self.token_enforcer_kwargs['executor'] = self._owned_executor
+        self._requests: LRUCache[int, EnforcerManager._Request] = LRUCache()
+        self._request_ids = itertools.count()
+        self._memory_bytes = 0
+        self._num_opened_requests = 0
+        self._num_evicted_caches = 0
+        self._closed_requests_stats = TokenEnforcerStats()
+        self._lock = threading.Lock()
+
+    def open(self, parser: CharacterLevelParser) -> int:
+        """Start a new request that is constrained by parser, and return its id."""
+        request = EnforcerManager._Request(TokenEnforcer(self.tokenizer_data, parser, **self.token_enforcer_kwargs))
+        with self._lock:
+            request_id = next(self._request_ids)
+            self._requests[request_id] = request
+            self._num_opened_requests += 1
+        return request_id
+
+    def get_allowed_tokens(self, request_id: int) -> TokenList:
+        """Get the tokens that are allowed next in the request."""
+        request = self._requests[request_id]
+        allowed_tokens = request.token_enforcer.get_allowed_tokens(request.state)
+        self._update_memory_usage(request_id, request)
+        return allowed_tokens
+
+    def advance(self, request_id: int, token: int):
+        """Report the token that was generated next in the request."""
+        request = self._requests[request_id]
+        request.state = request.token_enforcer.advance(request.state, token)
+        self._update_memory_usage(request_id, request)
+
+    def close(self, request_id: int):
+        """Finish the request and release its memory. Closing an unknown (or already closed) request does nothing."""
+        request = self._requests.pop(request_id)
+        if request is None:
+            return
+        request.token_enforcer._cancel_background_computations(request.state)
+        with self._lock:
+            self._memory_bytes -= request.memory_bytes
+            _add_stats(self._closed_requests_stats, request.token_enforcer.stats)
+
+    def shutdown(self):
+        """Stop the executor of the background computations, if the manager created it. Requests can not be used afterwards."""
+        if self._owned_executor is not None:
+            self._owned_executor.shutdown(wait=True)
+
+    def get_stats(self) -> EnforcerManagerStats:
+        """Get the aggregate statistics of all of the requests."""
+        with self._lock:
+            enforcer_stats = TokenEnforcerStats()
+            _add_stats(enforcer_stats, self._closed_requests_stats)
+            for _, request in self._requests.items():
+                _add_stats(enforcer_stats, request.token_enforcer.stats)
+            return EnforcerManagerStats(num_open_requests=len(self._requests),
+                                        num_opened_requests=self._num_opened_requests,
+                                        memory_bytes=self._memory_bytes,
+                                        num_evicted_caches=self._num_evicted_caches,
+                                        enforcer_stats=enforcer_stats)
+
+    def _update_memory_usage(self, request_id: int, request: 'EnforcerManager._Request'):
+        token_enforcer = request.token_enforcer
+        traversal_memo = token_enforcer.traversal_memo
+        cache_sizes = (len(token_enforcer.allowed_token_cache), len(token_enforcer.prefix_states), 
+                       len(traversal_memo) if traversal_memo is not None else 0)
+        if cache_sizes != request.cache_sizes:
+            # Measuring the caches takes time proportional to their size, so it is only done when they changed
+            memory_usage = token_enforcer.memory_usage()
+            request.caches_bytes = memory_usage['allowed_token_cache_bytes'] + memory_usage['prefix_states_bytes'] + \
+                memory_usage['speculative_states_bytes'] + memory_usage['traversal_memo_bytes']
+            request.cache_sizes = cache_sizes
+        memory_bytes = request.caches_bytes + _get_state_bytes(request.state)
+        with self._lock:
+            if request_id not in self._requests:
+                return  # Closed concurrently
+            self._memory_bytes += memory_bytes - request.memory_bytes
+            request.memory_bytes = memory_bytes
+            if self.max_memory_bytes is None:
+                return
+            # Requests are ordered from the least recently used one
+            for _, lru_request in self._requests.items():
+                if self._memory_bytes <= self.max_memory_bytes:
+                    break
+                if lru_request.memory_bytes == 0:
+                    continue
+                self._evict(lru_request)
+
+    def _evict(self, request: 'EnforcerManager._Request'):
+        # Must be called while holding the lock
+        token_enforcer = request.token_enforcer
+        token_enforcer._cancel_background_computations(request.state)
+        token_enforcer.allowed_token_cache.clear()
+        token_enforcer.prefix_states.clear()
+        if token_enforcer.traversal_memo is not None:
+            token_enforcer.traversal_memo.clear()
+        # The current state is replaced by an equivalent one without its allowed tokens and the states advanced to from it
+        state = request.state
+        evicted_state = TokenEnforcer.OutputTensorState(state.parser, state.detokenizer_state)
+        request.state = evicted_state
+        self._memory_bytes -= request.memory_bytes
+        request.memory_bytes = 0
+        request.cache_sizes = (0, 0, 0)
+        request.caches_bytes = 0
+        self._num_evicted_caches += 1
+
+
+def _get_state_bytes(state: TokenEnforcer.OutputTensorState) -> int:
+    state_bytes = sys.getsizeof(state) + sys.getsizeof(state.detokenizer_state)
+    if state.allowed_tokens is not None and state.parser.cache_key() is None:
+        # The allowed tokens of states that have a cache key are held (and counted) by the caches
+        state_bytes += state.allowed_tokens.memory_usage()
+    return state_bytes
+
+
+def _add_stats(total: TokenEnforcerStats, stats: TokenEnforcerStats):
+    for stats_field in fields(TokenEnforcerStats):
+        setattr(total, stats_field.name, getattr(total, stats_field.name) + getattr(stats, stats_field.name))
@@ -3,22 +3,20 @@ try:
 except ImportError:
     raise ImportError('llama-cpp-python is not installed. Please install it with "pip install llama-cpp-python"')
 from lmformatenforcer import CharacterLevelParser, TokenEnforcer, FormatEnforcerAnalyzer, TokenEnforcerTokenizerData
+from lmformatenforcer.detokenizer import BytesIncrementalDetokenizer
 import numpy as np
 import numpy.typing as npt
-from typing import Tuple, List, Union
+from typing import Optional, Tuple, List, Union
 
-def _build_regular_tokens_list(llm: Llama) -> List[Tuple[int, str, bool]]:
-    token_0 = llm.tokenize(b"0")[-1]
+def _build_regular_tokens_list(token_bytes: List[Optional[bytes]]) -> List[Tuple[int, str, bool]]:
     regular_tokens = []
-    special_tokens = [llm.token_bos(), llm.token_eos()]
-    for token_idx in range(llm.n_vocab()):
-        if token_idx in special_tokens:
+    for token_idx, bytes_after_0 in enumerate(token_bytes):
+        if bytes_after_0 is None:
             continue
-        # We prepend token 0 and skip the first letter of the result to get a space if the token is a start word.
         try:
-            decoded_after_0 = llm.detokenize([token_0, token_idx]).decode('utf-8')[1:]
-            decoded_regular = llm.detokenize([token_idx]).decode('utf-8')
-            is_word_start_token = len(decoded_after_0) > len(decoded_regular)
+            # The bytes are decoded after token 0, so word start tokens keep their prefix space
+            decoded_after_0 = bytes_after_0.decode('utf-8')
+            is_word_start_token = decoded_after_0.startswith(' ')
             regular_tokens.append((token_idx, decoded_after_0, is_word_start_token))
         except:
             # This can happen for cases such as raw bytes outside of the ASCII range. We assign this a value of �,
@@ -29,8 +27,22 @@ def _build_regular_tokens_list(llm: Llama) -> List[Tuple[int, str, bool]]:
     return regular_tokens
 
 
-def build_token_enforcer_tokenizer_data(llm: Llama) -> TokenEnforcerTokenizerData:
-    regular_tokens = _build_regular_tokens_list(llm)
+def _build_token_bytes_list(llm: Llama) -> List[Optional[bytes]]:
+    # We prepend token 0 and skip its bytes, to get a space if the token is a start word.
+    token_0 = llm.tokenize(b"0")[-1]
+    num_token_0_bytes = len(llm.detokenize([token_0]))
+    special_tokens = [llm.token_bos(), llm.token_eos()]
+    return [None if token_idx in special_tokens else llm.detokenize([token_0, token_idx])[num_token_0_bytes:] 
+            for token_idx in range(llm.n_vocab())]
+
+
+def build_token_enforcer_tokenizer_data(llm: Llama, byte_level: bool = False) -> TokenEnforcerTokenizerData:
+    """Build the TokenEnforcerTokenizerData of a llama.cpp model.
+    :param byte_level: If True, the TokenEnforcer works with the bytes of the tokens (see TokenEnforcerTokenizerData), 
+    which is exact for raw byte tokens that are only valid in combination, for example in multilingual text."""
+    # The bytes of the tokens are detokenized once, and are used both for the token strings and for decoding
+    token_bytes = _build_token_bytes_list(llm)
+    regular_tokens = _build_regular_tokens_list(token_bytes)
 
     def decoder_fn(sent: List[int]) -> str:
         try:
@@ -39,7 +51,14 @@ def build_token_enforcer_tokenizer_data(llm: Llama) -> TokenEnforcerTokenizerDat
             return decoder_fn(sent[:-1])
     
     use_bitmask = False
-    return TokenEnforcerTokenizerData(regular_tokens, decoder_fn, llm.token_eos(), use_bitmask, llm.n_vocab())
+    if byte_level:
+        # Byte level TokenEnforcers get the characters of each token from its bytes, and don't need to detokenize words
+        return TokenEnforcerTokenizerData(regular_tokens, decoder_fn, llm.token_eos(), use_bitmask, llm.n_vocab(),
+                                          token_bytes=token_bytes)
+    # Decoding the bytes of each token avoids detokenizing the whole current word (and retrying on partial characters) every step
+    incremental_detokenizer = BytesIncrementalDetokenizer(token_bytes)
+    return TokenEnforcerTokenizerData(regular_tokens, decoder_fn, llm.token_eos(), use_bitmask, llm.n_vocab(),
+                                      incremental_detokenizer=incremental_detokenizer)
 
 
 class LlamaCppLogitsProcessor:
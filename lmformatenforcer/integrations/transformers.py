@@ -1,5 +1,6 @@
 import functools
-from typing import Any, Callable, List, Optional, Tuple, Union
+import re
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 try:
     from transformers import AutoModelForCausalLM
     from transformers.generation.logits_process import LogitsProcessor, PrefixConstrainedLogitsProcessor
@@ -53,6 +54,9 @@ class LogitsSaverManager:
         self.model._get_logits_warper = self.old_warper
 
 
+_BYTE_FALLBACK_TOKEN_REGEX = re.compile(r'<0x([0-9A-Fa-f]{2})>')
+
+
 def _build_regular_tokens_list(tokenizer: PreTrainedTokenizerBase, vocab_size: int) -> List[Tuple[int, str, bool]]:
     token_0 = tokenizer.encode("0")[-1]
     regular_tokens = []
@@ -67,6 +71,67 @@ def _build_regular_tokens_list(tokenizer: PreTrainedTokenizerBase, vocab_size: i
     return regular_tokens
 
 
+def _bytes_to_unicode() -> Dict[int, str]:
+    # The printable character that byte level BPE tokenizers (GPT-2 style) use for each byte in their vocabulary
+    printable_bytes = list(range(ord('!'), ord('~') + 1)) + list(range(ord('¡'), ord('¬') + 1)) + list(range(ord('®'), ord('ÿ') + 1))
+    characters = {byte: chr(byte) for byte in printable_bytes}
+    num_unprintable_bytes = 0
+    for byte in range(256):
+        if byte not in characters:
+            characters[byte] = chr(256 + num_unprintable_bytes)
+            num_unprintable_bytes += 1
+    return characters
+
+
+def _get_continuing_subword_prefix(tokenizer: PreTrainedTokenizerBase) -> Optional[str]:
+    # WordPiece tokenizers (BERT style) mark the tokens that continue a word with a prefix, usually '##'
+    backend_tokenizer = getattr(tokenizer, 'backend_tokenizer', None)
+    if backend_tokenizer is not None:
+        model = backend_tokenizer.model
+        return model.continuing_subword_prefix if type(model).__name__ == 'WordPiece' else None
+    return '##' if hasattr(tokenizer, 'wordpiece_tokenizer') else None
+
+
+def _build_token_bytes_list(tokenizer: PreTrainedTokenizerBase, vocab_size: int) -> List[Optional[bytes]]:
+    # How a token string maps to bytes depends on the type of the tokenizer. The vocabulary of byte level BPE tokenizers 
+    # contains a printable character for every byte. Sentencepiece tokenizers use '▁' for spaces, and the ones with byte 
+    # fallback have <0xNN> tokens for raw bytes. WordPiece tokenizers prefix the tokens that continue a word, and the 
+    # other tokens start a word. Added tokens are plain text. The tokens of other tokenizers are decoded after token 0, 
+    # like in _build_regular_tokens_list().
+    byte_decoder = {character: byte for byte, character in _bytes_to_unicode().items()}
+    vocab = tokenizer.get_vocab()
+    is_byte_level = all(character in vocab for character in byte_decoder)
+    continuing_subword_prefix = _get_continuing_subword_prefix(tokenizer)
+    is_sentencepiece = any('\u2581' in token_str or _BYTE_FALLBACK_TOKEN_REGEX.fullmatch(token_str) for token_str in vocab)
+    added_tokens = set(tokenizer.get_added_vocab())
+    token_strs = tokenizer.convert_ids_to_tokens(list(range(vocab_size)))
+    special_ids = set(tokenizer.all_special_ids)
+    is_plain_text = not (is_byte_level or continuing_subword_prefix or is_sentencepiece)
+    token_0 = tokenizer.encode("0")[-1] if is_plain_text else None
+    token_bytes: List[Optional[bytes]] = []
+    for token_idx, token_str in enumerate(token_strs):
+        if token_idx in special_ids or token_str is None:
+            token_bytes.append(None)
+        elif token_str in added_tokens:
+            token_bytes.append(token_str.encode('utf-8'))
+        elif is_byte_level:
+            token_bytes.append(bytes(byte_decoder[character] for character in token_str))
+        elif continuing_subword_prefix:
+            if token_str.startswith(continuing_subword_prefix):
+                token_bytes.append(token_str[len(continuing_subword_prefix):].encode('utf-8'))
+            else:
+                token_bytes.append((' ' + token_str).encode('utf-8'))
+        elif is_plain_text:
+            token_bytes.append(tokenizer.decode([token_0, token_idx])[1:].encode('utf-8'))
+        else:
+            byte_fallback_match = _BYTE_FALLBACK_TOKEN_REGEX.fullmatch(token_str)
+            if byte_fallback_match:
+                token_bytes.append(bytes([int(byte_fallback_match.group(1), 16)]))
+            else:
+                token_bytes.append(token_str.replace('\u2581', ' ').encode('utf-8'))
+    return token_bytes
+
+
 def _decode_function(tokenizer: PreTrainedTokenizerBase, tokens: List[int]) -> str:
     decoded = tokenizer.decode(tokens)
     cleaned = decoded.rstrip('�')
@@ -76,11 +141,16 @@ def _decode_function(tokenizer: PreTrainedTokenizerBase, tokens: List[int]) -> s
 def build_token_enforcer_tokenizer_data(tokenizer: PreTrainedTokenizerBase, 
                                         use_bitmask: bool = False,
                                         vocab_size: Optional[int] = None,
+                                        byte_level: bool = False,
                                         ) -> TokenEnforcerTokenizerData:
+    """Build the TokenEnforcerTokenizerData of a transformers tokenizer.
+    :param byte_level: If True, the TokenEnforcer works with the bytes of the tokens (see TokenEnforcerTokenizerData), 
+    which is exact for byte fallback tokens (<0xNN>) and partial characters, for example in multilingual text."""
     vocab_size = vocab_size or len(tokenizer)
     regular_tokens = _build_regular_tokens_list(tokenizer, vocab_size)
     decode_fn = functools.partial(_decode_function, tokenizer)
-    return TokenEnforcerTokenizerData(regular_tokens, decode_fn, tokenizer.eos_token_id, use_bitmask, vocab_size)
+    token_bytes = _build_token_bytes_list(tokenizer, vocab_size) if byte_level else None
+    return TokenEnforcerTokenizerData(regular_tokens, decode_fn, tokenizer.eos_token_id, use_bitmask, vocab_size, token_bytes=token_bytes)
 
 
 class TransformersPrefixAllowedTokensFn:
@@ -19,19 +19,16 @@ class TRTLLMLogitsProcessor:
                 (self.eos_token_id if isinstance(self.eos_token_id, list) else [self.eos_token_id])]
 
     def __call__(self, step: int, batch_input_ids: List[List[int]], logits: torch.Tensor) -> torch.Tensor:
-        for idx in range(len(batch_input_ids)):
-            if self.analyzer:
+        if self.analyzer:
+            for idx in range(len(batch_input_ids)):
                 self.analyzer.report_raw_logits(batch_input_ids[idx], logits[idx].tolist())
 
-            allowed_tokens = self.token_enforcer.get_allowed_tokens(self._trim(batch_input_ids[idx])).allowed_tokens
-
-            if self.mask is not None:
-                self.mask.fill_(self.mask_val)
-            else:
-                # We create it here because full_like() also copies the device and dtype
-                self.mask = torch.full_like(logits[idx], self.mask_val)
-            self.mask[allowed_tokens] = 0
-            logits[idx] = logits[idx] + self.mask
+        # All of the rows are resolved together, so rows that are in the same parsing state are only computed once,
+        # and the whole batch is masked in a single operation.
+        token_sequences = [self._trim(input_ids) for input_ids in batch_input_ids]
+        allowed_tokens = self.token_enforcer.get_allowed_tokens_batch(token_sequences)
+        self.mask = allowed_tokens.to_mask(logits.shape[-1]).to(logits.device)
+        logits.masked_fill_(~self.mask, self.mask_val)
 
         return logits
 
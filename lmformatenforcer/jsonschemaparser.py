@@ -1,6 +1,11 @@
-from copy import deepcopy
+from copy import copy, deepcopy
+from dataclasses import astuple
 import enum
+import functools
+import hashlib
+import json
 import sys
+import threading
 from typing import Dict, Hashable, List, Optional, Union, cast
 
 
@@ -17,12 +22,51 @@ class JsonSchemaParser(CharacterLevelParser):
     ANY_JSON_OBJECT_SCHEMA: JsonSchemaObject = JsonSchemaObject(**_ANY_JSON_SCHEMA_DICT)
     class _Context:
         model_class: JsonSchemaObject
-        # We store the active parser in the context, so that if a node adds to the stack, it knows
-        # to which parser's stack to add.
-        active_parser: "JsonSchemaParser"
         alphabet_without_quotes: str
+        fingerprint: str
         regex_parser_cache: Dict[str, RegexParser] = {}
 
+        def __init__(self):
+            # We store the active parser in the context, so that if a node adds to the stack, it knows
+            # to which parser's stack to add. It is stored per thread, as parsers that share a context
+            # can be advanced concurrently by different threads.
+            self._thread_local = threading.local()
+            # The schemas of the $refs that were resolved so far, so that every use of a ref gets the same object
+            self.ref_schemas: Dict[str, JsonSchemaObject] = {}
+
+        @property
+        def active_parser(self) -> "JsonSchemaParser":
+            return self._thread_local.active_parser
+
+        @active_parser.setter
+        def active_parser(self, parser: "JsonSchemaParser"):
+            self._thread_local.active_parser = parser
+
+        def get_ref_schema(self, ref: str) -> JsonSchemaObject:
+            ref_schema = self.ref_schemas.get(ref)
+            if ref_schema is not None:
+                return ref_schema
+            value_class_name = ref.split('/')[-1]
+            extras = self.model_class.extras
+            # Pydantic V1 and V2 have different names for the definitions field
+            if 'definitions' in extras:
+                definitions = extras['definitions']
+            elif '$defs' in extras:
+                definitions = extras['$defs']
+            else:
+                raise ValueError("No definitions found in schema")
+            class_dict = definitions[value_class_name]
+            return self.ref_schemas.setdefault(ref, JsonSchemaObject(**class_dict))
+
+        def __getstate__(self):
+            state = self.__dict__.copy()
+            del state['_thread_local']
+            return state
+
+        def __setstate__(self, state):
+            self.__dict__.update(state)
+            self._thread_local = threading.local()
+
     object_stack: List[CharacterLevelParser]
     context: _Context
     num_consecutive_whitespaces: int
@@ -43,6 +87,9 @@ class JsonSchemaParser(CharacterLevelParser):
             self.context = JsonSchemaParser._Context()
             json_schema = json_schema or _ANY_JSON_SCHEMA_DICT
             self.context.model_class = JsonSchemaObject(**json_schema)
+            # A stable identifier of the schema, so that states and caches can refer to it without copying it
+            schema_json = json.dumps(json_schema, sort_keys=True, default=str)
+            self.context.fingerprint = hashlib.sha256(schema_json.encode('utf-8')).hexdigest()
             self.context.active_parser = self
             self.context.alphabet_without_quotes = self.config.alphabet.replace('"', '')
         
@@ -112,6 +159,37 @@ class JsonSchemaParser(CharacterLevelParser):
 
         return updated_parser
 
+    def add_string(self, new_string: str) -> CharacterLevelParser:
+        parser: CharacterLevelParser = self
+        idx = 0
+        while idx < len(new_string):
+            if isinstance(parser, JsonSchemaParser) and parser.object_stack and isinstance(parser.object_stack[-1], StringParsingState):
+                # Performance optimization: Freetext runs (up to the next quote / backslash) are added to the string in one step
+                run_length = parser.object_stack[-1].get_freetext_run_length(new_string, idx)
+                if run_length > 0:
+                    parser = parser._add_freetext_run(new_string[idx:idx + run_length])
+                    idx += run_length
+                    continue
+            parser = parser.add_character(new_string[idx])
+            idx += 1
+        return parser
+
+    def _add_freetext_run(self, freetext_run: str) -> 'JsonSchemaParser':
+        # Equivalent to adding the characters one by one, as they are all received by the string at the top of the stack
+        updated_stack = self.object_stack[:]
+        updated_stack[-1] = updated_stack[-1].add_string(freetext_run)
+        updated_parser = JsonSchemaParser(self.context, self.config, updated_stack, self.num_consecutive_whitespaces)
+        updated_parser.context.active_parser = updated_parser
+        updated_parser.last_parsed_string = self.last_parsed_string
+        non_whitespace_prefix = freetext_run.rstrip(WHITESPACE_CHARACTERS)
+        if non_whitespace_prefix:
+            updated_parser.num_consecutive_whitespaces = len(freetext_run) - len(non_whitespace_prefix)
+            updated_parser.last_non_whitespace_character = non_whitespace_prefix[-1]
+        else:
+            updated_parser.num_consecutive_whitespaces += len(freetext_run)
+            updated_parser.last_non_whitespace_character = self.last_non_whitespace_character
+        return updated_parser
+
     def get_allowed_characters(self) -> str:
         self.context.active_parser = self
         
@@ -137,6 +215,9 @@ class JsonSchemaParser(CharacterLevelParser):
     def can_end(self) -> bool:
         return all(parser.can_end() for parser in self.object_stack)
 
+    def fingerprint(self) -> Optional[Hashable]:
+        return ('json_schema', self.context.fingerprint, astuple(self.config))
+
     def shortcut_key(self) -> Optional[Hashable]:
         if self.object_stack:
             current_parser = self.object_stack[-1]
@@ -153,23 +234,52 @@ class JsonSchemaParser(CharacterLevelParser):
                         return ('json_freetext', cur_len, min_len, max_len)
         return None
 
+    def get_any_string_characters(self) -> Optional[str]:
+        if self.object_stack:
+            current_parser = self.object_stack[-1]
+            if isinstance(current_parser, StringParsingState) and not current_parser.allowed_strings and \
+                    not current_parser.regex_parser and current_parser.max_length is None and \
+                    current_parser.seen_opening_quote and not current_parser.seen_closing_quote:
+                # Any freetext without whitespaces (that are limited by max_consecutive_whitespaces) keeps the string open
+                return _get_any_string_characters(self.config.alphabet, self.context.alphabet_without_quotes)
+        return None
+
 
 class BaseParsingState(CharacterLevelParser):
     def __init__(self, root: JsonSchemaParser):
         self.root = root
 
+    def __getstate__(self):
+        # The root parser is only used for its context and config. Pickling all of it would also pickle
+        # the (potentially long outdated) object stack it had when this parsing state was created.
+        state = self.__dict__.copy()
+        root = state.pop('root')
+        state['_root_context'] = root.context
+        state['_root_config'] = root.config
+        return state
+
+    def __setstate__(self, state):
+        root_context = state.pop('_root_context')
+        root_config = state.pop('_root_config')
+        self.__dict__.update(state)
+        self.root = JsonSchemaParser(root_context, root_config, existing_stack=[])
+
 
 def _merge_object_schemas(base_schema: JsonSchemaObject, option_schema: JsonSchemaObject) -> JsonSchemaObject:
+    # The schemas are not modified, as they are shared by all of the parsers (and processes) of the schema
+    merged_schema = copy(option_schema)
+    merged_schema.properties = dict(option_schema.properties or {})
+    merged_schema.required = list(option_schema.required)
     base_schema_properties = base_schema.properties or {}
     for property_name, property_value in base_schema_properties.items():
         # We assume that if a property exists in both base and option, the option version will be
         # more specific, therefore we only take missing entries
-        if property_name not in option_schema.properties:
-            option_schema.properties[property_name] = property_value
+        if property_name not in merged_schema.properties:
+            merged_schema.properties[property_name] = property_value
     for required_property in base_schema.required:
-        if required_property not in option_schema.required:
-            option_schema.required.append(required_property)
-    return option_schema
+        if required_property not in merged_schema.required:
+            merged_schema.required.append(required_property)
+    return merged_schema
 
 
 def get_parser(
@@ -211,17 +321,7 @@ def get_parser(
     elif value_schema.type == "object":
         return ObjectParsingState(value_schema, parsing_state)
     elif value_schema.type == None and value_schema.ref:
-        value_class_name = value_schema.ref.split('/')[-1]
-        extras = parsing_state.context.model_class.extras
-        # Pydantic V1 and V2 have different names for the definitions field
-        if 'definitions' in extras:
-            definitions = extras['definitions']
-        elif '$defs' in extras:
-            definitions = extras['$defs']
-        else:
-            raise ValueError("No definitions found in schema")
-        class_dict = definitions[value_class_name]
-        value_schema = JsonSchemaObject(**class_dict)
+        value_schema = parsing_state.context.get_ref_schema(value_schema.ref)
         return get_parser(parsing_state, value_schema)
     elif value_schema.enum:
         is_numeric = all(isinstance(i, (int, float)) for i in value_schema.enum)
@@ -585,6 +685,31 @@ class StringParsingState(PrimitiveParsingState):
             self.root.context.active_parser.object_stack.append(json_escaping_parser)
         return self
 
+    def add_string(self, new_string: str) -> CharacterLevelParser:
+        run_length = self.get_freetext_run_length(new_string, 0)
+        if run_length == 0:
+            return super().add_string(new_string)
+        new = self._clone()
+        new.parsed_string += new_string[:run_length]
+        return CharacterLevelParser.add_string(new, new_string[run_length:])
+
+    def get_freetext_run_length(self, new_string: str, start_idx: int) -> int:
+        """The number of characters from new_string[start_idx:] that are plain freetext content of this string: they are 
+        allowed, and adding them only appends them to parsed_string (no quotes, escapes, patterns or allowed strings)."""
+        if self.allowed_strings or self.regex_parser or not self.seen_opening_quote or self.seen_closing_quote:
+            return 0
+        if not self.parsed_string and new_string[start_idx:start_idx + 1] in WHITESPACE_CHARACTERS:
+            # Leading whitespaces are skipped by add_character()
+            return 0
+        end_idx = len(new_string)
+        if self.max_length is not None:
+            end_idx = min(end_idx, start_idx + max(0, self.max_length - len(self.parsed_string)))
+        freetext_characters = _get_freetext_characters(self.root.config.alphabet, self.root.context.alphabet_without_quotes)
+        idx = start_idx
+        while idx < end_idx and new_string[idx] in freetext_characters:
+            idx += 1
+        return idx - start_idx
+
     def get_allowed_characters(self) -> str:
         if not self.seen_opening_quote:
             return '"' + WHITESPACE_CHARACTERS
@@ -627,6 +752,18 @@ class StringParsingState(PrimitiveParsingState):
                 return bool(self.parsed_string)
 
 
+@functools.lru_cache(maxsize=16)
+def _get_freetext_characters(alphabet: str, alphabet_without_quotes: str) -> frozenset:
+    # The characters that a freetext string allows regardless of its length constraints, except for the escaping backslash
+    return frozenset(alphabet).intersection(alphabet_without_quotes).difference('"' + BACKSLASH)
+
+
+@functools.lru_cache(maxsize=16)
+def _get_any_string_characters(alphabet: str, alphabet_without_quotes: str) -> str:
+    freetext_characters = _get_freetext_characters(alphabet, alphabet_without_quotes)
+    return "".join(sorted(freetext_characters.difference(WHITESPACE_CHARACTERS)))
+
+
 class ListParsingState(PrimitiveParsingState):
     list_member_type: JsonSchemaObject
     seen_list_opener: bool = False
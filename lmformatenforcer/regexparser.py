@@ -12,8 +12,10 @@ class RegexParser(CharacterLevelParser):
 
     class _Context:
         pattern: interegular.FSM
+        pattern_str: str
         anything_else_characters: str
         state_character_cache: Dict[int, str]
+        state_self_loop_character_cache: Dict[int, str]
     
     context: _Context
     current_state: int
@@ -23,7 +25,9 @@ class RegexParser(CharacterLevelParser):
         if isinstance(pattern, str):
             self.context = RegexParser._Context()
             self.context.pattern = interegular.parse_pattern(pattern).to_fsm()
+            self.context.pattern_str = pattern
             self.context.state_character_cache = {}
+            self.context.state_self_loop_character_cache = {}
             self._update_alphabet(self.config.alphabet)
         else:
             self.context = pattern
@@ -49,6 +53,23 @@ class RegexParser(CharacterLevelParser):
             # Missing transition = transition to dead state
             return RegexParser(self.context, self.config, RegexParser.INVALID_STATE)
     
+    def add_string(self, new_string: str) -> 'RegexParser':
+        # Walks the FSM directly, only creating the parser of the final state
+        state = self.current_state
+        fsm = self.context.pattern
+        for new_character in new_string:
+            if state == RegexParser.INVALID_STATE:
+                break
+            symbol = new_character
+            if anything_else in fsm.alphabet and not symbol in fsm.alphabet:
+                symbol = anything_else
+            transition = fsm.alphabet[symbol]
+            try:
+                state = fsm.map[state][transition]  # type: ignore
+            except KeyError:
+                state = RegexParser.INVALID_STATE
+        return RegexParser(self.context, self.config, state)
+
     def can_end(self) -> bool:
         return self.current_state in self.context.pattern.finals or self.current_state == RegexParser.INVALID_STATE
     
@@ -67,10 +88,33 @@ class RegexParser(CharacterLevelParser):
                         allowed_characters.append(symbol)
             self.context.state_character_cache[self.current_state] = "".join(allowed_characters)
         return self.context.state_character_cache[self.current_state]
+
+    def get_any_string_characters(self) -> Optional[str]:
+        # The characters that lead back to the current state (for example, in the .* of a pattern) can repeat freely
+        if self.current_state not in self.context.pattern.map:
+            return None
+        if self.current_state not in self.context.state_self_loop_character_cache:
+            self_loop_characters = []
+            state_map = self.context.pattern.map[self.current_state]
+            for symbol_idx, next_state in state_map.items():
+                if next_state != self.current_state:
+                    continue
+                symbols: List[str] = self.context.pattern.alphabet.by_transition[symbol_idx]
+                for symbol in symbols:
+                    if symbol == anything_else:
+                        self_loop_characters.append(self.context.anything_else_characters)
+                    else:
+                        self_loop_characters.append(symbol)
+            self.context.state_self_loop_character_cache[self.current_state] = "".join(self_loop_characters)
+        return self.context.state_self_loop_character_cache[self.current_state]
     
     def cache_key(self) -> Optional[Hashable]:
-        # If we are in the same regex fsm state, the allowed next tokens are the same ones
-        return self.current_state
+        # If we are in the same regex fsm state, the allowed next tokens are the same ones.
+        # The pattern is part of the key, as the state numbers of different patterns are unrelated.
+        return ('regex', self.context.pattern_str, self.current_state)
+
+    def fingerprint(self) -> Optional[Hashable]:
+        return ('regex', self.context.pattern_str, self.context.anything_else_characters)
 
     def _update_alphabet(self, new_alphabet: str):
         if self.context:
@@ -0,0 +1,172 @@
+import enum
+import io
+import pickle
+import sys
+from typing import Any, Dict, Hashable, Optional, Set, Tuple
+
+from pydantic import BaseModel
+
+from .bytelevel import Utf8ByteParser
+from .characterlevelparser import CharacterLevelParser, CharacterLevelParserConfig, SequenceParser, UnionParser
+from .exceptions import LMFormatEnforcerException
+from .jsonschemaparser import JsonSchemaParser
+from .regexparser import RegexParser
+
+_STATE_FORMAT_VERSION = 2
+
+
+class SharedParserObjects:
+    """The objects that all of the states of a root parser share: parser contexts and JSON schema objects.
+    Serialized states refer to them by a stable identifier instead of copying them, so that a state can be
+    restored by any TokenEnforcer that was created with the same parser (schema / pattern), also in another process."""
+    def __init__(self, root_parser: CharacterLevelParser):
+        self._objects_by_id: Dict[Hashable, Any] = {}
+        self._ids_by_object_id: Dict[int, Hashable] = {}
+        self._json_schema_contexts: Dict[str, JsonSchemaParser._Context] = {}
+        self._num_added_ref_schemas: Dict[str, int] = {}
+        self._add_parser(root_parser)
+        self._add_schema_object(JsonSchemaParser.ANY_JSON_OBJECT_SCHEMA, ('any_json_schema',), set())
+        for regex_parser in list(JsonSchemaParser._Context.regex_parser_cache.values()):
+            self._add_parser(regex_parser)
+
+    def get_id(self, obj: Any) -> Optional[Hashable]:
+        persistent_id = self._ids_by_object_id.get(id(obj))
+        if persistent_id is not None:
+            return persistent_id
+        if isinstance(obj, RegexParser._Context):
+            # Regex contexts of patterns inside JSON schemas are created on demand, and can be rebuilt from the pattern
+            return _regex_context_id(obj)
+        if isinstance(obj, BaseModel) and self._add_ref_schemas():
+            return self._ids_by_object_id.get(id(obj))
+        return None
+
+    def get_object(self, persistent_id: Hashable) -> Any:
+        if persistent_id in self._objects_by_id:
+            return self._objects_by_id[persistent_id]
+        if persistent_id[0] == 'regex_context':
+            _, pattern_str, anything_else_characters = persistent_id
+            context = RegexParser(pattern_str).context
+            context.anything_else_characters = anything_else_characters
+            self._add(context, persistent_id)
+            return context
+        if persistent_id[0] == 'json_schema_ref' and persistent_id[1] in self._json_schema_contexts:
+            # The ref was not resolved in this process yet
+            self._json_schema_contexts[persistent_id[1]].get_ref_schema(persistent_id[2])
+            self._add_ref_schemas()
+            if persistent_id in self._objects_by_id:
+                return self._objects_by_id[persistent_id]
+        raise LMFormatEnforcerException("The state was dumped by a TokenEnforcer whose parser is different from this one's. "
+                                        "States can only be loaded by TokenEnforcers that were created with the same schema / pattern.")
+
+    def _add(self, obj: Any, persistent_id: Hashable):
+        self._objects_by_id[persistent_id] = obj
+        self._ids_by_object_id[id(obj)] = persistent_id
+
+    def _add_parser(self, parser: CharacterLevelParser):
+        if isinstance(parser, JsonSchemaParser):
+            fingerprint = parser.context.fingerprint
+            self._add(parser.context, ('json_schema_context', fingerprint))
+            self._add_schema_object(parser.context.model_class, ('json_schema', fingerprint), set())
+            self._json_schema_contexts[fingerprint] = parser.context
+            self._num_added_ref_schemas[fingerprint] = 0
+            self._add_ref_schemas()
+        elif isinstance(parser, RegexParser):
+            self._add(parser.context, _regex_context_id(parser.context))
+        elif isinstance(parser, (UnionParser, SequenceParser)):
+            for inner_parser in parser.parsers:
+                self._add_parser(inner_parser)
+        elif isinstance(parser, Utf8ByteParser):
+            self._add_parser(parser.parser)
+
+    def _add_ref_schemas(self) -> bool:
+        # The schemas of $refs are created when the ref is first parsed, and are identified by the ref
+        added = False
+        for fingerprint, context in self._json_schema_contexts.items():
+            if len(context.ref_schemas) == self._num_added_ref_schemas[fingerprint]:
+                continue
+            for ref, ref_schema in list(context.ref_schemas.items()):
+                if id(ref_schema) not in self._ids_by_object_id:
+                    self._add_schema_object(ref_schema, ('json_schema_ref', fingerprint, ref), set())
+                    added = True
+            self._num_added_ref_schemas[fingerprint] = len(context.ref_schemas)
+        return added
+
+    def _add_schema_object(self, value: Any, path: Tuple, visited: Set[int]):
+        # The path of attribute names / keys / indices from the root schema is the same in every process
+        if id(value) in visited:
+            return
+        if isinstance(value, BaseModel):
+            visited.add(id(value))
+            self._add(value, path)
+            for attribute_name, attribute_value in value.__dict__.items():
+                self._add_schema_object(attribute_value, path + (attribute_name,), visited)
+        elif isinstance(value, list):
+            for idx, item in enumerate(value):
+                self._add_schema_object(item, path + (idx,), visited)
+        elif isinstance(value, dict):
+            for key, item in value.items():
+                self._add_schema_object(item, path + (key,), visited)
+
+
+def _regex_context_id(context: RegexParser._Context) -> Hashable:
+    return ('regex_context', context.pattern_str, context.anything_else_characters)
+
+
+class _StatePickler(pickle.Pickler):
+    def __init__(self, file: io.BytesIO, shared_objects: SharedParserObjects):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.shared_objects = shared_objects
+
+    def persistent_id(self, obj: Any) -> Optional[Hashable]:
+        return self.shared_objects.get_id(obj)
+
+
+class _StateUnpickler(pickle.Unpickler):
+    # States only contain parser objects, so that loading a state can not create (or call) anything else
+    def __init__(self, file: io.BytesIO, shared_objects: SharedParserObjects):
+        super().__init__(file)
+        self.shared_objects = shared_objects
+
+    def persistent_load(self, persistent_id: Hashable) -> Any:
+        return self.shared_objects.get_object(persistent_id)
+
+    def find_class(self, module: str, name: str) -> Any:
+        if module.startswith('lmformatenforcer.') and '.' not in name:
+            obj = getattr(sys.modules.get(module), name, None)
+            # Schema objects that are not shared (for example, merged allOf schemas) are stored by value
+            if isinstance(obj, type) and issubclass(obj, (CharacterLevelParser, CharacterLevelParserConfig, enum.Enum, BaseModel)):
+                return obj
+        if (module, name) in _ALLOWED_BUILTINS:
+            return super().find_class(module, name)
+        raise LMFormatEnforcerException(f"Refusing to load '{module}.{name}', states can only contain parser objects")
+
+
+_ALLOWED_BUILTINS = {('builtins', 'set'), ('builtins', 'frozenset'), ('collections', 'OrderedDict')}
+
+
+def dump_parser_state(shared_objects: SharedParserObjects,
+                      tokenizer_fingerprint: str,
+                      parser: CharacterLevelParser,
+                      detokenizer_state: Any) -> bytes:
+    buffer = io.BytesIO()
+    _StatePickler(buffer, shared_objects).dump((_STATE_FORMAT_VERSION, tokenizer_fingerprint, parser, detokenizer_state))
+    return buffer.getvalue()
+
+
+def get_parser_state_key(shared_objects: SharedParserObjects, parser: CharacterLevelParser) -> bytes:
+    """A key that is equal for parsers that are in the same state, even if they are different objects. Parsers with equal keys
+    accept the same continuations. Equal states may still have different keys (for example, if they share objects differently)."""
+    buffer = io.BytesIO()
+    _StatePickler(buffer, shared_objects).dump(parser)
+    return buffer.getvalue()
+
+
+def load_parser_state(shared_objects: SharedParserObjects,
+                      tokenizer_fingerprint: str,
+                      data: bytes) -> Tuple[CharacterLevelParser, Any]:
+    version, dumped_tokenizer_fingerprint, parser, detokenizer_state = _StateUnpickler(io.BytesIO(data), shared_objects).load()
+    if version != _STATE_FORMAT_VERSION:
+        raise LMFormatEnforcerException(f"Unsupported state format version {version}")
+    if dumped_tokenizer_fingerprint != tokenizer_fingerprint:
+        raise LMFormatEnforcerException("The state was dumped by a TokenEnforcer that uses a different tokenizer")
+    return parser, detokenizer_state
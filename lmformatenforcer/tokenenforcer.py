@@ -1,12 +1,23 @@
-from dataclasses import dataclass, field
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+import hashlib
+import pickle
 import sys
-from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple, Union
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Sequence, Tuple, Union
 import logging
 
 from .exceptions import LMFormatEnforcerException
 from .characterlevelparser import CharacterLevelParser, ForceStopParser, CharacterLevelParserConfig
-from .tokenizerprefixtree import TokenizerPrefixTree, TokenizerPrefixTreeNode
-from .tokenlist import TokenList
+from .tokenizerprefixtree import CompactTokenizerPrefixTree, RadixTokenizerPrefixTree, TokenizerPrefixTree
+from .tokenlist import TokenList, TokenListBatch
+from .consts import WHITESPACE_CHARACTERS
+from .caching import AllowedTokenCacheBackend, LRUCache, ParserTransitionTable
+from .detokenizer import DecoderIncrementalDetokenizer, IncrementalDetokenizer
+from .bytelevel import Utf8ByteParser, byte_string_to_text, bytes_to_byte_string, get_byte_level_alphabet
+from .statepersistence import SharedParserObjects, dump_parser_state, get_parser_state_key, load_parser_state
 
 
 class TokenEnforcerTokenizerData:
@@ -17,106 +28,915 @@ class TokenEnforcerTokenizerData:
                  decoder: Callable[[List[int]], str],
                  eos_token_id: Union[int, List[int]],
                  use_bitmask: bool,
-                 vocab_size: int):
+                 vocab_size: int,
+                 shared_allowed_token_cache_size: Optional[int] = 1024,
+                 shared_allowed_token_cache_backend: Optional[AllowedTokenCacheBackend] = None,
+                 parser_transition_table_size: Optional[int] = 100000,
+                 incremental_detokenizer: Optional[IncrementalDetokenizer] = None,
+                 token_bytes: Optional[Sequence[Optional[bytes]]] = None,
+                 compact_prefix_tree: bool = False,
+                 path_compressed_prefix_tree: bool = False):
         """
         Create the tokenizer data that the TokenEnforcer needs. This can be reused for multiple TokenEnforcers if they work with the same tokenizer.
         :param regular_tokens: A list of tuples (token_id, token_string, is_new_word_token) for all the regular (not special) tokens in the tokenizer vocabulary.
         Note that token_string is expected to include leading / trailing whitespaces if relevant.
         :param decoder: A function that decodes a list of token ids into a string.
         :param eos_token_id: The token id(s) of the end-of-string token(s).
+        :param shared_allowed_token_cache_size: The maximal number of allowed token lists that are shared between all of the TokenEnforcers
+        that use this tokenizer data, so that new TokenEnforcers of a popular parser (pattern / schema) start with warm caches. 
+        The least recently used lists are evicted. None means unbounded, 0 disables the sharing.
+        :param shared_allowed_token_cache_backend: Optional. A different store for the shared allowed token lists, instead of the
+        in-memory one. For example, MemoryMappedFileCache or KeyValueFileCache keep them on disk, for warm starts across restarts.
+        :param parser_transition_table_size: The maximal number of parser state transitions that are remembered and shared between all
+        of the TokenEnforcers that use this tokenizer data (see ParserTransitionTable). None means unbounded, 0 disables the table.
+        :param incremental_detokenizer: Optional. Decodes the tokens of the current word one at a time. Defaults to one that uses 
+        decoder, integrations that know the bytes of each token can pass a BytesIncrementalDetokenizer, whose cost does not 
+        grow with the length of the word.
+        :param token_bytes: Optional. The UTF-8 bytes of each token id as they appear in the middle of a text (including the leading 
+        space of word start tokens), None for special tokens. If given, the TokenEnforcer works in byte level mode: the prefix tree 
+        is keyed by bytes, and parsers receive the bytes through Utf8ByteParser. This is exact for byte fallback tokens 
+        (for example <0xE4>), that are only valid in combination, and applying a token does not need the decoder.
+        :param compact_prefix_tree: If True, the tokenizer prefix tree is stored in contiguous arrays (CompactTokenizerPrefixTree)
+        instead of an object per node. This takes much less memory and construction time for large vocabularies.
+        :param path_compressed_prefix_tree: If True, the tokenizer prefix tree is a compact tree whose single child chains are
+        merged into edges labelled with strings (RadixTokenizerPrefixTree), so that the traversal visits far fewer nodes.
         """
         filtered_regular_tokens = [token_tuple for token_tuple in regular_tokens if token_tuple[0] <= vocab_size]
         self.regular_tokens = filtered_regular_tokens
-        self.tokenizer_tree = TokenizerPrefixTree(self.regular_tokens, use_bitmask, vocab_size)
+        self.token_bytes = token_bytes
+        self.byte_level = token_bytes is not None
+        if self.byte_level:
+            tree_tokens = [(token_idx, bytes_to_byte_string(token_bytes[token_idx]), is_new_word) 
+                           for token_idx, _, is_new_word in self.regular_tokens 
+                           if token_idx < len(token_bytes) and token_bytes[token_idx]]
+        else:
+            tree_tokens = self.regular_tokens
+        if path_compressed_prefix_tree:
+            tree_class = RadixTokenizerPrefixTree
+        elif compact_prefix_tree:
+            tree_class = CompactTokenizerPrefixTree
+        else:
+            tree_class = TokenizerPrefixTree
+        self.tokenizer_tree: TokenizerPrefixTree = tree_class(tree_tokens, use_bitmask, vocab_size, self.byte_level)
         self.decoder = decoder
+        self.incremental_detokenizer = incremental_detokenizer or DecoderIncrementalDetokenizer(decoder)
         self.eos_token_id = eos_token_id
-        self.tokenizer_alphabet = "".join(token_str for token_str in self.tokenizer_tree.root.children.keys() if len(token_str) == 1)
+        if self.byte_level:
+            self.tokenizer_alphabet = get_byte_level_alphabet(self.regular_tokens, self.tokenizer_tree.tokens_to_strs.values())
+        else:
+            root_characters = self.tokenizer_tree.get_child_characters(self.tokenizer_tree.root)
+            self.tokenizer_alphabet = "".join(token_str for token_str in root_characters if len(token_str) == 1)
         self.vocab_size = vocab_size
         self.use_bitmask = use_bitmask
+        self._fingerprint: Optional[str] = None
+        # Keyed by (root parser fingerprint, parser cache key)
+        self.shared_allowed_token_cache: Optional[AllowedTokenCacheBackend] = None
+        if shared_allowed_token_cache_backend is not None:
+            self.shared_allowed_token_cache = shared_allowed_token_cache_backend
+            shared_allowed_token_cache_backend.attach(self)
+        elif shared_allowed_token_cache_size != 0:
+            self.shared_allowed_token_cache = LRUCache(shared_allowed_token_cache_size)
+        # Keyed by root parser fingerprint as well, only parsers that have a cache key use it
+        self.parser_transition_table: Optional[ParserTransitionTable] = \
+            ParserTransitionTable(parser_transition_table_size) if parser_transition_table_size != 0 else None
+
+    @property
+    def fingerprint(self) -> str:
+        """A stable identifier of the tokenizer vocabulary. It is the same in every process that uses the same tokenizer."""
+        if getattr(self, '_fingerprint', None) is None:
+            vocabulary = (self.regular_tokens, self.eos_token_id, self.vocab_size)
+            if getattr(self, 'byte_level', False):
+                vocabulary += (list(self.token_bytes),)
+            vocabulary_repr = repr(vocabulary)
+            self._fingerprint = hashlib.sha256(vocabulary_repr.encode('utf-8')).hexdigest()
+        return self._fingerprint
+
+
+@dataclass
+class TokenEnforcerStats:
+    """Counters that describe the work done by a TokenEnforcer, see TokenEnforcer.stats."""
+    num_prefetched_states: int = 0
+    """How many states had their allowed tokens computed in the background by prefetch()"""
+    prefetch_compute_seconds: float = 0.0
+    """Total time spent computing the allowed tokens of prefetched states in the background"""
+    prefetch_wait_seconds: float = 0.0
+    """Total time that get_allowed_tokens() waited for prefetched computations to finish"""
+    num_speculative_states: int = 0
+    """How many candidate states were precomputed by precompute_candidates()"""
+    num_speculative_hits: int = 0
+    """How many of the precomputed candidate states were later actually requested"""
+    num_budget_overruns: int = 0
+    """How many times the time budget was exceeded, and a fallback list of allowed tokens was returned"""
+    num_traversal_memo_hits: int = 0
+    """How many tokenizer tree subtrees were taken from the traversal memo instead of being explored again"""
+    num_whole_subtrees: int = 0
+    """How many tokenizer tree subtrees were allowed as a whole without being explored, as the parser accepts any string 
+    over their characters (see CharacterLevelParser.get_any_string_characters())"""
+    num_replayed_tokens: int = 0
+    """How many tokens were applied again to rebuild the states of sequences whose previous step was evicted from 
+    prefix_states (see max_prefix_states)"""
+
+    @property
+    def prefetch_hidden_seconds(self) -> float:
+        """How much of the prefetched computation overlapped with the caller's own work (for example, the model's forward pass)"""
+        return max(0.0, self.prefetch_compute_seconds - self.prefetch_wait_seconds)
+
+    @property
+    def speculative_hit_rate(self) -> float:
+        """The fraction of precomputed candidate states that were later requested. Useful for tuning the number of candidates."""
+        return self.num_speculative_hits / self.num_speculative_states if self.num_speculative_states else 0.0
+
+
+@dataclass
+class TokenEnforcerWarmUpReport:
+    """The result of TokenEnforcer.warm_up()."""
+    num_states_visited: int = 0
+    """How many parser states were explored"""
+    num_states_computed: int = 0
+    """How many of them had their allowed tokens computed, because they are cacheable"""
+    seconds: float = 0.0
+    """The time that the warm up took"""
+
+
+class _TimeBudgetExceeded(Exception):
+    pass
+
+
+# Marks the end of a memoized subtree in the traversal stack of TokenEnforcer._collect_allowed_tokens()
+_SUBTREE_END = object()
+# Smaller subtrees are cheaper to explore than to memoize, or to check whether they are allowed as a whole
+_MIN_MEMOIZED_SUBTREE_SIZE = 8
+_MIN_WHOLE_SUBTREE_SIZE = 8
 
 
 class TokenEnforcer:
     """TokenEnforcer provides a token filtering mechanism, given a CharacterLevelParser and some information about the tokenizer.
-    It is the main entry point for extending lm-format-enforcer to new inference libraries. See __init__() and get_allowed_tokens()"""
-    @dataclass
+    It is the main entry point for extending lm-format-enforcer to new inference libraries. See __init__() and get_allowed_tokens()
+    
+    Thread safety: A TokenEnforcer (and the TokenEnforcerTokenizerData it uses) can be shared between threads, and its methods can be
+    called concurrently. Computed states and allowed token lists are published to the shared caches once they are complete,
+    so concurrent requests for the same state may compute it more than once, but will always get the same result."""
     class OutputTensorState:
-        parser: CharacterLevelParser
-        allowed_tokens: TokenList | None = field(default=None)
-        current_word_tokens: List[int] = field(default_factory=list)
-        
+        """The parsing state after a specific token sequence. It is also the opaque handle of the handle based API."""
+        __slots__ = ('parser', 'allowed_tokens', 'detokenizer_state', 'children', 'parent', 'key', 'pending', 
+                     'speculative', 'fallback_allowed_tokens')
+
+        def __init__(self, parser: CharacterLevelParser, detokenizer_state: Any = None):
+            self.parser = parser
+            self.allowed_tokens: Optional[TokenList] = None
+            # The state of the incremental detokenizer after the tokens of the current word. None if no word was started.
+            self.detokenizer_state: Any = detokenizer_state
+            # The states that were reached from this state, by the token that led to them. Created on demand.
+            self.children: Optional[Dict[int, TokenEnforcer.OutputTensorState]] = None
+            # Only states that are stored in prefix_states know their parent and key, so that they can be released.
+            self.parent: Optional[TokenEnforcer.OutputTensorState] = None
+            self.key: Optional[Tuple] = None
+            # A background computation of allowed_tokens that was started by prefetch()
+            self.pending: Optional[Future] = None
+            # Whether the state was created by precompute_candidates() and was not requested yet
+            self.speculative = False
+            # The partial allowed tokens that were returned when the time budget was exceeded, until the exact ones are computed
+            self.fallback_allowed_tokens: Optional[TokenList] = None
+
+        def __getstate__(self):
+            # A background computation can not be pickled, the allowed tokens are computed again on demand
+            state = {slot: getattr(self, slot) for slot in self.__slots__}
+            state['pending'] = None
+            return state
 
-    def __init__(self, tokenizer_data: TokenEnforcerTokenizerData, parser: CharacterLevelParser):
+        def __setstate__(self, state):
+            for slot, value in state.items():
+                setattr(self, slot, value)
+
+    def __init__(self, 
+                 tokenizer_data: TokenEnforcerTokenizerData, 
+                 parser: CharacterLevelParser,
+                 max_prefix_states: Optional[int] = None,
+                 max_allowed_token_cache_size: Optional[int] = None,
+                 prefetch: bool = False,
+                 executor: Optional[Executor] = None,
+                 time_budget: Optional[float] = None,
+                 max_traversal_memo_size: Optional[int] = 1024):
         """
         Create a new TokenEnforcer.
         :param tokenizer_data: Per tokenizer data that the token enforcer needs in order to operate.
         :param parser: A CharacterLevelParser that defines the allowed strings.
+        :param max_prefix_states: Optional. The maximal number of token sequence states to remember. When exceeded, the least recently used 
+        states are evicted. It should be comfortably larger than the number of sequences that are generated concurrently (batch size * beams).
+        If the state of a sequence's previous step was evicted, it is rebuilt by applying the tokens of the sequence again, from 
+        the longest prefix whose state is still remembered, or from its prompt (see stats.num_replayed_tokens). The handle based 
+        API (get_initial_state() / advance()) does not depend on prefix_states.
+        :param max_allowed_token_cache_size: Optional. The maximal number of allowed token lists to cache by parser cache key. When exceeded,
+        the least recently used lists are evicted.
+        :param prefetch: Optional. If True, advance() immediately starts computing the allowed tokens of the new state in the background,
+        so that the computation overlaps the model's forward pass, and get_allowed_tokens() only waits for the result. 
+        With the token sequence API, call prefetch() as soon as the next token is known.
+        :param executor: Optional. The executor that runs background computations. By default, a single worker thread is created on first use.
+        :param time_budget: Optional. The default time budget (in seconds) of get_allowed_tokens() and get_allowed_tokens_batch(), see get_allowed_tokens().
+        :param max_traversal_memo_size: Optional. The maximal number of tokenizer tree subtrees whose allowed tokens are remembered by 
+        (parser cache key, tree node), so that different states whose parsers converge after the same characters don't explore 
+        the subtree again. 0 disables the memo. See stats.num_traversal_memo_hits.
         """
-        self.prefix_states: Dict[Tuple, TokenEnforcer.OutputTensorState] = {}
+        self.prefix_states: LRUCache[Tuple, TokenEnforcer.OutputTensorState] = LRUCache(max_prefix_states, self._on_prefix_state_evicted)
+        if tokenizer_data.byte_level and not isinstance(parser, Utf8ByteParser):
+            parser = Utf8ByteParser(parser)
         self.root_parser = parser
         self.tokenizer_tree = tokenizer_data.tokenizer_tree
         self.decoder = tokenizer_data.decoder
         self.eos_token_id = tokenizer_data.eos_token_id
         self.regular_tokens = tokenizer_data.regular_tokens
-        self.allowed_token_cache: Dict[Hashable, Any] = {}
+        self.tokenizer_data = tokenizer_data
+        self.allowed_token_cache: LRUCache[Hashable, TokenList] = LRUCache(max_allowed_token_cache_size)
+        self.traversal_memo: Optional[LRUCache[Tuple[Hashable, Any], List[int]]] = \
+            LRUCache(max_traversal_memo_size) if max_traversal_memo_size != 0 else None
         self.use_bitmask = tokenizer_data.use_bitmask
         self.vocab_size = tokenizer_data.vocab_size
-        
+        self.prefetch_enabled = prefetch
+        self.stats = TokenEnforcerStats()
+        self._executor = executor
+        self.time_budget = time_budget
+        # Guards the links between states (children / parent), which are updated together with prefix_states
+        self._state_lock = threading.RLock()
+        self._shared_parser_objects: Optional[SharedParserObjects] = None
+        # Used to rebuild the states of sequences whose previous step was evicted from prefix_states. The prompts are 
+        # remembered (by length) for as many sequences as prefix_states holds.
+        self._num_evicted_prefix_states = 0
+        self._prompts: LRUCache[Tuple, None] = LRUCache(max_prefix_states, self._on_prompt_evicted)
+        self._prompt_length_counts: Dict[int, int] = {}
         
         config = CharacterLevelParserConfig(alphabet=tokenizer_data.tokenizer_alphabet)
         parser.config = config
+        # Allowed token lists and parser transitions are shared with other TokenEnforcers whose root parser has the same fingerprint
+        fingerprint = parser.fingerprint()
+        self._shared_cache_namespace = fingerprint if tokenizer_data.shared_allowed_token_cache is not None else None
+        self._transition_table_namespace = fingerprint if tokenizer_data.parser_transition_table is not None else None
+
+    def __getstate__(self):
+        # Locks and executors can not be pickled. An unpickled TokenEnforcer uses the default executor.
+        state = self.__dict__.copy()
+        del state['_state_lock']
+        state['_executor'] = None
+        return state
 
-    def get_allowed_tokens(self, token_sequence: List[int]) -> TokenList:
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._state_lock = threading.RLock()
+
+    def get_allowed_tokens(self, 
+                           token_sequence: Union[List[int], 'TokenEnforcer.OutputTensorState'],
+                           time_budget: Optional[float] = None) -> TokenList:
         """
         Get a list of allowed tokens, given a list of tokens that were already generated.
         :param token_sequence: The tokens that were already generated, and the next token will be generated for.
+        Can also be a state handle returned by get_initial_state() / advance().
+        :param time_budget: Optional. The maximal time (in seconds) to spend, defaults to the TokenEnforcer's time_budget.
+        If the computation takes longer, a fallback is returned: the allowed tokens that were found so far (plus the EOS token
+        if the parser can end), which is a non empty subset of the exact list. The exact list is then computed in the background, 
+        and is returned by the following requests for the same state. Overruns are counted in stats.num_budget_overruns.
         :return: A list of token ids that are allowed to be selected next.
         """
+        state = self._get_state(token_sequence)
+        self._mark_requested(state)
+        return self._get_allowed_tokens_of_state(state, self._get_deadline(time_budget))
+
+    def prefetch(self, token_sequence: Union[List[int], 'TokenEnforcer.OutputTensorState']) -> 'TokenEnforcer.OutputTensorState':
+        """
+        Start computing the allowed tokens of a token sequence (or state handle) in the background, and return its state handle.
+        Call this as soon as the last token of the sequence was sampled, and the following get_allowed_tokens() call for the 
+        sequence will only wait for the remaining part of the computation. See stats.prefetch_hidden_seconds.
+        """
+        state = self._get_state(token_sequence)
+        if self._start_background_computation(state):
+            self.stats.num_prefetched_states += 1
+        return state
+
+    def precompute_candidates(self, 
+                              token_sequence: Union[List[int], 'TokenEnforcer.OutputTensorState'], 
+                              candidate_tokens: Iterable[int],
+                              background: bool = True) -> int:
+        """
+        Speculatively compute the allowed tokens of the states that follow token_sequence (or a state handle), for each of the 
+        candidate tokens that is allowed. Candidates would usually be the top-k tokens of the logits that were just masked,
+        for example scores.topk(k).indices.tolist(), so that the next step is already computed when one of them is sampled.
+        :param background: If True (default), the computation runs on the background executor, otherwise it runs immediately.
+        :return: The number of new candidate states that were created. See stats.speculative_hit_rate for tuning the number of candidates.
+        The candidate states that are still unused when the state is advanced (by advance() or by the token sequence API) are dropped.
+        """
+        state = self._get_state(token_sequence)
+        allowed_tokens = self.get_allowed_tokens(state)
+        num_created = 0
+        for candidate_token in candidate_tokens:
+            children = state.children
+            if (children is not None and candidate_token in children) or not allowed_tokens.is_token_allowed(candidate_token):
+                continue
+            child_state = self._advance(state, candidate_token)
+            child_state.speculative = True
+            num_created += 1
+            if background:
+                self._start_background_computation(child_state)
+            elif child_state.allowed_tokens is None:
+                self._compute_allowed_tokens(None, child_state)
+        self.stats.num_speculative_states += num_created
+        return num_created
+
+    def is_token_allowed(self, token_sequence: Union[List[int], 'TokenEnforcer.OutputTensorState'], token_id: int) -> bool:
+        """
+        Check whether a single token is allowed after token_sequence (or a state handle), without building the full allowed token list.
+        If the allowed tokens of the state were already computed, they are used. Otherwise only the token's characters are 
+        walked through the parser, stopping at the first character that is not allowed.
+        """
+        state = self._get_state(token_sequence)
+        allowed_tokens = self._get_cached_allowed_tokens(state)
+        if allowed_tokens is not None:
+            return allowed_tokens.is_token_allowed(token_id)
+        return self._parser_allows_token(state.parser, token_id)
+
+    def filter_candidate_tokens(self, 
+                                token_sequence: Union[List[int], 'TokenEnforcer.OutputTensorState'], 
+                                candidate_tokens: Iterable[int],
+                                max_tokens: Optional[int] = None) -> List[int]:
+        """
+        Return the allowed tokens out of candidate_tokens, in their original order, without building the full allowed token list.
+        Pass the candidates sorted by their logits (for example scores.argsort(descending=True).tolist()) and max_tokens=1 for 
+        greedy decoding, or max_tokens=k for top-k / top-p sampling. Each candidate only costs walking its own characters through 
+        the parser, so this is much cheaper than get_allowed_tokens() when a huge number of tokens is allowed (for example, 
+        inside JSON strings) and the model mostly complies with the format. If the allowed tokens of the state were already 
+        computed, they are used instead.
+        If no candidate is allowed, the result is empty, and the caller should fall back to get_allowed_tokens().
+        """
+        state = self._get_state(token_sequence)
+        result = []
+        if max_tokens is not None and max_tokens <= 0:
+            return result
+        for candidate_token in candidate_tokens:
+            if self.is_token_allowed(state, candidate_token):
+                result.append(candidate_token)
+                if max_tokens is not None and len(result) >= max_tokens:
+                    break
+        return result
+
+    def get_allowed_tokens_batch(self, 
+                                 token_sequences: List[Union[List[int], 'TokenEnforcer.OutputTensorState']],
+                                 time_budget: Optional[float] = None) -> TokenListBatch:
+        """
+        Get the allowed tokens for a batch of sequences at once. Each entry can be a token sequence or a state handle, 
+        like in get_allowed_tokens(). Rows that are in the same parsing state are only computed once, also when they reached it
+        through different tokens. The result can be converted to a single mask for the whole batch, see TokenListBatch.
+        :param time_budget: Optional. The time budget (in seconds) of the whole batch, see get_allowed_tokens().
+        """
+        states = [self._get_state(token_sequence) for token_sequence in token_sequences]
+        deadline = self._get_deadline(time_budget)
+        computed_states: Dict[Hashable, TokenEnforcer.OutputTensorState] = {}
+        token_lists: List[TokenList] = []
+        # Grouping has a cost (see _get_parser_group_key()), which is only worth it if several rows need to be computed
+        num_uncomputed_states = sum(1 for state in states if state.allowed_tokens is None and state.pending is None)
+        for state in states:
+            self._mark_requested(state)
+            if state.allowed_tokens is None and state.pending is None and num_uncomputed_states > 1:
+                group_key = self._get_parser_group_key(state.parser)
+                computed_state = computed_states.get(group_key)
+                if computed_state is not None and computed_state.allowed_tokens is not None:
+                    state.allowed_tokens = computed_state.allowed_tokens
+                else:
+                    computed_states[group_key] = state
+            token_lists.append(self._get_allowed_tokens_of_state(state, deadline))
+        return TokenListBatch(token_lists, self.use_bitmask, self.vocab_size)
+
+    def _get_parser_group_key(self, parser: CharacterLevelParser) -> Hashable:
+        cache_key = parser.cache_key()
+        if cache_key is not None:
+            return ('cache_key', cache_key)
+        # Parsers without a cache key (for example, JsonSchemaParser) are grouped by a snapshot of their state, as every row
+        # has its own parser object, even when the rows are in the same state
+        try:
+            return ('state', get_parser_state_key(self._get_shared_parser_objects(), parser))
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return ('parser', id(parser))
+
+    def verify_draft(self, 
+                     token_sequence: Union[List[int], 'TokenEnforcer.OutputTensorState'], 
+                     draft_tokens: List[int]) -> Tuple[int, TokenListBatch]:
+        """
+        Verify the tokens proposed by a draft model (speculative decoding) after token_sequence (or a state handle).
+        The draft is walked token by token, and stops at the first token that is not allowed. 
+        :return: A tuple (num_accepted, allowed_tokens). allowed_tokens holds the allowed tokens of the num_accepted + 1 positions 
+        that the target model's verification logits need: one for each accepted token, and one for the token that follows them 
+        (the correction of the first rejected token, or the bonus token if the whole draft was accepted).
+        With the token sequence API, the states of the accepted prefixes are registered like get_allowed_tokens() would.
+        """
+        state = self._get_state(token_sequence)
+        states = [state]
+        for draft_token in draft_tokens:
+            if not self.is_token_allowed(state, draft_token):
+                break
+            if isinstance(token_sequence, TokenEnforcer.OutputTensorState):
+                state = self.advance(state, draft_token)
+            else:
+                state = self._get_state(list(state.key) + [draft_token])
+            states.append(state)
+        return len(states) - 1, self.get_allowed_tokens_batch(states)
+
+    def get_forced_continuation(self, 
+                                token_sequence: Union[List[int], 'TokenEnforcer.OutputTensorState'],
+                                skip_optional_whitespace: bool = False,
+                                max_length: int = 1024) -> Tuple[str, List[int]]:
+        """
+        Get the text that every legal completion of token_sequence (or a state handle) must start with, and a tokenization of it.
+        The engine can append these tokens in a single prefill-style step (jump forward) instead of decoding them one by one.
+        This is useful for schema heavy outputs, for example when force_json_field_order is set, or for constant strings and single enum values.
+        :param skip_optional_whitespace: If True, states that allow exactly one non whitespace character, in addition to optional 
+        whitespace, are also followed (this is typical between JSON tokens). The result is then a legal continuation without the
+        optional whitespace, rather than a continuation that is strictly forced.
+        :param max_length: The maximal number of characters to return.
+        :return: A tuple (text, token_ids). The tokens are chosen by greedy longest match in the tokenizer vocabulary. 
+        If the end of the text cannot be represented by the vocabulary, the text is shortened to what token_ids represent.
+        """
+        state = self._get_state(token_sequence)
+        parser = state.parser
+        forced_text = ''
+        while len(forced_text) < max_length and not parser.can_end():
+            allowed_characters = set(parser.get_allowed_characters())
+            if skip_optional_whitespace and len(allowed_characters) > 1:
+                allowed_characters.difference_update(WHITESPACE_CHARACTERS)
+            if len(allowed_characters) != 1:
+                break
+            character = allowed_characters.pop()
+            try:
+                parser = parser.add_character(character)
+            except Exception:
+                break
+            forced_text += character
+        
+        token_ids: List[int] = []
+        tokenized_length = 0
+        while tokenized_length < len(forced_text):
+            # Greedy longest match, by walking the tokenizer prefix tree along the remaining text
+            tree = self.tokenizer_tree
+            tree_node = tree.root
+            longest_token: Optional[int] = None
+            longest_token_length = 0
+            idx = tokenized_length
+            while idx < len(forced_text):
+                tree_node = tree.get_child(tree_node, forced_text[idx])
+                if tree_node is None:
+                    break
+                edge_suffix = tree.get_edge_suffix(tree_node)
+                idx += 1
+                if edge_suffix:
+                    if not forced_text.startswith(edge_suffix, idx):
+                        break
+                    idx += len(edge_suffix)
+                node_tokens = tree.get_tokens(tree_node)
+                if node_tokens:
+                    longest_token = node_tokens[0]
+                    longest_token_length = idx - tokenized_length
+            if longest_token is None:
+                break
+            token_ids.append(longest_token)
+            tokenized_length += longest_token_length
+        if self.tokenizer_data.byte_level:
+            return byte_string_to_text(forced_text[:tokenized_length]), token_ids
+        return forced_text[:tokenized_length], token_ids
+
+    def get_initial_state(self) -> 'TokenEnforcer.OutputTensorState':
+        """
+        Get a state handle for the start of the generated output. This is the entry point of the handle based API,
+        which is an alternative to passing the full token sequence to get_allowed_tokens() on every step.
+        Each step then only costs the new token, regardless of the length of the prompt.
+        The handle should be treated as opaque. Pass it to get_allowed_tokens() and advance().
+        """
+        return TokenEnforcer.OutputTensorState(parser=self.root_parser)
+
+    def advance(self, state: 'TokenEnforcer.OutputTensorState', new_token: int) -> 'TokenEnforcer.OutputTensorState':
+        """
+        Get the state handle that is reached after generating new_token from state.
+        The same (state, new_token) pair always returns the same handle, so beam forks and batch slots can keep
+        advancing from a shared parent handle.
+        """
+        new_state = self._advance(state, new_token)
+        if state.children is not None and len(state.children) > 1:
+            self._drop_speculative_children(state, new_token)
+        return new_state
+
+    def _advance(self, state: 'TokenEnforcer.OutputTensorState', new_token: int) -> 'TokenEnforcer.OutputTensorState':
+        children = state.children
+        if children is not None and new_token in children:
+            return children[new_token]
+        new_state = self._apply_new_characters(state, new_token)
+        with self._state_lock:
+            if state.children is None:
+                state.children = {}
+            new_state = state.children.setdefault(new_token, new_state)
+        if self.prefetch_enabled and self._start_background_computation(new_state):
+            self.stats.num_prefetched_states += 1
+        return new_state
+
+    def _drop_speculative_children(self, state: 'TokenEnforcer.OutputTensorState', advanced_token: int):
+        # The candidates that were not generated are unlikely to be requested anymore (if they are, they are computed again)
+        with self._state_lock:
+            children = state.children
+            unused_tokens = [token for token, child in children.items() 
+                             if token != advanced_token and child.speculative and child.key is None]
+            for token in unused_tokens:
+                child = children.pop(token)
+                if child.pending is not None:
+                    child.pending.cancel()
+
+    def _cancel_background_computations(self, state: 'TokenEnforcer.OutputTensorState'):
+        # Cancels the computations that did not start yet, of state, the states advanced to from it, and prefix_states
+        with self._state_lock:
+            states = [state] + list(state.children.values() if state.children else []) + list(self.prefix_states.values())
+        for cancelled_state in states:
+            if cancelled_state.pending is not None:
+                cancelled_state.pending.cancel()
+
+    def release(self, token_sequence: Union[List[int], 'TokenEnforcer.OutputTensorState']):
+        """
+        Release the memory held for a finished sequence.
+        For a token sequence, the states of the sequence and of its prefixes are dropped, up to the first prefix that 
+        other sequences continued from. Sequences that are still being generated must not be prefixes of the released sequence.
+        For a state handle of the handle based API, the states that were advanced to from it are dropped. The handle itself 
+        (and the states before it) are freed once they are no longer referenced.
+        """
+        if isinstance(token_sequence, TokenEnforcer.OutputTensorState):
+            state: Optional[TokenEnforcer.OutputTensorState] = token_sequence
+        else:
+            state = self.prefix_states.get(tuple(token_sequence))
+        if state is None:
+            return
+        with self._state_lock:
+            if state.key is None:
+                self._detach_state(state)
+                return
+            while state is not None:
+                parent = state.parent
+                self.prefix_states.pop(state.key)
+                self._detach_state(state)
+                if parent is None:
+                    self._remove_prompt(state.key)
+                if parent is None or parent.children:
+                    break
+                state = parent
+
+    def memory_usage(self) -> Dict[str, int]:
+        """
+        Return an estimate of the memory that is held by this TokenEnforcer's caches, to help size max_prefix_states 
+        and max_allowed_token_cache_size. Allowed token lists that are shared between several entries are counted once.
+        Lists that are also held by the shared cache of the tokenizer data are not counted, as they are not freed with this
+        TokenEnforcer.
+        """
+        counted_token_lists = set()
+        shared_allowed_token_cache = self.tokenizer_data.shared_allowed_token_cache
+        if isinstance(shared_allowed_token_cache, LRUCache):
+            counted_token_lists.update(id(token_list) for token_list in shared_allowed_token_cache.values())
+        def token_list_bytes(token_list: Optional[TokenList]) -> int:
+            if token_list is None or id(token_list) in counted_token_lists:
+                return 0
+            counted_token_lists.add(id(token_list))
+            return token_list.memory_usage()
+        
+        allowed_token_cache_bytes = sum(token_list_bytes(token_list) for token_list in self.allowed_token_cache.values())
+        prefix_states_bytes = 0
+        for key, state in self.prefix_states.items():
+            prefix_states_bytes += sys.getsizeof(key) + sys.getsizeof(state) + sys.getsizeof(state.detokenizer_state)
+            prefix_states_bytes += token_list_bytes(state.allowed_tokens)
+        # Candidate states of precompute_candidates() that were not requested yet are only held by their parent
+        num_speculative_states = 0
+        speculative_states_bytes = 0
+        with self._state_lock:
+            parent_states = [state for state in self.prefix_states.values() if state.children]
+            speculative_states = [child for state in parent_states for child in state.children.values() if child.speculative]
+        for state in speculative_states:
+            num_speculative_states += 1
+            speculative_states_bytes += sys.getsizeof(state) + sys.getsizeof(state.detokenizer_state) + \
+                token_list_bytes(state.allowed_tokens)
+        traversal_memo_bytes = 0
+        if self.traversal_memo is not None:
+            for key, token_ids in self.traversal_memo.items():
+                traversal_memo_bytes += sys.getsizeof(key) + sys.getsizeof(token_ids)
+        return {
+            'num_prefix_states': len(self.prefix_states),
+            'prefix_states_bytes': prefix_states_bytes,
+            'num_speculative_states': num_speculative_states,
+            'speculative_states_bytes': speculative_states_bytes,
+            'num_cached_token_lists': len(self.allowed_token_cache),
+            'allowed_token_cache_bytes': allowed_token_cache_bytes,
+            'num_traversal_memo_entries': len(self.traversal_memo) if self.traversal_memo is not None else 0,
+            'traversal_memo_bytes': traversal_memo_bytes,
+        }
+
+    def warm_up(self, max_depth: int = 16, max_states: int = 1000) -> TokenEnforcerWarmUpReport:
+        """
+        Explore the parser states that are reachable from the root parser (breadth first, by adding characters), and compute
+        the allowed tokens of every state that has a cache key or a new shortcut key. Call this when a parser (schema / pattern) 
+        is registered, so that the first requests don't pay for cold caches. With the shared cache of TokenEnforcerTokenizerData, 
+        it also warms up the other TokenEnforcers of the same parser, and with a persistent backend, future processes as well.
+        Parsers without cache keys (JsonSchemaParser) can only share the allowed tokens of their free text strings, so those are
+        the states that are computed for them, and the exploration skips characters that don't change the structure.
+        :param max_depth: The maximal number of characters after the root to explore.
+        :param max_states: The maximal number of parser states to explore.
+        """
+        start_time = time.perf_counter()
+        report = TokenEnforcerWarmUpReport()
+        seen_group_keys = set()
+        computed_shortcut_keys = set()
+        queue = deque([(self.root_parser, 0)])
+        while queue and report.num_states_visited < max_states:
+            parser, depth = queue.popleft()
+            # Parsers without a cache key (for example, JsonSchemaParser) are deduplicated by a snapshot of their state
+            group_key = self._get_parser_group_key(parser)
+            if group_key in seen_group_keys:
+                continue
+            if group_key[0] != 'parser':
+                seen_group_keys.add(group_key)
+            report.num_states_visited += 1
+            cache_key = parser.cache_key()
+            shortcut_key = parser.shortcut_key()
+            if cache_key is not None or (shortcut_key is not None and shortcut_key not in computed_shortcut_keys):
+                self._compute_allowed_tokens(None, TokenEnforcer.OutputTensorState(parser))
+                report.num_states_computed += 1
+                if shortcut_key is not None:
+                    computed_shortcut_keys.add(shortcut_key)
+            if depth >= max_depth:
+                continue
+            characters = set(parser.get_allowed_characters())
+            if self._get_json_freetext_lengths(shortcut_key) is not None:
+                # Every character of a JSON freetext string leads to a new state, but the rest of the JSON only depends
+                # on the string being closed, so only the closing quote (or one character, until it is allowed) is explored
+                characters = {'"'} if '"' in characters else set(sorted(characters, key=lambda c: (not c.isalnum(), c))[:1])
+            # Characters that lead to states that behave like the parser itself or like one of their siblings on the next 
+            # character (for example, whitespaces or the digits of a JSON number) usually lead to the same structure, so only 
+            # one of them is explored. Parsers with a cache key don't need this, as their states are deduplicated exactly.
+            explored_signatures = {self._get_warm_up_signature(parser)}
+            for character in sorted(characters):
+                try:
+                    next_parser = parser.add_character(character)
+                except Exception:
+                    continue
+                if cache_key is None:
+                    signature = self._get_warm_up_signature(next_parser)
+                    if signature in explored_signatures:
+                        continue
+                    explored_signatures.add(signature)
+                queue.append((next_parser, depth + 1))
+        report.seconds = time.perf_counter() - start_time
+        return report
+
+    @staticmethod
+    def _get_warm_up_signature(parser: CharacterLevelParser) -> Hashable:
+        return ''.join(sorted(set(parser.get_allowed_characters()))), parser.can_end(), parser.shortcut_key()
+
+    def dump_state(self, token_sequence: Union[List[int], 'TokenEnforcer.OutputTensorState']) -> bytes:
+        """
+        Serialize the parsing state after token_sequence (or a state handle), so that a request can be preempted or moved
+        to another worker without replaying all of its tokens. Parser contexts, schemas and the tokenizer data are referred 
+        to by fingerprint instead of being copied, so the result is compact. See load_state().
+        """
+        state = self._get_state(token_sequence)
+        return dump_parser_state(self._get_shared_parser_objects(), self.tokenizer_data.fingerprint, 
+                                 state.parser, state.detokenizer_state)
+
+    def load_state(self, data: bytes, token_sequence: Optional[List[int]] = None) -> 'TokenEnforcer.OutputTensorState':
+        """
+        Restore a state that was serialized by dump_state(), and return its handle. The TokenEnforcer must use the same tokenizer
+        and be created with an equivalent parser (same schema / pattern) as the one that dumped it, otherwise an 
+        LMFormatEnforcerException is raised. 
+        :param token_sequence: Optional. When using the token sequence API, the full token sequence of the state (prompt included),
+        so that following get_allowed_tokens() calls continue from the restored state.
+        Only load data from a trusted source. Classes other than the parsers of this library are rejected, but the 
+        data is still unpickled.
+        """
+        parser, detokenizer_state = load_parser_state(self._get_shared_parser_objects(), self.tokenizer_data.fingerprint, data)
+        state = TokenEnforcer.OutputTensorState(parser, detokenizer_state)
+        if token_sequence is not None:
+            with self._state_lock:
+                state.key = tuple(token_sequence)
+                state = self.prefix_states.setdefault(state.key, state)
+        return state
+
+    def _get_shared_parser_objects(self) -> SharedParserObjects:
+        with self._state_lock:
+            if self._shared_parser_objects is None:
+                self._shared_parser_objects = SharedParserObjects(self.root_parser)
+            return self._shared_parser_objects
+
+    def _get_state(self, token_sequence: Union[List[int], 'TokenEnforcer.OutputTensorState']) -> 'TokenEnforcer.OutputTensorState':
+        if isinstance(token_sequence, TokenEnforcer.OutputTensorState):
+            return token_sequence
         # In order to elegantly support beam search and batching, we don't store per-batch information.
         # Instead, we store a hash of all the states (unique token tensors) we encountered so far.
         # When we encounter a new unique token tensor, we find the token tensor that led to it, and continue from there.
         sent_tuple = tuple(token_sequence)
-        prev_step_tuple = sent_tuple[:-1]
-
-        if sent_tuple in self.prefix_states:
-            # We already calculated for this node, return cached list
-            return self.prefix_states[sent_tuple].allowed_tokens
-        elif prev_step_tuple not in self.prefix_states:
+        state = self.prefix_states.get(sent_tuple)
+        if state is not None:
+            # We already encountered this node
+            return state
+        prev_step_state = self.prefix_states.get(sent_tuple[:-1])
+        if prev_step_state is None and self._num_evicted_prefix_states > 0:
+            prev_step_state = self._replay_evicted_state(sent_tuple[:-1])
+        if prev_step_state is None:
             # We have not encountered the tensor up to the before-last entry. This means that this is the first call - the instruction / prompt tensor.
             # Initialize the root node
+            self._add_prompt(sent_tuple)
             state = TokenEnforcer.OutputTensorState(parser=self.root_parser)
+        else:
+            # Find the state that led to this node. We explicitly don't use the concept of "timestep" because of beam search
+            state = self.advance(prev_step_state, sent_tuple[-1])
+        with self._state_lock:
+            existing_state = self.prefix_states.get(sent_tuple)
+            if existing_state is not None:
+                # Another thread registered this sequence while we were applying the new token
+                return existing_state
+            if prev_step_state is not None:
+                state.parent = prev_step_state
+            state.key = sent_tuple
             self.prefix_states[sent_tuple] = state
-            self._compute_allowed_tokens(sent_tuple, state)
+        return state
+
+    def _replay_evicted_state(self, sent_tuple: Tuple) -> Optional['TokenEnforcer.OutputTensorState']:
+        # If sent_tuple continues a prompt that was seen, its state was evicted. Apply its tokens again, starting from the 
+        # longest prefix whose state is still in prefix_states (at worst, the prompt itself is parsed again).
+        with self._state_lock:
+            prompt_lengths = sorted(self._prompt_length_counts, reverse=True)
+        prompt_length = next((length for length in prompt_lengths 
+                              if length <= len(sent_tuple) and sent_tuple[:length] in self._prompts), None)
+        if prompt_length is None:
+            return None
+        start_length = len(sent_tuple)
+        while start_length > prompt_length and sent_tuple[:start_length] not in self.prefix_states:
+            start_length -= 1
+        self.stats.num_replayed_tokens += len(sent_tuple) - start_length
+        state = None
+        for length in range(start_length, len(sent_tuple) + 1):
+            state = self._get_state(sent_tuple[:length])
+        return state
+
+    def _add_prompt(self, sent_tuple: Tuple):
+        with self._state_lock:
+            if sent_tuple not in self._prompts:
+                self._prompt_length_counts[len(sent_tuple)] = self._prompt_length_counts.get(len(sent_tuple), 0) + 1
+            self._prompts[sent_tuple] = None
+
+    def _remove_prompt(self, sent_tuple: Tuple):
+        with self._state_lock:
+            if sent_tuple in self._prompts:
+                self._prompts.pop(sent_tuple)
+                self._on_prompt_evicted(sent_tuple, None)
+
+    def _on_prompt_evicted(self, sent_tuple: Tuple, _: None):
+        with self._state_lock:
+            prompt_length = len(sent_tuple)
+            self._prompt_length_counts[prompt_length] -= 1
+            if self._prompt_length_counts[prompt_length] == 0:
+                del self._prompt_length_counts[prompt_length]
+
+    def _get_deadline(self, time_budget: Optional[float]) -> Optional[float]:
+        if time_budget is None:
+            time_budget = self.time_budget
+        return time.perf_counter() + time_budget if time_budget is not None else None
+
+    def _get_allowed_tokens_of_state(self, state: 'TokenEnforcer.OutputTensorState', deadline: Optional[float]) -> TokenList:
+        pending = state.pending
+        if pending is not None and deadline is not None and state.fallback_allowed_tokens is not None:
+            # The exact computation was started because of an earlier overrun. Only wait for it until the deadline.
+            wait([pending], timeout=max(0.0, deadline - time.perf_counter()))
+            if not pending.done():
+                self.stats.num_budget_overruns += 1
+                return state.fallback_allowed_tokens
+        self._wait_for_pending(state)
+        if state.allowed_tokens is None:
+            self._compute_allowed_tokens(state.key, state, deadline)
+        allowed_tokens = state.allowed_tokens
+        return allowed_tokens if allowed_tokens is not None else state.fallback_allowed_tokens
+
+    def _get_executor(self) -> Executor:
+        with self._state_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='lmformatenforcer')
+            return self._executor
+
+    def _start_background_computation(self, state: 'TokenEnforcer.OutputTensorState') -> bool:
+        with self._state_lock:
+            if state.allowed_tokens is not None or state.pending is not None:
+                return False
+            state.pending = self._get_executor().submit(self._compute_allowed_tokens_in_background, state)
+            return True
+
+    def _compute_allowed_tokens_in_background(self, state: 'TokenEnforcer.OutputTensorState'):
+        start_time = time.perf_counter()
+        self._compute_allowed_tokens(state.key, state)
+        self.stats.prefetch_compute_seconds += time.perf_counter() - start_time
+
+    def _mark_requested(self, state: 'TokenEnforcer.OutputTensorState'):
+        if state.speculative:
+            state.speculative = False
+            self.stats.num_speculative_hits += 1
+
+    def _wait_for_pending(self, state: 'TokenEnforcer.OutputTensorState'):
+        pending = state.pending
+        if pending is None:
+            return
+        start_time = time.perf_counter()
+        pending.result()
+        self.stats.prefetch_wait_seconds += time.perf_counter() - start_time
+        state.pending = None
+
+    def _get_cached_allowed_tokens(self, state: 'TokenEnforcer.OutputTensorState') -> Optional[TokenList]:
+        # The allowed tokens of the state, if they can be found without traversing the tokenizer tree
+        if state.allowed_tokens is not None:
             return state.allowed_tokens
-        else:
-            # Find the state that led to this node. We explicitly don't use the concept of "timestep" because of beam search        
-            prev_step_state = self.prefix_states[prev_step_tuple]
-            new_state = self._apply_new_characters(prev_step_state, token_sequence)
-            self.prefix_states[sent_tuple] = new_state
-            self._compute_allowed_tokens(sent_tuple, new_state)
-            return new_state.allowed_tokens
-
-    def _compute_allowed_tokens(self, state_tokens: Tuple, state: 'TokenEnforcer.OutputTensorState'):
+        pending = state.pending
+        if pending is not None and pending.done():
+            self._wait_for_pending(state)
+            return state.allowed_tokens
+        cache_key = state.parser.cache_key()
+        if cache_key is not None:
+            return self._lookup_allowed_token_cache(cache_key)
+        return None
+
+    def _lookup_allowed_token_cache(self, cache_key: Hashable) -> Optional[TokenList]:
+        allowed_tokens = self.allowed_token_cache.get(cache_key)
+        if allowed_tokens is None and self._shared_cache_namespace is not None:
+            allowed_tokens = self.tokenizer_data.shared_allowed_token_cache.get((self._shared_cache_namespace, cache_key))
+            if allowed_tokens is not None:
+                self.allowed_token_cache[cache_key] = allowed_tokens
+        return allowed_tokens
+
+    def _store_allowed_token_cache(self, cache_key: Hashable, allowed_tokens: TokenList) -> TokenList:
+        # Returns the list that ended up in the cache, which is the one that was published first
+        if self._shared_cache_namespace is not None:
+            shared_key = (self._shared_cache_namespace, cache_key)
+            allowed_tokens = self.tokenizer_data.shared_allowed_token_cache.setdefault(shared_key, allowed_tokens)
+        return self.allowed_token_cache.setdefault(cache_key, allowed_tokens)
+
+    def _parser_allows_token(self, parser: CharacterLevelParser, token: int) -> bool:
+        # Walk the token's characters through the parser, stopping at the first character that is not allowed.
+        if token == self.eos_token_id or (isinstance(self.eos_token_id, list) and token in self.eos_token_id):
+            return parser.can_end()
+        token_str = self.tokenizer_tree.tokens_to_strs.get(token)
+        if token_str is None:
+            return False
+        # Mirror the JSON freetext shortcut of _collect_allowed_tokens(), so that the answer always agrees with the full list
+        json_freetext_lengths = self._get_json_freetext_lengths(parser.shortcut_key())
+        if json_freetext_lengths is not None:
+            if self.tokenizer_tree.json_freetext_tokens.is_token_allowed(token_str, *json_freetext_lengths):
+                return True
+            if token_str and not token_str.startswith('"'):
+                return False
+        try:
+            for character in token_str:
+                if character not in parser.get_allowed_characters():
+                    return False
+                parser = parser.add_character(character)
+        except Exception:
+            return False
+        return True
+
+    def _on_prefix_state_evicted(self, key: Tuple, state: 'TokenEnforcer.OutputTensorState'):
+        with self._state_lock:
+            self._num_evicted_prefix_states += 1
+            self._detach_state(state)
+
+    def _detach_state(self, state: 'TokenEnforcer.OutputTensorState'):
+        # Break the links to the state's parent and children, so that evicted / released states can be garbage collected
+        if state.parent is not None and state.parent.children is not None and state.key:
+            state.parent.children.pop(state.key[-1], None)
+        state.parent = None
+        if state.children:
+            for child in state.children.values():
+                child.parent = None
+        state.children = None
+
+    def _compute_allowed_tokens(self, state_tokens: Optional[Tuple], state: 'TokenEnforcer.OutputTensorState', deadline: Optional[float] = None):
         try:
             allowed_tokens: TokenList = TokenList(self.use_bitmask, self.vocab_size)
             
             cache_key = state.parser.cache_key()
-            if cache_key is not None and cache_key in self.allowed_token_cache:
-                state.allowed_tokens = self.allowed_token_cache[cache_key]
-                return
+            if cache_key is not None:
+                cached_allowed_tokens = self._lookup_allowed_token_cache(cache_key)
+                if cached_allowed_tokens is not None:
+                    state.allowed_tokens = cached_allowed_tokens
+                    return
             shortcut_key = state.parser.shortcut_key()
-            self._collect_allowed_tokens(state.parser, self.tokenizer_tree.root, allowed_tokens, shortcut_key)
+            try:
+                self._collect_allowed_tokens(state.parser, self.tokenizer_tree.root, allowed_tokens, shortcut_key, deadline)
+            except _TimeBudgetExceeded:
+                if state.parser.can_end():
+                    self._append_eos_tokens(allowed_tokens)
+                state.fallback_allowed_tokens = allowed_tokens
+                self.stats.num_budget_overruns += 1
+                self._start_background_computation(state)
+                return
             if state.parser.can_end():
-                if isinstance(self.eos_token_id, list):
-                    allowed_tokens.extend(self.eos_token_id)                    
-                else:
-                    allowed_tokens.append(self.eos_token_id)
-            if not allowed_tokens:
+                self._append_eos_tokens(allowed_tokens)
+            if allowed_tokens.is_empty():
                 raise ValueError(f"Parser reached state with no allowed tokens")
             # root_state = next(state for state in self.prefix_states.values() if state.parser == self.root_parser)
             # print(f"Allowing {len(allowed_tokens)} tokens after {state.str_so_far[len(root_state.str_so_far):]}")
-            state.allowed_tokens = allowed_tokens
             if cache_key is not None:
-                self.allowed_token_cache[cache_key] = allowed_tokens
+                allowed_tokens = self._store_allowed_token_cache(cache_key, allowed_tokens)
+            state.allowed_tokens = allowed_tokens
+            state.fallback_allowed_tokens = None
         except LMFormatEnforcerException:
             # Getting an LMFormatEnforcerException means that we know what the user did wrong, 
             # and we can give a nice error message for them to fix.
@@ -124,61 +944,171 @@ class TokenEnforcer:
         except Exception:
             # Other exceptions are potential bugs and should be reported
             logging.basicConfig(level=logging.ERROR)  # Initialize if no loggers
-            prefix = self.decoder(list(state_tokens))
+            prefix = self.decoder(list(state_tokens)) if state_tokens is not None else '<unknown, handle based API>'
             logging.exception(f"Unknown LMFormatEnforcer Problem. Prefix: '{prefix}'\n"
                               "Terminating the parser. Please open an issue at \n"
                               "https://github.com/noamgat/lm-format-enforcer/issues with the prefix and "
                               "CharacterLevelParser parameters")
             state.allowed_tokens = TokenList(self.use_bitmask, self.vocab_size)
-            if isinstance(self.eos_token_id, list):
-                state.allowed_tokens.extend(self.eos_token_id)
-            else:
-                state.allowed_tokens.append(self.eos_token_id)
-
-    def _collect_allowed_tokens(self, parser: CharacterLevelParser, tree_node: TokenizerPrefixTreeNode, allowed_tokens: TokenList, shortcut_key: Optional[Hashable]):
-        allowed_tokens.extend(tree_node.tokens)
-        allowed_characters = parser.get_allowed_characters()
-        relevant_characters = tree_node.children.keys()
-        # This next line is the heart of the traversal algorithm. We only explore paths that are shared by both the parser and the tokenizer.
-        characters_to_explore = set(relevant_characters).intersection(allowed_characters)
-        
+            self._append_eos_tokens(state.allowed_tokens)
+
+    def _append_eos_tokens(self, allowed_tokens: TokenList):
+        if isinstance(self.eos_token_id, list):
+            allowed_tokens.extend(self.eos_token_id)
+        else:
+            allowed_tokens.append(self.eos_token_id)
+
+    def _collect_allowed_tokens(self, 
+                                parser: CharacterLevelParser, 
+                                tree_node: Any, 
+                                allowed_tokens: TokenList, 
+                                shortcut_key: Optional[Hashable],
+                                deadline: Optional[float] = None):
         # Performance optimization: If we are in JSON freetext, all of the tokens that don't contain quote, or end with quote, are legal, so we take
         # their cached list. If the quote character is allowed, we only need to dynamically explore the cases where the string starts with a quote.
         # This breaks the elegance of the API, but otherwise it is a huge performance hit.
-        if isinstance(shortcut_key, tuple) and shortcut_key[0] == 'json_freetext':
-            assert len(shortcut_key) == 4
-            _, cur_len, min_len, max_len = shortcut_key
+        json_freetext_lengths = self._get_json_freetext_lengths(shortcut_key)
+        if json_freetext_lengths is not None:
             cache = self.tokenizer_tree.json_freetext_tokens
+            allowed_tokens.extend(cache.lookup_allowed_tokens(*json_freetext_lengths).allowed_tokens)
 
-            min_remaining = min(cache.max_token_len, max(0, min_len - cur_len))  # no " allowed before this many chars
-            max_allowed_len = min(cache.max_token_len, max_len - cur_len)  # max new characters allowed (before ")
-
-            allowed_tokens.extend(cache.lookup_allowed_tokens(min_remaining, max_allowed_len).allowed_tokens)
-            characters_to_explore = characters_to_explore.intersection(['"'])
+        # The traversal uses an explicit stack instead of recursion, as tokens can be very long (for example, whitespace runs).
+        # Each entry is a parser, its cache key (if the transition table is used), the tree node that it is in and the memo key 
+        # of the node's subtree (if it should be memoized), or a _SUBTREE_END marker that is popped once the subtree of a 
+        # memoized node was explored. The root parser is only filtered by the freetext shortcut.
+        memo = self.traversal_memo
+        tree = self.tokenizer_tree
+        get_tokens, get_child_characters, get_child, get_edge_suffix, get_subtree_size = \
+            tree.get_tokens, tree.get_child_characters, tree.get_child, tree.get_edge_suffix, tree.get_subtree_size
+        any_string_character_sets: Dict[str, frozenset] = {}
+        transition_table = self.tokenizer_data.parser_transition_table
+        namespace = self._transition_table_namespace
+        root_cache_key = parser.cache_key() if namespace is not None else None
+        token_ids: List[int] = []
+        stack: List[tuple] = [(parser, root_cache_key, tree_node, None)]
+        is_root = True
+        while stack:
+            entry = stack.pop()
+            if entry[0] is _SUBTREE_END:
+                # The tokens of a subtree are contiguous, as it is explored completely before its siblings
+                _, memo_key, subtree_start = entry
+                memo[memo_key] = token_ids[subtree_start:]
+                continue
+            # The budget is only enforced once at least one allowed token was found, so that the fallback is never empty
+            if deadline is not None and time.perf_counter() > deadline and (token_ids or not allowed_tokens.is_empty()):
+                allowed_tokens.extend(token_ids)
+                raise _TimeBudgetExceeded()
+            parser, cache_key, tree_node, memo_key = entry
+            if memo_key is not None:
+                stack.append((_SUBTREE_END, memo_key, len(token_ids)))
+            edge_suffix = get_edge_suffix(tree_node)
+            if edge_suffix:
+                # The rest of a path compressed edge has no tokens and no branches, so it is checked one character at a time
+                parser, cache_key = self._walk_edge_suffix(parser, cache_key, edge_suffix)
+                if parser is None:
+                    continue
+            if get_subtree_size(tree_node) >= _MIN_WHOLE_SUBTREE_SIZE and not (is_root and json_freetext_lengths is not None):
+                # If the parser accepts any string over the characters of the subtree (for example, whitespaces after the 
+                # end of a JSON object, or the .* of a regex), all of its tokens are allowed
+                any_string_characters = parser.get_any_string_characters()
+                if any_string_characters:
+                    any_string_character_set = any_string_character_sets.get(any_string_characters)
+                    if any_string_character_set is None:
+                        any_string_character_set = any_string_character_sets[any_string_characters] = frozenset(any_string_characters)
+                    if tree.get_subtree_characters(tree_node) <= any_string_character_set:
+                        token_ids.extend(tree.get_subtree_tokens(tree_node))
+                        self.stats.num_whole_subtrees += 1
+                        is_root = False
+                        continue
+            token_ids.extend(get_tokens(tree_node))
+            if cache_key is not None:
+                allowed_characters = transition_table.get_allowed_characters(namespace, parser, cache_key)
+            else:
+                allowed_characters = parser.get_allowed_characters()
+            relevant_characters = get_child_characters(tree_node)
+            # This next line is the heart of the traversal algorithm. We only explore paths that are shared by both the parser and the tokenizer.
+            characters_to_explore = set(relevant_characters).intersection(allowed_characters)
+            is_root_node = is_root
+            if is_root:
+                is_root = False
+                if json_freetext_lengths is not None:
+                    characters_to_explore = characters_to_explore.intersection(['"'])
 
-        for character in characters_to_explore:
-            next_parser = parser.add_character(character)
-            next_tree_node = tree_node.children[character]
-            self._collect_allowed_tokens(next_parser, next_tree_node, allowed_tokens, None)
+            children = [(character, get_child(tree_node, character)) for character in characters_to_explore]
+            if len(children) > 1:
+                # Push the largest subtrees first, so that the smallest ones are popped (and finished) first, keeping the stack short.
+                children.sort(key=lambda child_item: get_subtree_size(child_item[1]), reverse=True)
+            for character, child in children:
+                if cache_key is not None:
+                    next_parser, next_cache_key = transition_table.add_character(namespace, parser, cache_key, character)
+                else:
+                    next_parser, next_cache_key = parser.add_character(character), None
+                memo_key = None
+                # Different root states often converge after their first character (for example, optional whitespace or 
+                # union branches), so the subtrees of the root's children are memoized by the parser state that enters them.
+                if is_root_node and memo is not None and get_subtree_size(child) >= _MIN_MEMOIZED_SUBTREE_SIZE:
+                    if next_cache_key is None:
+                        next_cache_key = next_parser.cache_key()
+                    if next_cache_key is not None:
+                        memo_key = (next_cache_key, child)
+                        memoized_token_ids = memo.get(memo_key)
+                        if memoized_token_ids is not None:
+                            token_ids.extend(memoized_token_ids)
+                            self.stats.num_traversal_memo_hits += 1
+                            continue
+                stack.append((next_parser, next_cache_key if namespace is not None else None, child, memo_key))
+        allowed_tokens.extend(token_ids)
             
-    def _apply_new_characters(self, state: 'TokenEnforcer.OutputTensorState', token_sequence: List[int]):
-        new_state = TokenEnforcer.OutputTensorState(parser=state.parser)
-        new_token = token_sequence[-1]
-        if new_token in self.tokenizer_tree.new_word_tokens:
-            new_state.current_word_tokens = [new_token]
+    def _walk_edge_suffix(self, 
+                          parser: CharacterLevelParser, 
+                          cache_key: Optional[Hashable], 
+                          edge_suffix: str) -> Tuple[Optional[CharacterLevelParser], Optional[Hashable]]:
+        # The parser (and its cache key) after edge_suffix, or None if the parser does not allow it
+        transition_table = self.tokenizer_data.parser_transition_table
+        namespace = self._transition_table_namespace
+        for character in edge_suffix:
+            if cache_key is not None:
+                if character not in transition_table.get_allowed_characters(namespace, parser, cache_key):
+                    return None, None
+                parser, cache_key = transition_table.add_character(namespace, parser, cache_key, character)
+            else:
+                if character not in parser.get_allowed_characters():
+                    return None, None
+                parser = parser.add_character(character)
+        return parser, cache_key
+
+    def _get_json_freetext_lengths(self, shortcut_key: Optional[Hashable]) -> Optional[Tuple[int, int]]:
+        # The (min_remaining, max_len) parameters of JsonFreetextTokenCache, if the shortcut key describes a JSON freetext state
+        if not (isinstance(shortcut_key, tuple) and shortcut_key[0] == 'json_freetext'):
+            return None
+        assert len(shortcut_key) == 4
+        _, cur_len, min_len, max_len = shortcut_key
+        cache = self.tokenizer_tree.json_freetext_tokens
+
+        min_remaining = min(cache.max_token_len, max(0, min_len - cur_len))  # no " allowed before this many chars
+        max_allowed_len = min(cache.max_token_len, max_len - cur_len)  # max new characters allowed (before ")
+        return min_remaining, max_allowed_len
+
+    def _apply_new_characters(self, state: 'TokenEnforcer.OutputTensorState', new_token: int):
+        detokenizer = self.tokenizer_data.incremental_detokenizer
+        if self.tokenizer_data.byte_level:
+            # The bytes of each token are known, so there is no need to track the current word
+            new_state = TokenEnforcer.OutputTensorState(state.parser)
+            new_characters = self.tokenizer_tree.tokens_to_strs.get(new_token, '')
+        elif new_token in self.tokenizer_tree.new_word_tokens:
+            new_state = TokenEnforcer.OutputTensorState(state.parser, detokenizer.start([new_token]))
             new_characters = self.tokenizer_tree.tokens_to_strs[new_token]
         else:
-            new_state.current_word_tokens = state.current_word_tokens + [new_token]
-            prev_decoded = self.decoder(state.current_word_tokens)
-            new_decoded = self.decoder(new_state.current_word_tokens)
-            new_characters = new_decoded[len(prev_decoded):]
-        for character in new_characters:
-            try:
-                new_state.parser = new_state.parser.add_character(character)
-            except Exception as e:
-                # This can happen in beam / batch scenarios, when some of the batches finished but others are continuing.
-                logging.debug(f"Received an invalid character '{character}', switching to ForceStopParser (Exception:{e})")
-                new_state.parser = ForceStopParser()
+            # Only the detokenizer state is kept, so continuing a word does not copy its tokens
+            detokenizer_state = state.detokenizer_state if state.detokenizer_state is not None else detokenizer.start([])
+            new_characters, new_detokenizer_state = detokenizer.decode_next(detokenizer_state, new_token)
+            new_state = TokenEnforcer.OutputTensorState(state.parser, new_detokenizer_state)
+        try:
+            new_state.parser = new_state.parser.add_string(new_characters)
+        except Exception as e:
+            # This can happen in beam / batch scenarios, when some of the batches finished but others are continuing.
+            logging.debug(f"Received invalid characters '{new_characters}', switching to ForceStopParser (Exception:{e})")
+            new_state.parser = ForceStopParser()
         return new_state
         
 
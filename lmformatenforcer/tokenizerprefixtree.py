@@ -1,13 +1,19 @@
+from array import array
 from collections import OrderedDict
-from typing import Dict, List, Set, Tuple
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
 import json
+import sys
 
+from .bytelevel import is_utf8_prefix
+from .caching import LRUCache
 from .tokenlist import TokenList
 
 class TokenizerPrefixTreeNode:
     def __init__(self) -> None:
         self.tokens: List[int] = []
         self.children: Dict[str, TokenizerPrefixTreeNode] = {}
+        # The number of nodes in the subtree that starts at this node (including it)
+        self.subtree_size = 1
 
 
 class JsonFreetextTokenCache:
@@ -48,8 +54,11 @@ class JsonFreetextTokenCache:
                 end_index = len(self.tokens)
             return self.tokens[start_index:end_index]
 
-    def __init__(self, use_bitmask: bool, vocab_size: int) -> None:
+    def __init__(self, use_bitmask: bool, vocab_size: int, byte_level: bool = False) -> None:
         self.token_num_to_str: Dict[int, str] = {}
+        # In byte level mode, token strings are UTF-8 bytes (see bytelevel.py). Tokens that are only valid after the
+        # beginning of a character are left out, they are allowed by the traversal of states with incomplete characters.
+        self.byte_level = byte_level
         self.allowlist_cache: Dict[Tuple[int, int], TokenList] = {}
         self.max_token_len = 0
         self.regular_tokens_length_cache = JsonFreetextTokenCache._StringLengthTokenCache()
@@ -59,7 +68,12 @@ class JsonFreetextTokenCache:
 
     def add_token(self, token_str: str, token_int: int):
         assert not self.allowlist_cache, "Cannot add more tokens after allowlists were precalculated"
+        if self._is_freetext_token(token_str):
+            self.token_num_to_str[token_int] = token_str
 
+    def _is_freetext_token(self, token_str: str) -> bool:
+        if self.byte_level and not is_utf8_prefix(token_str):
+            return False
         has_non_trailing_backslash = "\\" in token_str[:-1]
         has_quote_before_end = '"' in token_str[0:-1]
         has_newline = "\n" in token_str or "\r" in token_str
@@ -67,14 +81,23 @@ class JsonFreetextTokenCache:
             try:
                 json.loads(f'"{token_str}"')
             except json.decoder.JSONDecodeError:
-                return  # Illegal inside JSON string, skip this token
+                return False  # Illegal inside JSON string, skip this token
 
         if len(token_str) == 0:
             # Tokens that don't decode to anything should be ignored, will not be allowed in json freetext fields.
             # TODO: Should we instead ALWAYS allow them?
-            return
+            return False
+        return True
 
-        self.token_num_to_str[token_int] = token_str
+    def is_token_allowed(self, token_str: str, min_remaining: int, max_len: int) -> bool:
+        """
+        Check whether a single token is in lookup_allowed_tokens(min_remaining, max_len), without building the list.
+        """
+        if not self._is_freetext_token(token_str):
+            return False
+        if token_str.endswith('"'):
+            return min_remaining + 1 <= len(token_str) <= max_len + 1
+        return len(token_str) <= max_len
 
     def lookup_allowed_tokens(self, min_remaining: int, max_len: int) -> TokenList:
         """
@@ -91,7 +114,8 @@ class JsonFreetextTokenCache:
             # TODO: This causes some heavy computations in first uses in use_bitmask=True case,
             # bitmask support can be added to get_indices_between_length() to be faster.
             new_tokenlist.extend(combined)
-            self.allowlist_cache[cache_key] = new_tokenlist
+            # setdefault() publishes the list atomically, so concurrent callers all get the same complete list
+            return self.allowlist_cache.setdefault(cache_key, new_tokenlist)
         return self.allowlist_cache[cache_key]
 
     def freeze(self) -> None:
@@ -119,18 +143,98 @@ class JsonFreetextTokenCache:
 
 
 class TokenizerPrefixTree:
-    def __init__(self, regular_tokens: List[Tuple[int, str, bool]], use_bitmask: bool, vocab_size: int):
-        self.root = TokenizerPrefixTreeNode()
-        self.json_freetext_tokens = JsonFreetextTokenCache(use_bitmask, vocab_size)
+    """The tokenizer vocabulary as a tree of characters, where each node holds the tokens whose string ends at it.
+    TokenEnforcer traverses it together with the parser, through get_tokens(), get_child_characters(), get_child(), 
+    get_edge_suffix(), get_subtree_size(), get_subtree_tokens() and get_subtree_characters(), so that other node layouts 
+    (see CompactTokenizerPrefixTree and RadixTokenizerPrefixTree) can be used as well."""
+    # The maximal number of nodes whose subtree characters are kept. The tree is shared by all of the enforcers of a 
+    # tokenizer, so this has to be bounded.
+    subtree_characters_cache_size = 4096
+
+    def __init__(self, regular_tokens: List[Tuple[int, str, bool]], use_bitmask: bool, vocab_size: int, byte_level: bool = False):
+        self.json_freetext_tokens = JsonFreetextTokenCache(use_bitmask, vocab_size, byte_level)
         self.new_word_tokens: Set[int] = set()
         self.tokens_to_strs = {token_idx: token_str for token_idx, token_str, _ in regular_tokens}
         for token_idx, decoded, is_new_word in regular_tokens:
-            self._add_token_to_tree(decoded, token_idx, self.root)
             self.json_freetext_tokens.add_token(decoded, token_idx)
             if is_new_word:
                 self.new_word_tokens.add(token_idx)
 
         self.json_freetext_tokens.freeze()
+        self._subtree_characters_cache: LRUCache[object, frozenset] = LRUCache(self.subtree_characters_cache_size)
+        self._build_tree(regular_tokens)
+
+    def _build_tree(self, regular_tokens: List[Tuple[int, str, bool]]):
+        self.root = TokenizerPrefixTreeNode()
+        for token_idx, decoded, _ in regular_tokens:
+            self._add_token_to_tree(decoded, token_idx, self.root)
+        self._compute_subtree_sizes()
+
+    def get_tokens(self, node: TokenizerPrefixTreeNode) -> Sequence[int]:
+        return node.tokens
+
+    def get_child_characters(self, node: TokenizerPrefixTreeNode) -> Iterable[str]:
+        return node.children.keys()
+
+    def get_child(self, node: TokenizerPrefixTreeNode, character: str) -> Optional[TokenizerPrefixTreeNode]:
+        return node.children.get(character)
+
+    def get_edge_suffix(self, node: TokenizerPrefixTreeNode) -> str:
+        """The characters of the edge into node after its first character (the one passed to get_child()). The parser has
+        to accept all of them to reach the node. Empty, unless the tree is path compressed."""
+        return ''
+
+    def get_subtree_size(self, node: TokenizerPrefixTreeNode) -> int:
+        return node.subtree_size
+
+    def get_subtree_tokens(self, node: TokenizerPrefixTreeNode) -> Sequence[int]:
+        """All of the tokens of the subtree that starts at node (including its own tokens)."""
+        subtree_tokens: List[int] = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            subtree_tokens.extend(node.tokens)
+            stack.extend(node.children.values())
+        return subtree_tokens
+
+    def get_subtree_characters(self, node: TokenizerPrefixTreeNode) -> frozenset:
+        """The characters of all of the edges below node, that a parser has to accept in order to reach every token of its 
+        subtree. They are computed when first requested, as only the nodes that the traversal checks need them, and the 
+        subtree_characters_cache_size most recently used ones are kept."""
+        subtree_characters = self._subtree_characters_cache.get(node)
+        if subtree_characters is None:
+            subtree_characters = self._subtree_characters_cache.setdefault(node, frozenset(self._collect_subtree_characters(node)))
+        return subtree_characters
+
+    def _collect_subtree_characters(self, node: TokenizerPrefixTreeNode) -> Iterable[str]:
+        subtree_characters: Set[str] = set()
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            subtree_characters.update(node.children.keys())
+            stack.extend(node.children.values())
+        return subtree_characters
+
+    def memory_usage(self) -> int:
+        """Return an estimate of the memory (in bytes) that the tree nodes hold."""
+        total_bytes = 0
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            total_bytes += sys.getsizeof(node) + sys.getsizeof(node.__dict__) + sys.getsizeof(node.tokens) + sys.getsizeof(node.children)
+            stack.extend(node.children.values())
+        return total_bytes
+
+    def _compute_subtree_sizes(self):
+        # Post order without recursion, as the tree is as deep as the longest token
+        nodes_in_preorder = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            nodes_in_preorder.append(node)
+            stack.extend(node.children.values())
+        for node in reversed(nodes_in_preorder):
+            node.subtree_size = 1 + sum(child.subtree_size for child in node.children.values())
 
     def _add_token_to_tree(self, token_str: str, token_idx: int, node: TokenizerPrefixTreeNode):
         for character in token_str:
@@ -138,3 +242,155 @@ class TokenizerPrefixTree:
                 node.children[character] = TokenizerPrefixTreeNode()
             node = node.children[character]
         node.tokens.append(token_idx)
+
+
+class CompactTokenizerPrefixTree(TokenizerPrefixTree):
+    """A TokenizerPrefixTree that is stored in a few contiguous arrays instead of an object per node, which takes a fraction
+    of the memory and construction time for large vocabularies. Nodes are integers, numbered in depth first (preorder) order.
+    The children of node n are the edges child_offsets[n]:child_offsets[n + 1], whose characters are in edge_characters and
+    whose nodes are in edge_targets. The tokens of node n are token_ids[token_offsets[n]:token_offsets[n + 1]]."""
+    path_compression = False
+
+    def _build_tree(self, regular_tokens: List[Tuple[int, str, bool]]):
+        # In sorted order, the new nodes of each token string are created in preorder, and its tokens are appended after 
+        # the tokens of all of the nodes before them
+        sorted_tokens = sorted((decoded, token_idx) for token_idx, decoded, _ in regular_tokens)
+        parents = array('i', [-1])
+        labels: List[str] = ['']
+        token_ids = array('i')
+        token_counts = array('i', [0])
+        path = [0]  # The nodes of the prefixes of the previous token string
+        previous_str = ''
+        for token_str, token_idx in sorted_tokens:
+            common_prefix_length = 0
+            max_common_prefix_length = min(len(token_str), len(previous_str))
+            while common_prefix_length < max_common_prefix_length and token_str[common_prefix_length] == previous_str[common_prefix_length]:
+                common_prefix_length += 1
+            del path[common_prefix_length + 1:]
+            for character in token_str[common_prefix_length:]:
+                parents.append(path[-1])
+                labels.append(character)
+                token_counts.append(0)
+                path.append(len(parents) - 1)
+            token_ids.append(token_idx)
+            token_counts[path[-1]] += 1
+            previous_str = token_str
+        if self.path_compression:
+            parents, labels, token_counts = self._compress_paths(parents, labels, token_counts)
+        
+        num_nodes = len(parents)
+        self.token_ids = token_ids
+        self.token_offsets = array('i', [0]) * (num_nodes + 1)
+        for node in range(num_nodes):
+            self.token_offsets[node + 1] = self.token_offsets[node] + token_counts[node]
+        
+        # Counting sort of the edges by their parent. Children were created in character order, so they stay sorted.
+        self.child_offsets = array('i', [0]) * (num_nodes + 1)
+        for node in range(1, num_nodes):
+            self.child_offsets[parents[node] + 1] += 1
+        for node in range(num_nodes):
+            self.child_offsets[node + 1] += self.child_offsets[node]
+        self.edge_targets = array('i', [0]) * (num_nodes - 1)
+        edge_characters = [''] * (num_nodes - 1)
+        next_edge = array('i', self.child_offsets[:num_nodes])
+        for node in range(1, num_nodes):
+            edge_idx = next_edge[parents[node]]
+            next_edge[parents[node]] += 1
+            self.edge_targets[edge_idx] = node
+            edge_characters[edge_idx] = labels[node][0]
+        self.edge_characters = "".join(edge_characters)
+        # The first character of the edge into each node, in node order (node n > 0 is at n - 1), so that the characters 
+        # below a node are a single slice
+        self.node_characters = "".join(label[:1] for label in labels)
+        if self.path_compression:
+            self.edge_suffix_offsets = array('i', [0]) * (num_nodes + 1)
+            for node in range(num_nodes):
+                self.edge_suffix_offsets[node + 1] = self.edge_suffix_offsets[node] + max(0, len(labels[node]) - 1)
+            self.edge_suffixes = "".join(label[1:] for label in labels)
+
+        self.subtree_sizes = array('i', [1]) * num_nodes
+        for node in range(num_nodes - 1, 0, -1):
+            self.subtree_sizes[parents[node]] += self.subtree_sizes[node]
+        self.root = 0
+
+    @staticmethod
+    def _compress_paths(parents: array, characters: List[str], token_counts: array) -> Tuple[array, List[str], array]:
+        # Keep the root and the nodes that have tokens or don't have exactly one child, and merge every other node into the 
+        # edge of its only child. Leaves always have tokens, so every chain of merged nodes ends in a kept node. The kept 
+        # nodes are a subsequence of the preorder, so they remain in preorder, and so do their tokens.
+        num_nodes = len(parents)
+        num_children = array('i', [0]) * num_nodes
+        for node in range(1, num_nodes):
+            num_children[parents[node]] += 1
+        new_ids = array('i', [-1]) * num_nodes
+        new_ids[0] = 0
+        new_parents = array('i', [-1])
+        new_labels: List[str] = ['']
+        new_token_counts = array('i', [token_counts[0]])
+        # The kept ancestor and the pending edge label of merged nodes
+        anchors = array('i', [0]) * num_nodes
+        pending_labels: Dict[int, str] = {}
+        for node in range(1, num_nodes):
+            parent = parents[node]
+            if new_ids[parent] >= 0:
+                anchor, label = new_ids[parent], characters[node]
+            else:
+                anchor, label = anchors[parent], pending_labels.pop(parent) + characters[node]
+            if token_counts[node] > 0 or num_children[node] != 1:
+                new_ids[node] = len(new_parents)
+                new_parents.append(anchor)
+                new_labels.append(label)
+                new_token_counts.append(token_counts[node])
+            else:
+                anchors[node] = anchor
+                pending_labels[node] = label
+        return new_parents, new_labels, new_token_counts
+
+    def get_tokens(self, node: int) -> Sequence[int]:
+        token_offsets = self.token_offsets
+        start, end = token_offsets[node], token_offsets[node + 1]
+        return self.token_ids[start:end] if start != end else ()
+
+    def get_child_characters(self, node: int) -> Iterable[str]:
+        child_offsets = self.child_offsets
+        return self.edge_characters[child_offsets[node]:child_offsets[node + 1]]
+
+    def get_child(self, node: int, character: str) -> Optional[int]:
+        child_offsets = self.child_offsets
+        edge_idx = self.edge_characters.find(character, child_offsets[node], child_offsets[node + 1])
+        return self.edge_targets[edge_idx] if edge_idx >= 0 else None
+
+    def get_subtree_size(self, node: int) -> int:
+        return self.subtree_sizes[node]
+
+    def get_subtree_tokens(self, node: int) -> Sequence[int]:
+        # The tokens are in node order, so the tokens of a subtree are contiguous
+        return self.token_ids[self.token_offsets[node]:self.token_offsets[node + self.subtree_sizes[node]]]
+
+    def _collect_subtree_characters(self, node: int) -> Iterable[str]:
+        return self.node_characters[node:node + self.subtree_sizes[node] - 1]
+
+    def memory_usage(self) -> int:
+        return sum(sys.getsizeof(arr) for arr in (self.token_ids, self.token_offsets, self.child_offsets, self.edge_targets, 
+                                                  self.subtree_sizes, self.edge_characters, self.node_characters))
+
+
+class RadixTokenizerPrefixTree(CompactTokenizerPrefixTree):
+    """A path compressed CompactTokenizerPrefixTree: chains of nodes that have no tokens and a single child are merged 
+    into one edge, which is labelled with a string. Most of the nodes of a character tree are such nodes (the tails of 
+    long, unique tokens), so this takes fewer nodes to store and to visit. The characters of the edge into node n after 
+    the first one are edge_suffixes[edge_suffix_offsets[n]:edge_suffix_offsets[n + 1]]."""
+    path_compression = True
+
+    def get_edge_suffix(self, node: int) -> str:
+        edge_suffix_offsets = self.edge_suffix_offsets
+        return self.edge_suffixes[edge_suffix_offsets[node]:edge_suffix_offsets[node + 1]]
+
+    def _collect_subtree_characters(self, node: int) -> Iterable[str]:
+        subtree_end = node + self.subtree_sizes[node]
+        subtree_characters = set(super()._collect_subtree_characters(node))
+        subtree_characters.update(self.edge_suffixes[self.edge_suffix_offsets[node + 1]:self.edge_suffix_offsets[subtree_end]])
+        return subtree_characters
+
+    def memory_usage(self) -> int:
+        return super().memory_usage() + sys.getsizeof(self.edge_suffix_offsets) + sys.getsizeof(self.edge_suffixes)
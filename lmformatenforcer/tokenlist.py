@@ -1,3 +1,5 @@
+import sys
+from typing import Dict, List, Optional, Tuple
 try:
     import torch
     _HAS_TORCH = True
@@ -45,3 +47,109 @@ class TokenList:
             return (self.allowed_tokens[element_index] & (1 << bit_index)) != 0
         else:
             return token_id in self.allowed_tokens
+
+    def is_empty(self) -> bool:
+        if self.use_bitmask:
+            return not bool(self.allowed_tokens.any())
+        else:
+            return len(self.allowed_tokens) == 0
+
+    def to_token_ids(self) -> List[int]:
+        """Return the allowed token ids as a list, regardless of the representation."""
+        if self.use_bitmask:
+            bits = (self.allowed_tokens.unsqueeze(-1) >> torch.arange(32, dtype=torch.int32)) & 1
+            return torch.nonzero(bits.flatten()).flatten().tolist()
+        else:
+            return list(self.allowed_tokens)
+
+    def to_packed_bytes(self, vocab_size: int) -> bytes:
+        """Return the allowed tokens as a packed bitmask (token t is bit t % 8 of byte t // 8), regardless of the representation.
+        The format is the same as the little endian bytes of the use_bitmask tensor, see from_packed_bytes()."""
+        if self.use_bitmask:
+            return bytes(self.allowed_tokens.contiguous().view(torch.uint8).tolist())
+        packed = bytearray((vocab_size + 31) // 32 * 4)
+        for token_id in self.allowed_tokens:
+            packed[token_id >> 3] |= 1 << (token_id & 0x7)
+        return bytes(packed)
+
+    @staticmethod
+    def from_packed_bytes(data: bytes, use_bitmask: bool, vocab_size: int) -> 'TokenList':
+        """Create a TokenList from the result of to_packed_bytes()."""
+        token_list = TokenList(use_bitmask, vocab_size)
+        if use_bitmask:
+            token_list.allowed_tokens = torch.frombuffer(bytearray(data), dtype=torch.uint8).view(torch.int32).clone()
+        else:
+            token_list.allowed_tokens = [byte_idx * 8 + bit_idx
+                                         for byte_idx, byte in enumerate(data) if byte
+                                         for bit_idx in range(8) if byte & (1 << bit_idx)]
+        return token_list
+
+    def memory_usage(self) -> int:
+        """Return an estimate of the number of bytes used to hold the allowed tokens."""
+        if self.use_bitmask:
+            return self.allowed_tokens.element_size() * self.allowed_tokens.nelement()
+        else:
+            return sys.getsizeof(self.allowed_tokens)
+
+
+class TokenListBatch:
+    """The allowed tokens of several sequences, as returned by TokenEnforcer.get_allowed_tokens_batch().
+    Rows that reached the same parsing state share the same TokenList object. The to_*() methods convert
+    the batch to a structure that can be used to mask the logits of the whole batch in a single operation."""
+    def __init__(self, token_lists: List[TokenList], use_bitmask: bool, vocab_size: int):
+        self.token_lists = token_lists
+        self.use_bitmask = use_bitmask
+        self.vocab_size = vocab_size
+
+    def __len__(self) -> int:
+        return len(self.token_lists)
+
+    def __getitem__(self, row: int) -> TokenList:
+        return self.token_lists[row]
+
+    def to_bitmask(self) -> 'torch.Tensor':
+        """Return a [batch, (vocab_size + 31) // 32] int32 tensor of the packed bitmasks of all rows. Requires use_bitmask."""
+        if not self.use_bitmask:
+            raise ValueError("to_bitmask() requires use_bitmask=True, use to_indices() instead")
+        # Rows that share a TokenList are only stacked once, and then expanded with a single indexing operation
+        unique_idx_by_id: Dict[int, int] = {}
+        unique_bitmasks = []
+        row_to_unique_idx = []
+        for token_list in self.token_lists:
+            if id(token_list) not in unique_idx_by_id:
+                unique_idx_by_id[id(token_list)] = len(unique_bitmasks)
+                unique_bitmasks.append(token_list.allowed_tokens)
+            row_to_unique_idx.append(unique_idx_by_id[id(token_list)])
+        stacked = torch.stack(unique_bitmasks)
+        return stacked[torch.tensor(row_to_unique_idx, dtype=torch.long)]
+
+    def to_indices(self) -> Tuple[List[int], List[int]]:
+        """Return (row_indices, token_indices) of all of the allowed tokens, suitable for mask[row_indices, token_indices] = value."""
+        row_indices: List[int] = []
+        token_indices: List[int] = []
+        for row, token_list in enumerate(self.token_lists):
+            allowed = token_list.to_token_ids()
+            row_indices.extend([row] * len(allowed))
+            token_indices.extend(allowed)
+        return row_indices, token_indices
+
+    def to_mask(self, num_columns: Optional[int] = None) -> 'torch.Tensor':
+        """Return a [batch, num_columns] boolean tensor that is True for allowed tokens. num_columns defaults to vocab_size,
+        and can be larger than it if the logits are padded."""
+        if not _HAS_TORCH:
+            raise ValueError("TokenListBatch.to_mask() requires torch")
+        num_columns = num_columns or self.vocab_size
+        if self.use_bitmask:
+            bitmask = self.to_bitmask()
+            shifts = torch.arange(32, dtype=torch.int32)
+            bits = (bitmask.unsqueeze(-1) >> shifts) & 1
+            mask = bits.reshape(len(self.token_lists), -1).bool()[:, :num_columns]
+            if mask.shape[1] < num_columns:
+                padding = torch.zeros((len(self.token_lists), num_columns - mask.shape[1]), dtype=torch.bool)
+                mask = torch.cat([mask, padding], dim=1)
+            return mask
+        else:
+            mask = torch.zeros((len(self.token_lists), num_columns), dtype=torch.bool)
+            row_indices, token_indices = self.to_indices()
+            mask[row_indices, token_indices] = True
+            return mask
@@ -831,3 +831,22 @@ def test_additional_properties():
     schema = {'type': 'object', 'properties': {'snippets': {'title': 'snippets', 'type': 'string'}, 'overall_sentiment': {'title': 'overall_sentiment', 'type': 'string'}}, 'required': ['snippets', 'overall_sentiment'], 'additionalProperties': False, 'definitions': {}} 
     completion = """{"snippets": "What a beautiful day", "overall_sentiment": "Positive"}"""
     _test_json_schema_parsing_with_string(completion, schema, True)
+
+
+def test_add_string_matches_add_character():
+    schema = {'type': 'object', 'properties': {'name': {'type': 'string'}, 
+                                               'bio': {'type': 'string', 'minLength': 3, 'maxLength': 12},
+                                               'tags': {'type': 'array', 'items': {'type': 'string'}}}}
+    string = '{"name": "  Jo hn\\"Doe\\u00e9 end ", "bio": "hello  world!!", "tags": ["a b", "  c\\n", ""]}'
+    for chunk_size in [1, 3, 7, len(string)]:
+        string_parser = JsonSchemaParser(schema)
+        character_parser = JsonSchemaParser(schema)
+        for idx in range(0, len(string), chunk_size):
+            chunk = string[idx:idx + chunk_size]
+            string_parser = string_parser.add_string(chunk)
+            for character in chunk:
+                character_parser = character_parser.add_character(character)
+            assert string_parser.get_allowed_characters() == character_parser.get_allowed_characters()
+            assert string_parser.can_end() == character_parser.can_end()
+            assert string_parser.shortcut_key() == character_parser.shortcut_key()
+            assert string_parser.num_consecutive_whitespaces == character_parser.num_consecutive_whitespaces
@@ -102,3 +102,12 @@ def test_negative_matching():
     _test_regex_parsing_with_string(text, pattern, False)
     correct_text = text.replace(',', ';')
     _test_regex_parsing_with_string(correct_text, pattern, True)
+
+
+def test_add_string_matches_add_character():
+    parser = RegexParser(r'(\s*[a-z]+\s*=\s*[0-9]+;)+')
+    for string in [' alpha = 12; beta=3;', 'abc', 'abc=x', '=']:
+        character_parser = parser
+        for character in string:
+            character_parser = character_parser.add_character(character)
+        assert parser.add_string(string).current_state == character_parser.current_state
@@ -0,0 +1,910 @@
+import concurrent.futures
+import os
+import pickle
+import sys
+import threading
+from typing import List, Optional
+from lmformatenforcer import CharacterLevelParser, TokenEnforcer, TokenEnforcerTokenizerData, RegexParser, JsonSchemaParser, EnforcerManager, LMFormatEnforcerException
+from lmformatenforcer.characterlevelparser import ForceStopParser
+from lmformatenforcer.caching import AllowedTokenCacheBackend, KeyValueFileCache, LRUCache, MemoryMappedFileCache, ParserTransitionTable
+from lmformatenforcer.consts import COMPLETE_ALPHABET
+from lmformatenforcer.detokenizer import BytesIncrementalDetokenizer
+
+# A small synthetic vocabulary, so that the TokenEnforcer API can be tested without downloading a tokenizer.
+_MULTI_CHARACTER_TOKENS = ['abc', '123', '{"', '"}', '":', '",', ': "', '", "', '  ', '\n', 'true', 'false', 'null', 'name']
+_TOKEN_STRS: List[str] = list(dict.fromkeys(list(COMPLETE_ALPHABET) + _MULTI_CHARACTER_TOKENS))
+_EOS_TOKEN_ID = len(_TOKEN_STRS)
+
+
+def _decode(tokens: List[int]) -> str:
+    return "".join(_TOKEN_STRS[token] for token in tokens if token != _EOS_TOKEN_ID)
+
+
+def _build_tokenizer_data(use_bitmask: bool = False, 
+                          shared_allowed_token_cache_backend: Optional[AllowedTokenCacheBackend] = None,
+                          compact_prefix_tree: bool = False) -> TokenEnforcerTokenizerData:
+    regular_tokens = [(token_id, token_str, False) for token_id, token_str in enumerate(_TOKEN_STRS)]
+    return TokenEnforcerTokenizerData(regular_tokens, _decode, _EOS_TOKEN_ID, use_bitmask, _EOS_TOKEN_ID + 1,
+                                      shared_allowed_token_cache_backend=shared_allowed_token_cache_backend,
+                                      compact_prefix_tree=compact_prefix_tree)
+
+
+def _encode(string: str) -> List[int]:
+    # Greedy longest match, good enough for the synthetic vocabulary
+    tokens = []
+    idx = 0
+    while idx < len(string):
+        token_id = max((token_id for token_id, token_str in enumerate(_TOKEN_STRS) if string.startswith(token_str, idx)),
+                       key=lambda token_id: len(_TOKEN_STRS[token_id]))
+        tokens.append(token_id)
+        idx += len(_TOKEN_STRS[token_id])
+    return tokens
+
+
+def _allowed_set(token_enforcer: TokenEnforcer, token_sequence) -> set:
+    allowed_tokens = token_enforcer.get_allowed_tokens(token_sequence)
+    return set(token_id for token_id in range(token_enforcer.vocab_size) if allowed_tokens.is_token_allowed(token_id))
+
+
+def test_handle_api_matches_sequence_api():
+    tokenizer_data = _build_tokenizer_data()
+    schema = {'type': 'object', 'properties': {'name': {'type': 'string'}, 'ok': {'type': 'boolean'}}, 'required': ['name', 'ok']}
+    output_tokens = _encode('{"name": "abc", "ok": true}')
+    prompt = [1, 2, 3]
+
+    sequence_enforcer = TokenEnforcer(tokenizer_data, JsonSchemaParser(schema))
+    handle_enforcer = TokenEnforcer(tokenizer_data, JsonSchemaParser(schema))
+    state = handle_enforcer.get_initial_state()
+    for idx, token in enumerate(output_tokens):
+        expected = _allowed_set(sequence_enforcer, prompt + output_tokens[:idx])
+        assert _allowed_set(handle_enforcer, state) == expected
+        assert token in expected
+        state = handle_enforcer.advance(state, token)
+    assert _EOS_TOKEN_ID in _allowed_set(handle_enforcer, state)
+
+
+def test_handle_api_forks():
+    token_enforcer = TokenEnforcer(_build_tokenizer_data(), RegexParser('ab(c|d)'))
+    root = token_enforcer.get_initial_state()
+    a_state = token_enforcer.advance(root, _TOKEN_STRS.index('a'))
+    assert token_enforcer.advance(root, _TOKEN_STRS.index('a')) is a_state
+    b_state = token_enforcer.advance(a_state, _TOKEN_STRS.index('b'))
+    c_state = token_enforcer.advance(b_state, _TOKEN_STRS.index('c'))
+    d_state = token_enforcer.advance(b_state, _TOKEN_STRS.index('d'))
+    assert _allowed_set(token_enforcer, c_state) == {_EOS_TOKEN_ID}
+    assert _allowed_set(token_enforcer, d_state) == {_EOS_TOKEN_ID}
+    assert _allowed_set(token_enforcer, b_state) == {_TOKEN_STRS.index('c'), _TOKEN_STRS.index('d')}
+
+
+def test_bounded_prefix_states():
+    tokenizer_data = _build_tokenizer_data()
+    bounded_enforcer = TokenEnforcer(tokenizer_data, RegexParser('[a-z]+'), max_prefix_states=4, max_allowed_token_cache_size=2)
+    unbounded_enforcer = TokenEnforcer(tokenizer_data, RegexParser('[a-z]+'))
+    sequence = [1, 2, 3]
+    for token_str in 'abcdefghij':
+        assert _allowed_set(bounded_enforcer, sequence) == _allowed_set(unbounded_enforcer, sequence)
+        sequence = sequence + [_TOKEN_STRS.index(token_str)]
+    assert len(bounded_enforcer.prefix_states) == 4
+    assert len(bounded_enforcer.allowed_token_cache) <= 2
+    usage = bounded_enforcer.memory_usage()
+    assert usage['num_prefix_states'] == 4
+    assert usage['prefix_states_bytes'] > 0
+
+
+def test_evicted_prefix_state_replay():
+    token_enforcer = TokenEnforcer(_build_tokenizer_data(), RegexParser('ab[a-z]'), max_prefix_states=2)
+    prompt = [1, 2, 3]
+    a_token, b_token = _TOKEN_STRS.index('a'), _TOKEN_STRS.index('b')
+    token_enforcer.get_allowed_tokens(prompt)
+    token_enforcer.get_allowed_tokens(prompt + [a_token])
+    token_enforcer.get_allowed_tokens(prompt + [b_token])
+    assert token_enforcer.stats.num_replayed_tokens == 0
+    # The states of the prompt and of prompt + [a_token] were evicted by the other sequence, so they are rebuilt instead of 
+    # parsing the sequence as a new prompt
+    allowed_tokens = _allowed_set(token_enforcer, prompt + [a_token, b_token])
+    assert token_enforcer.stats.num_replayed_tokens == 1
+    reference_enforcer = TokenEnforcer(_build_tokenizer_data(), RegexParser('ab[a-z]'))
+    for length in range(len(prompt), len(prompt) + 2):
+        reference_enforcer.get_allowed_tokens((prompt + [a_token, b_token])[:length])
+    assert allowed_tokens == _allowed_set(reference_enforcer, prompt + [a_token, b_token])
+    assert a_token in allowed_tokens and b_token in allowed_tokens
+    # A sequence that does not continue a prompt is a new prompt
+    assert b_token not in _allowed_set(token_enforcer, [4, 5])
+
+
+def test_release_sequence():
+    token_enforcer = TokenEnforcer(_build_tokenizer_data(), RegexParser('[a-z]+'))
+    prompt = [1, 2, 3]
+    a_token, b_token = _TOKEN_STRS.index('a'), _TOKEN_STRS.index('b')
+    token_enforcer.get_allowed_tokens(prompt)
+    for continuation in ([a_token], [b_token]):
+        token_enforcer.get_allowed_tokens(prompt + continuation)
+        token_enforcer.get_allowed_tokens(prompt + continuation + [a_token])
+    assert len(token_enforcer.prefix_states) == 5
+    token_enforcer.release(prompt + [a_token, a_token])
+    # The prompt is shared with the other sequence, so it is kept
+    assert len(token_enforcer.prefix_states) == 3
+    token_enforcer.release(prompt + [b_token, a_token])
+    assert len(token_enforcer.prefix_states) == 0
+
+
+def test_allowed_tokens_batch():
+    for use_bitmask in [False, True]:
+        tokenizer_data = _build_tokenizer_data(use_bitmask)
+        batch_enforcer = TokenEnforcer(tokenizer_data, RegexParser('[a-c]+x'))
+        single_enforcer = TokenEnforcer(tokenizer_data, RegexParser('[a-c]+x'))
+        prompt = [1, 2, 3]
+        sequences = [prompt + _encode(continuation) for continuation in ['', 'a', 'b', 'ab', 'abc', 'ax']]
+        batch = batch_enforcer.get_allowed_tokens_batch(sequences)
+        mask = batch.to_mask()
+        assert mask.shape == (len(sequences), _EOS_TOKEN_ID + 1)
+        for row, sequence in enumerate(sequences):
+            expected = _allowed_set(single_enforcer, sequence)
+            assert set(batch[row].to_token_ids()) == expected
+            assert set(mask[row].nonzero().flatten().tolist()) == expected
+        # 'a' and 'b' reach the same regex state, so they share the computed list
+        assert batch[1] is batch[2]
+
+
+def test_allowed_tokens_batch_json():
+    # JSON parsers have no cache key, rows in the same state are grouped by a snapshot of the parser state
+    tokenizer_data = _build_tokenizer_data()
+    schema = {"type": "object", "properties": {"name": {"type": "string"}}}
+    batch_enforcer = TokenEnforcer(tokenizer_data, JsonSchemaParser(schema))
+    prompt = [1, 2, 3]
+    sequences = [prompt + [_TOKEN_STRS.index(token_str) for token_str in tokens] 
+                 for tokens in [['{"'], ['{', '"'], ['{', ' ', '"'], ['{', '"', 'n']]]
+    # The states of the previous steps have to be known
+    batch_enforcer.get_allowed_tokens_batch([prompt, prompt + [_TOKEN_STRS.index('{')]])
+    batch_enforcer.get_allowed_tokens(prompt + [_TOKEN_STRS.index('{'), _TOKEN_STRS.index(' ')])
+    batch = batch_enforcer.get_allowed_tokens_batch(sequences)
+    single_enforcer = TokenEnforcer(tokenizer_data, JsonSchemaParser(schema))
+    for row, sequence in enumerate(sequences):
+        for prefix_length in range(len(prompt), len(sequence)):
+            single_enforcer.get_allowed_tokens(sequence[:prefix_length])
+        assert set(batch[row].to_token_ids()) == _allowed_set(single_enforcer, sequence)
+    # '{"' and '{' + '"' reach the same state through different tokens
+    assert batch[0] is batch[1]
+    assert batch[0] is not batch[3]
+
+
+def test_concurrent_get_allowed_tokens():
+    tokenizer_data = _build_tokenizer_data()
+    schema = {'type': 'object', 'properties': {'name': {'type': 'string'}, 'items': {'type': 'array', 'items': {'type': 'integer'}}}}
+    outputs = ['{"name": "abc"}', '{"items": [1, 23, 4]}', '{"name": "a b c", "items": []}', '{"items": [123], "name": "name"}']
+    prompt = [1, 2, 3]
+    sequences = [prompt + _encode(output) for output in outputs]
+    
+    single_threaded_enforcer = TokenEnforcer(tokenizer_data, JsonSchemaParser(schema))
+    expected = {}
+    for sequence in sequences:
+        for idx in range(len(prompt), len(sequence) + 1):
+            expected[tuple(sequence[:idx])] = _allowed_set(single_threaded_enforcer, sequence[:idx])
+
+    shared_enforcer = TokenEnforcer(tokenizer_data, JsonSchemaParser(schema), max_prefix_states=1000)
+    def run_sequence(sequence: List[int], use_shared_enforcer: bool):
+        # Some of the workers share an enforcer, the others share only the tokenizer data
+        token_enforcer = shared_enforcer if use_shared_enforcer else TokenEnforcer(tokenizer_data, JsonSchemaParser(schema))
+        for idx in range(len(prompt), len(sequence) + 1):
+            assert _allowed_set(token_enforcer, sequence[:idx]) == expected[tuple(sequence[:idx])]
+
+    # Switching threads very often makes races much more likely to surface
+    original_switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+            futures = [executor.submit(run_sequence, sequence, worker_idx % 2 == 0) 
+                       for sequence in sequences for worker_idx in range(16)]
+            for future in futures:
+                future.result()
+    finally:
+        sys.setswitchinterval(original_switch_interval)
+
+
+def test_prefetch():
+    tokenizer_data = _build_tokenizer_data()
+    schema = {'type': 'object', 'properties': {'name': {'type': 'string'}}}
+    output_tokens = _encode('{"name": "abc"}')
+    expected_enforcer = TokenEnforcer(tokenizer_data, JsonSchemaParser(schema))
+    prefetch_enforcer = TokenEnforcer(tokenizer_data, JsonSchemaParser(schema), prefetch=True)
+    state = prefetch_enforcer.get_initial_state()
+    for idx, token in enumerate(output_tokens):
+        assert _allowed_set(prefetch_enforcer, state) == _allowed_set(expected_enforcer, output_tokens[:idx])
+        state = prefetch_enforcer.advance(state, token)
+    assert prefetch_enforcer.stats.num_prefetched_states == len(output_tokens)
+
+    # Sequence API: prefetch() is called explicitly once the next token is known
+    sequence_enforcer = TokenEnforcer(tokenizer_data, JsonSchemaParser(schema))
+    prompt = [1, 2, 3]
+    sequence_enforcer.get_allowed_tokens(prompt)
+    sequence_enforcer.prefetch(prompt + output_tokens[:1])
+    assert _allowed_set(sequence_enforcer, prompt + output_tokens[:1]) == _allowed_set(expected_enforcer, output_tokens[:1])
+    assert sequence_enforcer.stats.num_prefetched_states == 1
+    assert sequence_enforcer.stats.prefetch_hidden_seconds >= 0
+
+
+def test_precompute_candidates():
+    token_enforcer = TokenEnforcer(_build_tokenizer_data(), RegexParser('a(b|c)d'))
+    state = token_enforcer.advance(token_enforcer.get_initial_state(), _TOKEN_STRS.index('a'))
+    candidates = [_TOKEN_STRS.index(token_str) for token_str in 'bcx']
+    # 'x' is not allowed, so only two candidate states are created
+    assert token_enforcer.precompute_candidates(state, candidates, background=False) == 2
+    b_state = token_enforcer.advance(state, _TOKEN_STRS.index('b'))
+    assert b_state.allowed_tokens is not None
+    assert _allowed_set(token_enforcer, b_state) == {_TOKEN_STRS.index('d')}
+    assert token_enforcer.stats.num_speculative_states == 2
+    assert token_enforcer.stats.num_speculative_hits == 1
+    assert token_enforcer.stats.speculative_hit_rate == 0.5
+    # The unused candidate was dropped when the state was advanced
+    assert list(state.children) == [_TOKEN_STRS.index('b')]
+
+    token_enforcer = TokenEnforcer(_build_tokenizer_data(), RegexParser('a(b|c)d'))
+    prompt = [1, 2, 3]
+    token_enforcer.get_allowed_tokens(prompt)
+    token_enforcer.precompute_candidates(prompt, candidates, background=False)
+    usage = token_enforcer.memory_usage()
+    assert usage['num_speculative_states'] == 0  # 'a' is the only allowed token
+    token_enforcer.get_allowed_tokens(prompt + [_TOKEN_STRS.index('a')])
+    token_enforcer.precompute_candidates(prompt + [_TOKEN_STRS.index('a')], candidates, background=False)
+    usage = token_enforcer.memory_usage()
+    assert usage['num_speculative_states'] == 2
+    assert usage['speculative_states_bytes'] > 0
+    token_enforcer.get_allowed_tokens(prompt + [_TOKEN_STRS.index('a'), _TOKEN_STRS.index('c')])
+    assert token_enforcer.memory_usage()['num_speculative_states'] == 0
+
+
+def test_filter_candidate_tokens():
+    tokenizer_data = _build_tokenizer_data()
+    schema = {'type': 'object', 'properties': {'name': {'type': 'string'}}}
+    prompt = [1, 2, 3]
+    candidates = list(range(_EOS_TOKEN_ID + 1))
+    for output in ['', '{"', '{"name": "a', '{"name": "abc"}']:
+        sequence = prompt + _encode(output)
+        expected_enforcer = TokenEnforcer(tokenizer_data, JsonSchemaParser(schema))
+        expected = [token for token in candidates if token in _allowed_set(expected_enforcer, sequence)]
+        # Without a computed mask, every candidate is walked through the parser
+        token_enforcer = TokenEnforcer(tokenizer_data, JsonSchemaParser(schema))
+        assert token_enforcer.filter_candidate_tokens(sequence, candidates) == expected
+        assert token_enforcer.filter_candidate_tokens(sequence, reversed(candidates), max_tokens=2) == expected[::-1][:2]
+        # With a computed mask, the mask is used
+        token_enforcer.get_allowed_tokens(sequence)
+        assert token_enforcer.filter_candidate_tokens(sequence, candidates) == expected
+
+
+def test_is_token_allowed():
+    tokenizer_data = _build_tokenizer_data()
+    schema = {'type': 'object', 'properties': {'name': {'type': 'string', 'maxLength': 4}, 'ok': {'type': 'boolean'}}}
+    prompt = [1, 2, 3]
+    output_tokens = _encode('{"name": "abc", "ok": false}')
+    expected_enforcer = TokenEnforcer(tokenizer_data, JsonSchemaParser(schema))
+    token_enforcer = TokenEnforcer(tokenizer_data, JsonSchemaParser(schema))
+    for idx in range(len(output_tokens) + 1):
+        sequence = prompt + output_tokens[:idx]
+        expected = _allowed_set(expected_enforcer, sequence)
+        for token_id in range(_EOS_TOKEN_ID + 1):
+            assert token_enforcer.is_token_allowed(sequence, token_id) == (token_id in expected)
+    # No mask was computed along the way
+    assert len(token_enforcer.allowed_token_cache) == 0
+
+
+def test_verify_draft():
+    tokenizer_data = _build_tokenizer_data()
+    schema = {'type': 'object', 'properties': {'ok': {'type': 'boolean'}}}
+    prompt = [1, 2, 3]
+    accepted_tokens = _encode('{"ok": ')
+    draft_tokens = accepted_tokens + _encode('"true"')
+    expected_enforcer = TokenEnforcer(tokenizer_data, JsonSchemaParser(schema))
+    expected = [_allowed_set(expected_enforcer, prompt + accepted_tokens[:idx]) for idx in range(len(accepted_tokens) + 1)]
+
+    sequence_enforcer = TokenEnforcer(tokenizer_data, JsonSchemaParser(schema))
+    num_accepted, allowed_tokens = sequence_enforcer.verify_draft(prompt, draft_tokens)
+    assert num_accepted == len(accepted_tokens)
+    assert [set(token_list.to_token_ids()) for token_list in allowed_tokens] == expected
+    # The accepted prefixes are registered, the rejected ones are not
+    assert tuple(prompt + accepted_tokens) in sequence_enforcer.prefix_states
+    assert tuple(prompt + draft_tokens[:num_accepted + 1]) not in sequence_enforcer.prefix_states
+
+    handle_enforcer = TokenEnforcer(tokenizer_data, JsonSchemaParser(schema))
+    num_accepted, allowed_tokens = handle_enforcer.verify_draft(handle_enforcer.get_initial_state(), draft_tokens)
+    assert num_accepted == len(accepted_tokens)
+    assert [set(token_list.to_token_ids()) for token_list in allowed_tokens] == expected
+
+
+def test_get_forced_continuation():
+    token_enforcer = TokenEnforcer(_build_tokenizer_data(), RegexParser('abc123(x|y)z'))
+    forced_text, forced_tokens = token_enforcer.get_forced_continuation(token_enforcer.get_initial_state())
+    assert forced_text == 'abc123'
+    assert forced_tokens == [_TOKEN_STRS.index('abc'), _TOKEN_STRS.index('123')]
+    state = token_enforcer.get_initial_state()
+    for token in forced_tokens:
+        state = token_enforcer.advance(state, token)
+    assert token_enforcer.get_forced_continuation(state) == ('', [])
+    state = token_enforcer.advance(state, _TOKEN_STRS.index('x'))
+    assert token_enforcer.get_forced_continuation(state) == ('z', [_TOKEN_STRS.index('z')])
+
+    schema = {'type': 'object', 'properties': {'name': {'type': 'string'}}, 'required': ['name']}
+    token_enforcer = TokenEnforcer(_build_tokenizer_data(), JsonSchemaParser(schema))
+    prompt = [1, 2, 3]
+    # Leading whitespace is allowed, so nothing is strictly forced
+    assert token_enforcer.get_forced_continuation(prompt) == ('', [])
+    forced_text, forced_tokens = token_enforcer.get_forced_continuation(prompt, skip_optional_whitespace=True)
+    assert forced_text == '{"name":"'
+    assert token_enforcer.verify_draft(prompt, forced_tokens)[0] == len(forced_tokens)
+
+
+class _ManualExecutor(concurrent.futures.Executor):
+    """Runs the submitted calls only when run_pending() is called, so that background computations are deterministic"""
+    def __init__(self):
+        self.pending = []
+
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        self.pending.append((future, fn, args, kwargs))
+        return future
+
+    def run_pending(self):
+        for future, fn, args, kwargs in self.pending:
+            future.set_result(fn(*args, **kwargs))
+        self.pending = []
+
+
+def test_time_budget():
+    tokenizer_data = _build_tokenizer_data()
+    schema = {'type': 'object', 'properties': {'name': {'type': 'string'}}}
+    executor = _ManualExecutor()
+    token_enforcer = TokenEnforcer(tokenizer_data, JsonSchemaParser(schema), executor=executor, time_budget=0)
+    expected_enforcer = TokenEnforcer(tokenizer_data, JsonSchemaParser(schema))
+    # Inside a JSON string, where a large number of tokens is allowed
+    state = token_enforcer.get_initial_state()
+    expected_state = expected_enforcer.get_initial_state()
+    for token in _encode('{"name": "'):
+        state = token_enforcer.advance(state, token)
+        expected_state = expected_enforcer.advance(expected_state, token)
+    expected = _allowed_set(expected_enforcer, expected_state)
+    # A zero budget is exceeded right away, so the fallback is a non empty subset of the allowed tokens
+    fallback = set(token_enforcer.get_allowed_tokens(state).to_token_ids())
+    assert fallback and fallback < expected
+    assert token_enforcer.stats.num_budget_overruns == 1
+    # Until the exact computation finishes in the background, the fallback is returned again
+    assert _allowed_set(token_enforcer, state) == fallback
+    assert token_enforcer.stats.num_budget_overruns == 2
+    executor.run_pending()
+    assert _allowed_set(token_enforcer, state) == expected
+    assert token_enforcer.stats.num_budget_overruns == 2
+
+
+def test_enforcer_manager():
+    tokenizer_data = _build_tokenizer_data()
+    outputs = ['abc', 'cab', 'bca']
+    single_enforcer = TokenEnforcer(tokenizer_data, RegexParser('[a-c]+'))
+    token_list_bytes = single_enforcer.get_allowed_tokens([]).memory_usage()
+    # Only about two cached lists fit in the budget
+    manager = EnforcerManager(tokenizer_data, max_memory_bytes=int(token_list_bytes * 2.5))
+    request_ids = [manager.open(RegexParser('[a-c]+')) for _ in outputs]
+    for step in range(3):
+        for request_id, output in zip(request_ids, outputs):
+            allowed_tokens = manager.get_allowed_tokens(request_id)
+            assert allowed_tokens.is_token_allowed(_TOKEN_STRS.index(output[step]))
+            manager.advance(request_id, _TOKEN_STRS.index(output[step]))
+            assert manager.get_stats().memory_bytes <= manager.max_memory_bytes
+    stats = manager.get_stats()
+    assert stats.num_open_requests == 3
+    assert stats.num_evicted_caches > 0
+    for request_id in request_ids:
+        assert _EOS_TOKEN_ID in manager.get_allowed_tokens(request_id).to_token_ids()
+        manager.close(request_id)
+    stats = manager.get_stats()
+    assert stats.num_open_requests == 0
+    assert stats.num_opened_requests == 3
+    assert stats.memory_bytes == 0
+
+
+def test_enforcer_manager_json():
+    # JSON states have no cache key, so the memory is held by the requests' current states (and traversal memos)
+    tokenizer_data = _build_tokenizer_data()
+    schema = {'type': 'object', 'properties': {'name': {'type': 'string'}}}
+    output = '{"name": "abc"}'
+    unbounded_manager = EnforcerManager(tokenizer_data)
+    request_id = unbounded_manager.open(JsonSchemaParser(schema))
+    unbounded_manager.get_allowed_tokens(request_id)
+    request_bytes = unbounded_manager.get_stats().memory_bytes
+    assert request_bytes > 0
+    unbounded_manager.close(request_id)
+    assert unbounded_manager.get_stats().memory_bytes == 0
+
+    manager = EnforcerManager(tokenizer_data, max_memory_bytes=int(request_bytes * 1.5))
+    request_ids = [manager.open(JsonSchemaParser(schema)) for _ in range(3)]
+    for character in output:
+        for request_id in request_ids:
+            allowed_tokens = manager.get_allowed_tokens(request_id)
+            assert allowed_tokens.is_token_allowed(_TOKEN_STRS.index(character))
+            manager.advance(request_id, _TOKEN_STRS.index(character))
+            assert manager.get_stats().memory_bytes <= manager.max_memory_bytes
+    assert manager.get_stats().num_evicted_caches > 0
+    for request_id in request_ids:
+        assert _EOS_TOKEN_ID in manager.get_allowed_tokens(request_id).to_token_ids()
+
+
+def test_enforcer_manager_shared_executor():
+    # All of the requests' background computations run on the manager's executor, instead of a thread per request
+    tokenizer_data = _build_tokenizer_data()
+    manager = EnforcerManager(tokenizer_data, max_workers=2, prefetch=True)
+    num_threads_before = threading.active_count()
+    request_ids = [manager.open(RegexParser('[a-c]+')) for _ in range(8)]
+    for request_id in request_ids:
+        manager.advance(request_id, _TOKEN_STRS.index('a'))
+        assert manager.get_allowed_tokens(request_id).is_token_allowed(_TOKEN_STRS.index('b'))
+    assert threading.active_count() <= num_threads_before + 2
+    for request_id in request_ids:
+        manager.close(request_id)
+    manager.shutdown()
+
+
+def test_dump_and_load_state():
+    tokenizer_data = _build_tokenizer_data()
+    schema = {'type': 'object', 'properties': {'name': {'type': 'string', 'pattern': '[a-c]+'}, 
+                                               'items': {'type': 'array', 'items': {'type': 'integer'}}}}
+    output_tokens = _encode('{"items": [1, 23], "name": "abc"}')
+    prompt = [1, 2, 3]
+    source_enforcer = TokenEnforcer(tokenizer_data, JsonSchemaParser(schema))
+    state = source_enforcer.get_initial_state()
+    for idx, token in enumerate(output_tokens):
+        # Dump the state at every step, and continue in an enforcer that only has the schema
+        data = source_enforcer.dump_state(state)
+        target_enforcer = TokenEnforcer(tokenizer_data, JsonSchemaParser(schema))
+        restored_state = target_enforcer.load_state(data)
+        assert _allowed_set(target_enforcer, restored_state) == _allowed_set(source_enforcer, state)
+        # The sequence API continues from the restored state as well
+        sequence = prompt + output_tokens[:idx]
+        target_enforcer.load_state(data, sequence)
+        assert _allowed_set(target_enforcer, sequence + [token]) == _allowed_set(source_enforcer, source_enforcer.advance(state, token))
+        state = source_enforcer.advance(state, token)
+    # The schema is referenced, not copied
+    assert len(data) < 2000
+
+    other_enforcer = TokenEnforcer(tokenizer_data, JsonSchemaParser({'type': 'object'}))
+    try:
+        other_enforcer.load_state(data)
+        assert False, "Loading a state of a different schema should fail"
+    except LMFormatEnforcerException:
+        pass
+
+
+def _assert_dump_and_load_state(schema: dict, output: str):
+    tokenizer_data = _build_tokenizer_data()
+    source_enforcer = TokenEnforcer(tokenizer_data, JsonSchemaParser(schema))
+    state = source_enforcer.get_initial_state()
+    for token in _encode(output):
+        target_enforcer = TokenEnforcer(tokenizer_data, JsonSchemaParser(schema))
+        restored_state = target_enforcer.load_state(source_enforcer.dump_state(state))
+        assert _allowed_set(target_enforcer, restored_state) == _allowed_set(source_enforcer, state)
+        state = source_enforcer.advance(state, token)
+
+
+def test_dump_and_load_ref_state():
+    # Nested pydantic models are referred to by $ref
+    schema = {'type': 'object', 'properties': {'inner': {'$ref': '#/$defs/Inner'}},
+              '$defs': {'Inner': {'type': 'object', 'properties': {'a': {'type': 'integer'}}}}}
+    _assert_dump_and_load_state(schema, '{"inner": {"a": 1}}')
+
+
+def test_dump_and_load_all_of_state():
+    # The merged schema of allOf is stored with the state, and the schemas of the loading process are not merged in place
+    schema = {'type': 'object', 'properties': {'x': {'allOf': [
+        {'type': 'object', 'properties': {'a': {'type': 'integer'}}, 'required': ['a']},
+        {'type': 'object', 'properties': {'b': {'type': 'integer'}}, 'required': ['b']}]}}}
+    _assert_dump_and_load_state(schema, '{"x": {"a": 1, "b": 2}}')
+
+
+def test_load_state_rejects_other_classes():
+    tokenizer_data = _build_tokenizer_data()
+    enforcer = TokenEnforcer(tokenizer_data, RegexParser('abc'))
+
+    class _Exploit:
+        def __reduce__(self):
+            return (os.system, ('echo pwned',))
+
+    data = pickle.dumps((1, tokenizer_data.fingerprint, _Exploit(), []))
+    try:
+        enforcer.load_state(data)
+        assert False, "Loading a state that calls os.system should fail"
+    except LMFormatEnforcerException:
+        pass
+
+
+def test_dump_and_load_regex_state():
+    tokenizer_data = _build_tokenizer_data()
+    source_enforcer = TokenEnforcer(tokenizer_data, RegexParser('abc[0-9]+x'))
+    state = source_enforcer.get_initial_state()
+    for token_str in 'abc12':
+        state = source_enforcer.advance(state, _TOKEN_STRS.index(token_str))
+    target_enforcer = TokenEnforcer(tokenizer_data, RegexParser('abc[0-9]+x'))
+    restored_state = target_enforcer.load_state(source_enforcer.dump_state(state))
+    assert _allowed_set(target_enforcer, restored_state) == _allowed_set(source_enforcer, state)
+
+
+def test_shared_allowed_token_cache():
+    tokenizer_data = _build_tokenizer_data()
+    first_enforcer = TokenEnforcer(tokenizer_data, RegexParser('[a-c]+x'))
+    sequence = [1, 2, 3]
+    for token_str in 'abx':
+        first_enforcer.get_allowed_tokens(sequence)
+        sequence = sequence + [_TOKEN_STRS.index(token_str)]
+    num_shared_lists = len(tokenizer_data.shared_allowed_token_cache)
+    assert num_shared_lists > 0
+    # A new enforcer of the same pattern starts with warm caches
+    second_enforcer = TokenEnforcer(tokenizer_data, RegexParser('[a-c]+x'))
+    assert second_enforcer.get_allowed_tokens([4, 5]) is first_enforcer.get_allowed_tokens([1, 2, 3])
+    assert len(tokenizer_data.shared_allowed_token_cache) == num_shared_lists
+    # Different patterns with the same state numbers don't share lists
+    other_enforcer = TokenEnforcer(tokenizer_data, RegexParser('[d-f]+x'))
+    assert _allowed_set(other_enforcer, [4, 5]) == set(_TOKEN_STRS.index(c) for c in 'def')
+
+
+def test_lru_cache_allowed_token_cache_backend():
+    backend = LRUCache(10)
+    tokenizer_data = _build_tokenizer_data(shared_allowed_token_cache_backend=backend)
+    token_enforcer = TokenEnforcer(tokenizer_data, RegexParser('[a-c]+x'))
+    expected = _allowed_set(TokenEnforcer(_build_tokenizer_data(), RegexParser('[a-c]+x')), [1, 2, 3])
+    assert _allowed_set(token_enforcer, [1, 2, 3]) == expected
+    assert len(backend) == 1
+
+
+def test_persistent_allowed_token_cache(tmp_path):
+    for use_bitmask in [False, True]:
+        for backend_class, file_name in [(MemoryMappedFileCache, 'cache.bin'), (KeyValueFileCache, 'cache.db')]:
+            path = str(tmp_path / f'{use_bitmask}_{file_name}')
+            backend = backend_class(path)
+            first_enforcer = TokenEnforcer(_build_tokenizer_data(use_bitmask, backend), RegexParser('[a-c]+x'))
+            expected = _allowed_set(first_enforcer, [1, 2, 3])
+            assert len(backend) == 1
+            backend.close()
+
+            # A new process that opens the same file starts with the list that was computed by the first one
+            backend = backend_class(path, read_only=True)
+            tokenizer_data = _build_tokenizer_data(use_bitmask, backend)
+            assert len(backend) == 1
+            second_enforcer = TokenEnforcer(tokenizer_data, RegexParser('[a-c]+x'))
+            assert _allowed_set(second_enforcer, [4, 5]) == expected
+            assert len(backend) == 1
+            backend.close()
+
+
+def test_warm_up():
+    tokenizer_data = _build_tokenizer_data()
+    warm_enforcer = TokenEnforcer(tokenizer_data, RegexParser('(abc|def)[0-9]x'))
+    report = warm_enforcer.warm_up()
+    # Every FSM state is computed once
+    num_cached_lists = len(tokenizer_data.shared_allowed_token_cache)
+    assert report.num_states_visited == report.num_states_computed == num_cached_lists
+    assert report.seconds > 0
+    # A new request does not compute anything
+    token_enforcer = TokenEnforcer(tokenizer_data, RegexParser('(abc|def)[0-9]x'))
+    sequence = [1, 2, 3]
+    for token_str in ['abc', '1', 'x']:
+        token_enforcer.get_allowed_tokens(sequence)
+        sequence = sequence + [_TOKEN_STRS.index(token_str)]
+    assert _allowed_set(token_enforcer, sequence) == {_EOS_TOKEN_ID}
+    assert len(tokenizer_data.shared_allowed_token_cache) == num_cached_lists
+
+    report = TokenEnforcer(tokenizer_data, RegexParser('[a-z]+')).warm_up(max_states=5)
+    assert report.num_states_visited <= 5
+
+
+def test_warm_up_json():
+    tokenizer_data = _build_tokenizer_data()
+    schema = {'type': 'object', 'properties': {'name': {'type': 'string', 'minLength': 2}, 'count': {'type': 'integer'},
+                                               'tags': {'type': 'array', 'items': {'type': 'string', 'enum': ['x', 'yy']}}}}
+    report = TokenEnforcer(tokenizer_data, JsonSchemaParser(schema)).warm_up()
+    # The exploration covers the structure instead of every whitespace run and number, and reaches the free text string
+    assert report.num_states_visited < 1000
+    assert report.num_states_computed == 3
+    freetext_cache = tokenizer_data.tokenizer_tree.json_freetext_tokens
+    num_cached_lists = len(freetext_cache.allowlist_cache)
+    assert num_cached_lists > 0
+    # A new request in the string reuses the lists
+    token_enforcer = TokenEnforcer(tokenizer_data, JsonSchemaParser(schema))
+    state = token_enforcer.get_initial_state()
+    for token in _encode('{"name": "ab'):
+        token_enforcer.get_allowed_tokens(state)
+        state = token_enforcer.advance(state, token)
+    token_enforcer.get_allowed_tokens(state)
+    assert len(freetext_cache.allowlist_cache) == num_cached_lists
+
+
+def test_very_long_tokens():
+    # Deeper than the default recursion limit
+    long_token = ' ' * (sys.getrecursionlimit() + 100)
+    token_strs = _TOKEN_STRS + [long_token]
+    regular_tokens = [(token_id, token_str, False) for token_id, token_str in enumerate(token_strs)]
+    eos_token_id = len(token_strs)
+    tokenizer_data = TokenEnforcerTokenizerData(regular_tokens, lambda tokens: '', eos_token_id, False, eos_token_id + 1)
+    token_enforcer = TokenEnforcer(tokenizer_data, RegexParser(' *x'))
+    allowed_tokens = token_enforcer.get_allowed_tokens([])
+    assert allowed_tokens.is_token_allowed(token_strs.index(long_token))
+    assert allowed_tokens.is_token_allowed(token_strs.index('x'))
+
+
+def test_traversal_memo():
+    # [ab]*c reaches the same regex state after 'a' from the initial state and from the state after 'a'
+    token_strs = _TOKEN_STRS + ['a' + character for character in 'defghijklm']
+    regular_tokens = [(token_id, token_str, False) for token_id, token_str in enumerate(token_strs)]
+    eos_token_id = len(token_strs)
+    def decoder(tokens: List[int]) -> str:
+        return "".join(token_strs[token] for token in tokens if token != eos_token_id)
+    tokenizer_data = TokenEnforcerTokenizerData(regular_tokens, decoder, eos_token_id, False, eos_token_id + 1)
+    token_enforcer = TokenEnforcer(tokenizer_data, RegexParser('[ab]*c'))
+    unmemoized_enforcer = TokenEnforcer(tokenizer_data, RegexParser('[ab]*c'), max_traversal_memo_size=0)
+    for sequence in [[], [token_strs.index('a')], [token_strs.index('a'), token_strs.index('b')]]:
+        allowed_tokens = token_enforcer.get_allowed_tokens(sequence).allowed_tokens
+        assert sorted(allowed_tokens) == sorted(unmemoized_enforcer.get_allowed_tokens(sequence).allowed_tokens)
+    assert token_enforcer.stats.num_traversal_memo_hits > 0
+    assert unmemoized_enforcer.stats.num_traversal_memo_hits == 0
+    assert token_enforcer.memory_usage()['num_traversal_memo_entries'] > 0
+
+
+def test_compact_prefix_tree():
+    tokenizer_data = _build_tokenizer_data()
+    compact_tokenizer_data = _build_tokenizer_data(compact_prefix_tree=True)
+    tree, compact_tree = tokenizer_data.tokenizer_tree, compact_tokenizer_data.tokenizer_tree
+    assert sorted(compact_tokenizer_data.tokenizer_alphabet) == sorted(tokenizer_data.tokenizer_alphabet)
+    assert compact_tree.get_subtree_size(compact_tree.root) == tree.get_subtree_size(tree.root)
+    assert compact_tree.memory_usage() < tree.memory_usage()
+    schema = {"type": "object", "properties": {"name": {"type": "string"}, "flag": {"type": "boolean"}}}
+    for parser, prefix in [(JsonSchemaParser(schema), '{"name": "abc'), (JsonSchemaParser(schema), '{"flag": '),
+                           (RegexParser('(abc|[0-9]+)( (abc|[0-9]+))*'), 'abc 12')]:
+        token_enforcer = TokenEnforcer(tokenizer_data, parser)
+        compact_token_enforcer = TokenEnforcer(compact_tokenizer_data, parser)
+        for idx in range(len(prefix) + 1):
+            sequence = _encode(prefix[:idx])
+            assert _allowed_set(compact_token_enforcer, sequence) == _allowed_set(token_enforcer, sequence)
+    forced_sequence = _encode('{"name": "abc", "flag"')
+    assert TokenEnforcer(compact_tokenizer_data, JsonSchemaParser(schema)).get_forced_continuation(forced_sequence) == \
+        TokenEnforcer(tokenizer_data, JsonSchemaParser(schema)).get_forced_continuation(forced_sequence)
+
+
+def test_path_compressed_prefix_tree():
+    # Long tokens that share a prefix with shorter ones, so that edges are split in the middle of a token
+    token_strs = _TOKEN_STRS + ['falsehood', 'fals', '        ', '    ', 'abcabc', 'named', 'nameless', '"name": "']
+    regular_tokens = [(token_id, token_str, False) for token_id, token_str in enumerate(token_strs)]
+    eos_token_id = len(token_strs)
+    def decoder(tokens: List[int]) -> str:
+        return "".join(token_strs[token] for token in tokens if token != eos_token_id)
+    def build(**kwargs) -> TokenEnforcerTokenizerData:
+        return TokenEnforcerTokenizerData(regular_tokens, decoder, eos_token_id, False, eos_token_id + 1, **kwargs)
+    tokenizer_data, radix_tokenizer_data = build(), build(path_compressed_prefix_tree=True)
+    tree, radix_tree = tokenizer_data.tokenizer_tree, radix_tokenizer_data.tokenizer_tree
+    assert radix_tree.get_subtree_size(radix_tree.root) < tree.get_subtree_size(tree.root)
+    assert radix_tree.get_edge_suffix(radix_tree.get_child(radix_tree.get_child(radix_tree.root, 'f'), 'a')) == 'ls'
+    schema = {"type": "object", "properties": {"name": {"type": "string", "enum": ["falsehood", "nameless"]}, 
+                                               "flag": {"type": "boolean"}}}
+    for parser, prefix in [(JsonSchemaParser(schema), '{"name": "fal'), (JsonSchemaParser(schema), '{"flag": f'),
+                           (RegexParser('(abc|[0-9]+)( +(abc|name[a-z]*))*'), 'abc   na')]:
+        token_enforcer = TokenEnforcer(tokenizer_data, parser)
+        radix_token_enforcer = TokenEnforcer(radix_tokenizer_data, parser)
+        state, radix_state = token_enforcer.get_initial_state(), radix_token_enforcer.get_initial_state()
+        for character in prefix:
+            allowed_tokens = token_enforcer.get_allowed_tokens(state).allowed_tokens
+            assert sorted(radix_token_enforcer.get_allowed_tokens(radix_state).allowed_tokens) == sorted(allowed_tokens)
+            state = token_enforcer.advance(state, token_strs.index(character))
+            radix_state = radix_token_enforcer.advance(radix_state, token_strs.index(character))
+    token_enforcer = TokenEnforcer(tokenizer_data, JsonSchemaParser(schema))
+    radix_token_enforcer = TokenEnforcer(radix_tokenizer_data, JsonSchemaParser(schema))
+    state, radix_state = token_enforcer.get_initial_state(), radix_token_enforcer.get_initial_state()
+    for character in '{"name": "fa':
+        state = token_enforcer.advance(state, token_strs.index(character))
+        radix_state = radix_token_enforcer.advance(radix_state, token_strs.index(character))
+    forced_text, forced_tokens = radix_token_enforcer.get_forced_continuation(radix_state)
+    assert forced_text == 'lsehood"'
+    assert (forced_text, forced_tokens) == token_enforcer.get_forced_continuation(state)
+
+
+def test_whole_subtrees():
+    token_strs = _TOKEN_STRS + [' ' * length for length in range(3, 13)] + ['\n' * length for length in range(2, 6)] + \
+        ['abcdefghij', 'a   b', '"abcdefghijklmnop', '"abc"', 'abc"}']
+    regular_tokens = [(token_id, token_str, False) for token_id, token_str in enumerate(token_strs)]
+    eos_token_id = len(token_strs)
+    def decoder(tokens: List[int]) -> str:
+        return "".join(token_strs[token] for token in tokens if token != eos_token_id)
+    def brute_force_allowed(parser: CharacterLevelParser) -> set:
+        allowed = set()
+        for token_id, token_str in enumerate(token_strs):
+            token_parser = parser
+            for character in token_str:
+                if character not in token_parser.get_allowed_characters():
+                    break
+                token_parser = token_parser.add_character(character)
+            else:
+                allowed.add(token_id)
+        return allowed
+    schema = {"type": "object", "properties": {"name": {"type": "string"}}}
+    json_parser = JsonSchemaParser(schema)
+    for character in '{"name": ':
+        json_parser = json_parser.add_character(character)
+    for tree_kwargs in [{}, {'compact_prefix_tree': True}, {'path_compressed_prefix_tree': True}]:
+        tokenizer_data = TokenEnforcerTokenizerData(regular_tokens, decoder, eos_token_id, False, eos_token_id + 1, **tree_kwargs)
+        for parser in [ForceStopParser(allow_whitespace=True), RegexParser('abc.*').add_string('abc'), 
+                       RegexParser('[a-j ]*x'), json_parser]:
+            token_enforcer = TokenEnforcer(tokenizer_data, parser)
+            allowed_tokens = set(token_enforcer.get_allowed_tokens(token_enforcer.get_initial_state()).allowed_tokens)
+            assert allowed_tokens - {eos_token_id} == brute_force_allowed(parser)
+            if not isinstance(parser, JsonSchemaParser):
+                # The path compressed tree has no big enough subtree below the JSON string's opening quote
+                assert token_enforcer.stats.num_whole_subtrees > 0
+        # The subtree characters are kept in a bounded cache, as the tree is shared by all of the enforcers
+        tree = tokenizer_data.tokenizer_tree
+        tree._subtree_characters_cache = LRUCache(1)
+        tokenizer_data.shared_allowed_token_cache.clear()
+        for parser in [RegexParser('abc.*').add_string('abc'), RegexParser('[a-j ]*x')]:
+            token_enforcer = TokenEnforcer(tokenizer_data, parser)
+            allowed_tokens = set(token_enforcer.get_allowed_tokens(token_enforcer.get_initial_state()).allowed_tokens)
+            assert allowed_tokens - {eos_token_id} == brute_force_allowed(parser)
+        assert len(tree._subtree_characters_cache) == 1
+
+
+def test_parser_transition_table():
+    tokenizer_data = _build_tokenizer_data()
+    table = tokenizer_data.parser_transition_table
+    pattern = '(abc|[0-9]+)( (abc|[0-9]+))*'
+    expected = _allowed_set(TokenEnforcer(tokenizer_data, RegexParser(pattern)), _encode('abc 1'))
+    num_misses = table.num_misses
+    assert num_misses > 0 and len(table) > 0
+    # A different TokenEnforcer of the same pattern follows the transitions that were already computed
+    tokenizer_data.shared_allowed_token_cache.clear()
+    assert _allowed_set(TokenEnforcer(tokenizer_data, RegexParser(pattern)), _encode('abc 1')) == expected
+    assert table.num_misses == num_misses
+    assert table.num_hits > 0
+
+    bounded_table = ParserTransitionTable(max_size=4)
+    parser = RegexParser('[0-9]+')
+    for character in '0123456789':
+        bounded_table.add_character('namespace', parser, parser.cache_key(), character)
+    assert len(bounded_table) <= 4
+
+
+def test_pickle_tokenizer_data_and_enforcer():
+    tokenizer_data = _build_tokenizer_data()
+    pattern = '(abc|[0-9]+)( (abc|[0-9]+))*'
+    expected = _allowed_set(TokenEnforcer(tokenizer_data, RegexParser(pattern)), _encode('abc 1'))
+    # The caches, including the parser transition table, are kept
+    loaded_tokenizer_data = pickle.loads(pickle.dumps(tokenizer_data))
+    assert len(loaded_tokenizer_data.parser_transition_table) == len(tokenizer_data.parser_transition_table)
+    assert len(loaded_tokenizer_data.shared_allowed_token_cache) == len(tokenizer_data.shared_allowed_token_cache)
+    assert _allowed_set(TokenEnforcer(loaded_tokenizer_data, RegexParser(pattern)), _encode('abc 1')) == expected
+
+    schema = {'type': 'object', 'properties': {'name': {'type': 'string'}, 'count': {'type': 'integer'}}}
+    token_enforcer = TokenEnforcer(tokenizer_data, JsonSchemaParser(schema), prefetch=True)
+    state = token_enforcer.get_initial_state()
+    for token in _encode('{"name": "ab", "co'):
+        token_enforcer.get_allowed_tokens(state)
+        state = token_enforcer.advance(state, token)
+    loaded_enforcer, loaded_state = pickle.loads(pickle.dumps((token_enforcer, state)))
+    for token in _encode('unt": 1'):
+        assert _allowed_set(loaded_enforcer, loaded_state) == _allowed_set(token_enforcer, state)
+        state = token_enforcer.advance(state, token)
+        loaded_state = loaded_enforcer.advance(loaded_state, token)
+    assert _allowed_set(loaded_enforcer, loaded_state) == _allowed_set(token_enforcer, state)
+
+
+def test_bytes_incremental_detokenizer():
+    # 'é' is split between two byte tokens, which are meaningless on their own
+    token_strs = _TOKEN_STRS + ['\ufffd', '\ufffd']
+    token_bytes = [token_str.encode('utf-8') for token_str in _TOKEN_STRS] + [b'\xc3', b'\xa9']
+    first_byte_token, second_byte_token = len(_TOKEN_STRS), len(_TOKEN_STRS) + 1
+    regular_tokens = [(token_id, token_str, False) for token_id, token_str in enumerate(token_strs)]
+    eos_token_id = len(token_strs)
+    def decoder(tokens: List[int]) -> str:
+        raise AssertionError("The incremental detokenizer should be used")
+    tokenizer_data = TokenEnforcerTokenizerData(regular_tokens, decoder, eos_token_id, False, eos_token_id + 1,
+                                                incremental_detokenizer=BytesIncrementalDetokenizer(token_bytes))
+    token_enforcer = TokenEnforcer(tokenizer_data, RegexParser('ab[éc]+x'))
+    state = token_enforcer.get_initial_state()
+    for token in [_TOKEN_STRS.index('a'), _TOKEN_STRS.index('b'), first_byte_token, second_byte_token, _TOKEN_STRS.index('c')]:
+        state = token_enforcer.advance(state, token)
+    assert _allowed_set(token_enforcer, state) == {_TOKEN_STRS.index('c'), _TOKEN_STRS.index('x')}
+
+    detokenizer = BytesIncrementalDetokenizer(token_bytes)
+    detokenizer_state = detokenizer.start([_TOKEN_STRS.index('a'), first_byte_token])
+    assert detokenizer_state == b'\xc3'
+    assert detokenizer.decode_next(detokenizer_state, second_byte_token) == ('\u00e9', b'')
+
+
+def _build_byte_level_tokenizer_data():
+    # Byte fallback tokens, 'é' and '中' are only valid in combination
+    byte_tokens = [b'\xc3', b'\xa9', b'\xe4', b'\xb8', b'\xad']
+    token_bytes = [token_str.encode('utf-8') for token_str in _TOKEN_STRS] + byte_tokens
+    regular_tokens = [(token_id, token_str, False) for token_id, token_str in enumerate(_TOKEN_STRS)]
+    regular_tokens += [(len(_TOKEN_STRS) + idx, '\ufffd', False) for idx in range(len(byte_tokens))]
+    eos_token_id = len(token_bytes)
+    def decoder(tokens: List[int]) -> str:
+        return b''.join(token_bytes[token] for token in tokens if token != eos_token_id).decode('utf-8', errors='ignore')
+    tokenizer_data = TokenEnforcerTokenizerData(regular_tokens, decoder, eos_token_id, False, eos_token_id + 1, token_bytes=token_bytes)
+    return tokenizer_data, token_bytes
+
+
+def test_byte_level_mode():
+    tokenizer_data, token_bytes = _build_byte_level_tokenizer_data()
+    byte_token_ids = {token_value: token_id for token_id, token_value in enumerate(token_bytes)}
+    token_enforcer = TokenEnforcer(tokenizer_data, RegexParser('ab[éc]+x'))
+    state = token_enforcer.get_initial_state()
+    for token in [b'a', b'b']:
+        state = token_enforcer.advance(state, byte_token_ids[token])
+    allowed = _allowed_set(token_enforcer, state)
+    # Only the first byte of 'é' is allowed on its own, and only the second byte can follow it
+    assert allowed == {byte_token_ids[b'c'], byte_token_ids[b'\xc3']}
+    state = token_enforcer.advance(state, byte_token_ids[b'\xc3'])
+    assert _allowed_set(token_enforcer, state) == {byte_token_ids[b'\xa9']}
+    state = token_enforcer.advance(state, byte_token_ids[b'\xa9'])
+    assert byte_token_ids[b'x'] in _allowed_set(token_enforcer, state)
+    state = token_enforcer.advance(state, byte_token_ids[b'x'])
+    assert _allowed_set(token_enforcer, state) == {tokenizer_data.eos_token_id}
+
+    # Multilingual JSON freetext, with the shortcut and after incomplete characters
+    schema = {'type': 'object', 'properties': {'name': {'type': 'string'}}}
+    json_enforcer = TokenEnforcer(tokenizer_data, JsonSchemaParser(schema))
+    state = json_enforcer.get_initial_state()
+    for token in [b'{"', b'name', b'":', b' ', b'"', b'a']:
+        state = json_enforcer.advance(state, byte_token_ids[token])
+    allowed = _allowed_set(json_enforcer, state)
+    assert byte_token_ids[b'\xe4'] in allowed and byte_token_ids[b'\xad'] not in allowed
+    state = json_enforcer.advance(json_enforcer.advance(state, byte_token_ids[b'\xe4']), byte_token_ids[b'\xb8'])
+    # Only continuation bytes can complete the character
+    incomplete_character_allowed = _allowed_set(json_enforcer, state)
+    assert incomplete_character_allowed == {byte_token_ids[b'\xa9'], byte_token_ids[b'\xb8'], byte_token_ids[b'\xad']}
+    dumped_state = json_enforcer.dump_state(state)
+    state = json_enforcer.advance(state, byte_token_ids[b'\xad'])
+    assert byte_token_ids[b'"}'] in _allowed_set(json_enforcer, state)
+    state = json_enforcer.advance(state, byte_token_ids[b'"'])
+    assert json_enforcer.get_forced_continuation(state, skip_optional_whitespace=True)[0] == '}'
+
+    loaded_enforcer = TokenEnforcer(tokenizer_data, JsonSchemaParser(schema))
+    loaded_state = loaded_enforcer.load_state(dumped_state)
+    assert _allowed_set(loaded_enforcer, loaded_state) == incomplete_character_allowed
+
+
+def test_byte_level_supplementary_characters():
+    # A byte fallback vocabulary can build any character, including emoji, which are 4 bytes long
+    byte_tokens = [bytes([byte]) for byte in range(0x80, 0x100)]
+    token_bytes = [token_str.encode('utf-8') for token_str in _TOKEN_STRS] + byte_tokens
+    regular_tokens = [(token_id, token_str, False) for token_id, token_str in enumerate(_TOKEN_STRS)]
+    regular_tokens += [(len(_TOKEN_STRS) + idx, '\ufffd', False) for idx in range(len(byte_tokens))]
+    eos_token_id = len(token_bytes)
+    def decoder(tokens: List[int]) -> str:
+        return b''.join(token_bytes[token] for token in tokens if token != eos_token_id).decode('utf-8', errors='ignore')
+    tokenizer_data = TokenEnforcerTokenizerData(regular_tokens, decoder, eos_token_id, False, eos_token_id + 1, token_bytes=token_bytes)
+    byte_token_ids = {token_value: token_id for token_id, token_value in enumerate(token_bytes)}
+    # The characters that can only be built from bytes are not listed in the alphabet
+    assert len(tokenizer_data.tokenizer_alphabet) < 1000
+
+    for string_schema in [{'type': 'string'}, {'type': 'string', 'maxLength': 2}]:
+        schema = {'type': 'object', 'properties': {'name': string_schema}}
+        token_enforcer = TokenEnforcer(tokenizer_data, JsonSchemaParser(schema))
+        state = token_enforcer.get_initial_state()
+        for token in [b'{"', b'name', b'":', b' ', b'"']:
+            state = token_enforcer.advance(state, byte_token_ids[token])
+        for token in '\U0001F600'.encode('utf-8'):
+            allowed = _allowed_set(token_enforcer, state)
+            assert byte_token_ids[bytes([token])] in allowed
+            state = token_enforcer.advance(state, byte_token_ids[bytes([token])])
+        assert byte_token_ids[b'"'] in _allowed_set(token_enforcer, state)
+
+    # Only the continuation bytes of valid UTF-8 are allowed, for example no surrogates after 0xED
+    token_enforcer = TokenEnforcer(tokenizer_data, JsonSchemaParser({'type': 'string'}))
+    state = token_enforcer.advance(token_enforcer.get_initial_state(), byte_token_ids[b'"'])
+    state = token_enforcer.advance(state, byte_token_ids[b'\xed'])
+    assert _allowed_set(token_enforcer, state) == set(byte_token_ids[bytes([byte])] for byte in range(0x80, 0xA0))
+
+
+def test_dead_end_allows_eos():
+    class DeadEndParser(CharacterLevelParser):
+        def add_character(self, new_character: str) -> CharacterLevelParser:
+            return self
+
+        def get_allowed_characters(self) -> str:
+            return ''
+
+        def can_end(self) -> bool:
+            return False
+
+    token_enforcer = TokenEnforcer(_build_tokenizer_data(), DeadEndParser())
+    assert _allowed_set(token_enforcer, token_enforcer.get_initial_state()) == {_EOS_TOKEN_ID}
@@ -1,6 +1,8 @@
 from lmformatenforcer import RegexParser
-from lmformatenforcer.integrations.transformers import build_transformers_prefix_allowed_tokens_fn, generate_enforced
-from transformers import pipeline
+from lmformatenforcer.integrations.transformers import build_transformers_prefix_allowed_tokens_fn, generate_enforced, \
+    _build_token_bytes_list, _bytes_to_unicode
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import PreTrainedTokenizerFast, pipeline
 
 def _build_pipeline():
     return pipeline('text-generation', model='hf-internal-testing/tiny-random-GPTNeoModel')
@@ -50,3 +52,49 @@ def test_transfomers_generate_function_integration():
     for idx in range(len(prompts)):
         output_text = hf_pipeline.tokenizer.decode(outputs[idx], skip_special_tokens=True)[len(prompts[idx]):]
         assert output_text == 'abc123'
+
+
+def test_token_bytes_by_tokenizer_type():
+    # Byte level BPE: the vocabulary has a printable character for every byte
+    byte_characters = list(_bytes_to_unicode().values())
+    vocab = {character: idx for idx, character in enumerate(byte_characters)}
+    vocab['Ġh'] = len(vocab)
+    vocab['Ã©'] = len(vocab)
+    bpe_tokenizer = Tokenizer(models.BPE(vocab, [('Ġ', 'h'), ('Ã', '©')]))
+    bpe_tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=bpe_tokenizer, eos_token='<eos>')
+    token_bytes = _build_token_bytes_list(tokenizer, len(tokenizer))
+    assert token_bytes[vocab['Ġh']] == b' h'
+    assert token_bytes[vocab['Ã©']] == 'é'.encode('utf-8')
+    assert token_bytes[tokenizer.eos_token_id] is None
+
+    # Sentencepiece without byte fallback: '▁' is a space, and the other characters are text
+    vocab = {'<unk>': 0, '▁': 1, 'a': 2, '▁a': 3, 'é': 4, '▁é': 5}
+    sentencepiece_tokenizer = Tokenizer(models.BPE(vocab, [('▁', 'a'), ('▁', 'é')], unk_token='<unk>'))
+    sentencepiece_tokenizer.pre_tokenizer = pre_tokenizers.Metaspace()
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=sentencepiece_tokenizer, unk_token='<unk>', eos_token='<unk>')
+    token_bytes = _build_token_bytes_list(tokenizer, len(tokenizer))
+    assert token_bytes[1:] == [b' ', b'a', b' a', 'é'.encode('utf-8'), ' é'.encode('utf-8')]
+
+    # Sentencepiece with byte fallback
+    vocab = {'<unk>': 0, '<0xC3>': 1, '<0xA9>': 2, '▁a': 3}
+    sentencepiece_tokenizer = Tokenizer(models.BPE(vocab, [], unk_token='<unk>', byte_fallback=True))
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=sentencepiece_tokenizer, unk_token='<unk>', eos_token='<unk>')
+    token_bytes = _build_token_bytes_list(tokenizer, len(tokenizer))
+    assert token_bytes[1:] == [b'\xc3', b'\xa9', b' a']
+
+    # WordPiece: the tokens that continue a word have a '##' prefix, and the other tokens start a word
+    vocab = {'[UNK]': 0, 'play': 1, '##ing': 2, '##é': 3, ',': 4}
+    wordpiece_tokenizer = Tokenizer(models.WordPiece(vocab, unk_token='[UNK]'))
+    wordpiece_tokenizer.pre_tokenizer = pre_tokenizers.BertPreTokenizer()
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=wordpiece_tokenizer, unk_token='[UNK]', eos_token='[UNK]')
+    token_bytes = _build_token_bytes_list(tokenizer, len(tokenizer))
+    assert token_bytes[1:] == [b' play', b'ing', '\u00e9'.encode('utf-8'), b' ,']
+
+    # Other tokenizers: the tokens are decoded after token 0
+    vocab = {'<unk>': 0, '0': 1, 'a': 2, 'b': 3}
+    word_level_tokenizer = Tokenizer(models.WordLevel(vocab, unk_token='<unk>'))
+    word_level_tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=word_level_tokenizer, unk_token='<unk>', eos_token='<unk>')
+    token_bytes = _build_token_bytes_list(tokenizer, len(tokenizer))
+    assert token_bytes[2:] == [tokenizer.decode([1, 2])[1:].encode('utf-8'), tokenizer.decode([1, 3])[1:].encode('utf-8')]